@@ -0,0 +1,12 @@
+"""
+Offline benchmarks for the Promptbox retrieval and generation paths.
+
+Run from the repository root with `python -m benchmarks`. See README.md for the options.
+"""
+import os
+import sys
+
+# The Streamlit app imports its helpers as `utils.*`, with ui/ as the working directory
+UI_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ui")
+if UI_DIR not in sys.path:
+    sys.path.insert(0, UI_DIR)
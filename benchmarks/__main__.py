@@ -0,0 +1,59 @@
+"""
+Runs the benchmarks and prints a table of the results.
+
+    python -m benchmarks [--model stub] [--iterations 20] [--output results.json] [--baseline baseline.json]
+
+Exits with status 1 if a metric regressed by more than --tolerance compared to the baseline.
+"""
+import argparse
+import logging
+import platform
+import sys
+
+from benchmarks.runner import compare, format_table, load_json, run_case, save_json
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=__doc__.split("\n")[1])
+    parser.add_argument("--model", default="stub", help="Path of a GGML model file, or 'stub' for a simulated model")
+    parser.add_argument("--store", default="memory", choices=["memory", "bm25"],
+                        help="Stand in for Elasticsearch in memory, or use the embedded BM25 document store")
+    parser.add_argument("--iterations", type=int, default=20, help="Timed iterations per case")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed iterations per case")
+    parser.add_argument("--documents", type=int, default=20, help="Number of documents in the synthetic corpus")
+    parser.add_argument("--paragraphs", type=int, default=30, help="Paragraphs per document")
+    parser.add_argument("--max-tokens", type=int, default=64, help="Tokens to generate in the invoke case")
+    parser.add_argument("--cases", nargs="*", help="Only run these cases")
+    parser.add_argument("--output", help="Write the results to this JSON file, to use as a baseline later")
+    parser.add_argument("--baseline", help="JSON file of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed regression, as a fraction of the baseline")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.ERROR)
+
+    from benchmarks.cases import build_cases, prepare
+
+    promptbox, promptmodel, store = prepare(args.model, args.documents, args.paragraphs, args.store)
+    results = {}
+    for case in build_cases(promptbox, promptmodel, store, args.max_tokens):
+        if args.cases and case.name not in args.cases:
+            continue
+        print(f"Running {case.name}...", file=sys.stderr)
+        results[case.name] = run_case(case, args.iterations, args.warmup)
+
+    print(format_table(results))
+    if args.output:
+        save_json(args.output, {"model": args.model, "store": args.store, "python": platform.python_version(), "cases": results})
+
+    if args.baseline:
+        regressions = compare(results, load_json(args.baseline)["cases"], args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print(f"No regressions beyond {args.tolerance:.0%} of {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
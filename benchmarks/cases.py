@@ -0,0 +1,162 @@
+"""
+The benchmark cases, run against the stand-ins in benchmarks.stubs.
+"""
+import io
+import os
+import tempfile
+import time
+from typing import Any, Dict, List
+
+from benchmarks.runner import Case
+from benchmarks.stubs import StubHaystackAPI, StubElasticsearch, StubLlama, make_corpus
+from utils import tracing
+from utils.tracing import Trace
+
+PROMPT = (
+    "Answer the question using only the documents below. If the documents do not answer it, say so.\n\n"
+    "Documents: {join(documents)}\n\nQuestion: {query}\n\nAnswer:"
+)
+SENTIMENT_PROMPT = (
+    "Does the answer below say yes or no to the question? Reply with 'yes.', 'no.' or 'na.'.\n\n"
+    "Answer: {join(documents)}\n\nQuestion: {query}\n\nReply:"
+)
+QUESTIONS = [
+    "Does the bank restrict financing of new coal power projects?",
+    "Does the bank require clients to have a transition plan?",
+    "Does the policy cover arctic oil and gas exploration?",
+    "Does the bank finance oil sands expansion?",
+]
+
+
+class TokenTimer:
+    """
+    Stream handler recording when the first token and the last token arrive.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.first = None
+        self.last = None
+        self.tokens = 0
+
+    def __call__(self, token_received: str, **kwargs) -> str:
+        now = time.perf_counter()
+        if self.first is None:
+            self.first = now
+        self.last = now
+        self.tokens += 1
+        return token_received
+
+
+def prepare(model: str, documents: int, paragraphs: int, store: str = "memory"):
+    """
+    Starts the stand-ins and points Promptbox at them. Has to run before utils.utils is imported, because it reads its
+    endpoints, document store and cache location from the environment at import time.
+
+    :param model: Path of a GGML model file, or "stub" to use StubLlama.
+    :param store: "memory" to stand in for Elasticsearch with an InMemoryDocumentStore, or "bm25" to use the
+    embedded NumpyBM25DocumentStore the way DOCUMENT_STORE=bm25 does.
+    :return: The utils.utils module, the PromptModel, and the document store.
+    """
+    api = StubHaystackAPI()
+    workdir = tempfile.mkdtemp(prefix="promptbox-bench-")
+    os.environ["API_ENDPOINT"] = api.url
+    os.environ["ANSWER_CACHE_PATH"] = os.path.join(workdir, "answer_cache.db")
+    if store == "bm25":
+        os.environ["DOCUMENT_STORE"] = "bm25"
+        os.environ["BM25_INDEX_PATH"] = os.path.join(workdir, "bm25_index")
+
+    from haystack.document_stores import InMemoryDocumentStore
+    from haystack.nodes import PromptModel
+    from haystack.schema import Document
+
+    import utils.llamalayer
+    import utils.utils as promptbox
+
+    if model == "stub":
+        utils.llamalayer.Llama = StubLlama
+
+    if store == "bm25":
+        document_store = promptbox.get_document_store()
+    else:
+        document_store = InMemoryDocumentStore(use_bm25=True)
+        promptbox.get_document_store = lambda: document_store
+        promptbox.Elasticsearch = lambda *args, **kwargs: StubElasticsearch(document_store)
+    corpus = make_corpus(documents, paragraphs, words=50)
+    document_store.write_documents([Document(content=p, meta={"name": name}) for name, ps in corpus.items() for p in ps])
+
+    promptmodel = PromptModel(
+        model_name_or_path=model,
+        invocation_layer_class=utils.llamalayer.LlamaCPPInvocationLayer,
+        model_kwargs={"max_context": 4096},
+    )
+    return promptbox, promptmodel, document_store
+
+
+def build_cases(promptbox: Any, promptmodel: Any, store: Any, max_tokens: int) -> List[Case]:
+    """
+    Returns the benchmark cases for the prepared module, model and document store.
+    """
+    layer = promptmodel.model_invocation_layer
+    cache = promptbox.get_answer_cache()
+    names = sorted({doc.meta["name"] for doc in store.get_all_documents()})
+    selected = names[:4]
+    counter = {"i": 0}
+
+    def next_question() -> str:
+        counter["i"] += 1
+        return QUESTIONS[counter["i"] % len(QUESTIONS)]
+
+    def invoke() -> Dict[str, float]:
+        prompt = promptbox.render_prompt(PROMPT, next_question(), store.get_all_documents()[:3])
+        prompt = promptmodel._ensure_token_limit(prompt)
+        timer = TokenTimer()
+        trace = Trace("invoke")
+        with tracing.activate(trace):
+            layer.invoke(prompt=prompt, stream=True, stream_handler=timer, max_tokens=max_tokens)
+        if timer.first is None:
+            return {}
+        # The prefix cache skips the part of the prompt shared with the previous question, only count what was prefilled
+        prefill = next((s for s in trace.stages if s["stage"] == "prefill"), None)
+        if prefill is None:
+            return {}
+        return {
+            "prefill_tokens": prefill["tokens"],
+            "prefill_seconds": prefill["seconds"],
+            "decode_tokens": timer.tokens - 1,
+            "decode_seconds": timer.last - timer.first,
+        }
+
+    def query_global():
+        promptbox.query_listed_documents(next_question(), [], promptmodel, PROMPT)
+
+    def query_multi():
+        promptbox.query_listed_documents(next_question(), selected, promptmodel, PROMPT)
+
+    sentiment_docs = [{"Document": name, "Answer": f"The bank does not finance {name}."} for name in selected]
+
+    def sentiment():
+        promptbox.check_sentiment(next_question(), promptmodel, sentiment_docs, SENTIMENT_PROMPT)
+
+    def build_pipeline():
+        promptbox.build_ES_pipeline(promptmodel, PROMPT)
+
+    def fetch_docs():
+        promptbox.fetch_docs()
+
+    def upload_doc():
+        file = io.BytesIO(("\n\n".join(make_corpus(1, 20, 50, seed=counter["i"])["policy_000.txt"])).encode("utf-8"))
+        file.name = "uploaded_policy.txt"
+        promptbox.upload_doc(file)
+
+    return [
+        Case("build_ES_pipeline", build_pipeline),
+        Case("fetch_docs", fetch_docs),
+        Case("fetch_docs_uncached", fetch_docs, setup=lambda: promptbox.get_document_catalog(promptbox._default_store()).invalidate()),
+        Case("upload_doc", upload_doc),
+        Case("invoke", invoke),
+        Case("query_listed_documents_global", query_global, setup=cache.clear),
+        Case("query_listed_documents_multi", query_multi, setup=cache.clear),
+        Case("query_listed_documents_cached", query_multi),
+        Case("check_sentiment", sentiment, setup=cache.clear),
+    ]
@@ -0,0 +1,124 @@
+"""
+Timing, reporting and baseline comparison for the benchmark cases.
+"""
+import json
+import math
+import resource
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+# Metrics compared against the baseline, with whether higher is better
+COMPARED_METRICS = {
+    "p50_ms": False,
+    "p95_ms": False,
+    "prefill_tokens_per_s": True,
+    "decode_tokens_per_s": True,
+}
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """
+    Returns the q-th percentile (0-100) of the values, interpolating linearly between the closest ranks.
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return float("nan")
+    rank = (len(ordered) - 1) * q / 100
+    low, high = math.floor(rank), math.ceil(rank)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident set size of this process so far, in MB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+class Case:
+    """
+    A benchmark case. `run` is called once per iteration, after `setup` if one is given, and only the run is timed.
+    If `run` returns a dictionary, its numeric values are summed over the iterations and reported as extra metrics.
+    """
+
+    def __init__(self, name: str, run: Callable[[], Optional[Dict[str, float]]], setup: Optional[Callable[[], None]] = None):
+        self.name = name
+        self.run = run
+        self.setup = setup
+
+
+def run_case(case: Case, iterations: int, warmup: int = 1) -> Dict[str, Any]:
+    """
+    Runs a case and returns its latency percentiles, extra metrics and the peak RSS after it ran.
+    """
+    for _ in range(warmup):
+        if case.setup is not None:
+            case.setup()
+        case.run()
+
+    latencies: List[float] = []
+    extra: Dict[str, float] = {}
+    for _ in range(iterations):
+        if case.setup is not None:
+            case.setup()
+        start = time.perf_counter()
+        metrics = case.run()
+        latencies.append(time.perf_counter() - start)
+        for key, value in (metrics or {}).items():
+            extra[key] = extra.get(key, 0) + value
+
+    result = {
+        "iterations": iterations,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+    }
+    if extra.get("prefill_seconds"):
+        result["prefill_tokens_per_s"] = extra["prefill_tokens"] / extra["prefill_seconds"]
+    if extra.get("decode_seconds"):
+        result["decode_tokens_per_s"] = extra["decode_tokens"] / extra["decode_seconds"]
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def compare(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]], tolerance: float) -> List[str]:
+    """
+    Compares results against a baseline and returns a description of each metric that regressed by more than
+    `tolerance`, a fraction of the baseline value.
+    """
+    regressions = []
+    for name, metrics in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            if metric not in metrics or not base.get(metric):
+                continue
+            change = (metrics[metric] - base[metric]) / base[metric]
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f"{name} {metric}: {base[metric]:.2f} -> {metrics[metric]:.2f} ({change:+.0%})")
+    return regressions
+
+
+def format_table(results: Dict[str, Dict[str, Any]]) -> str:
+    columns = ["p50_ms", "p95_ms", "p99_ms", "prefill_tokens_per_s", "decode_tokens_per_s", "peak_rss_mb"]
+    width = max(len(name) for name in results) if results else 10
+    lines = [f"{'case':<{width}}  " + "  ".join(f"{c:>20}" for c in columns)]
+    for name, metrics in results.items():
+        cells = [f"{metrics[c]:>20.2f}" if c in metrics else f"{'-':>20}" for c in columns]
+        lines.append(f"{name:<{width}}  " + "  ".join(cells))
+    return "\n".join(lines)
+
+
+def load_json(path: str) -> Dict[str, Any]:
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_json(path: str, data: Dict[str, Any]):
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
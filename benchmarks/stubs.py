@@ -0,0 +1,185 @@
+"""
+Local stand-ins for the services Promptbox talks to, so the benchmarks run without network or model downloads.
+"""
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Sequence
+
+WORDS = (
+    "bank policy oil gas coal client financing transition plan energy sector restriction due diligence "
+    "emissions project power exploration arctic sands expansion risk framework review approval climate "
+    "target net zero portfolio lending capital markets advisory new existing customer assessment"
+).split()
+
+
+def make_corpus(documents: int, paragraphs: int, words: int, seed: int = 0) -> Dict[str, List[str]]:
+    """
+    Builds a synthetic corpus: a dictionary of document names and their paragraphs.
+    """
+    rng = random.Random(seed)
+    return {
+        f"policy_{i:03d}.txt": [" ".join(rng.choice(WORDS) for _ in range(words)) for _ in range(paragraphs)]
+        for i in range(documents)
+    }
+
+
+class StubLlama:
+    """
+    Stand-in for llama_cpp.Llama with the parts of its API the invocation layer uses.
+
+    Tokens are whitespace-separated words. Prefill and decode take a fixed time per token, and evaluated tokens are
+    tracked like the llama context does, so prefix reuse and caching show up in the numbers.
+    """
+
+    BOS = 1
+    EOS = 2
+
+    def __init__(self, model_path: str = "stub", n_ctx: int = 4096, prefill_seconds: float = 0.0002,
+        decode_seconds: float = 0.002, answer_tokens: int = 48, **kwargs):
+        self.model_path = model_path
+        self._n_ctx = n_ctx
+        self.prefill_seconds = prefill_seconds
+        self.decode_seconds = decode_seconds
+        self.answer_tokens = answer_tokens
+        self.input_ids: List[int] = []
+        self.n_tokens = 0
+        self.ctx = None
+        self._vocab: Dict[int, bytes] = {}
+        self._lock = threading.Lock()
+
+    def n_ctx(self) -> int:
+        return self._n_ctx
+
+    def n_vocab(self) -> int:
+        return 32000
+
+    def token_eos(self) -> int:
+        return self.EOS
+
+    def tokenize(self, text: bytes, add_bos: bool = True) -> List[int]:
+        tokens = [self.BOS] if add_bos else []
+        for word in text.split():
+            token = 3 + zlib.crc32(word) % 31997
+            with self._lock:
+                self._vocab[token] = word
+            tokens.append(token)
+        return tokens
+
+    def detokenize(self, tokens: Sequence[int]) -> bytes:
+        return b"".join(b" " + self._vocab.get(t, b"") for t in tokens if t not in (self.BOS, self.EOS))
+
+    def reset(self):
+        self.n_tokens = 0
+
+    def eval(self, tokens: Sequence[int]):
+        time.sleep(self.prefill_seconds * len(tokens))
+        self.input_ids = self.input_ids[: self.n_tokens] + list(tokens)
+        self.n_tokens = len(self.input_ids)
+
+    def generate(self, tokens: Sequence[int], reset: bool = True, **kwargs) -> Iterator[int]:
+        tokens = list(tokens)
+        prefix = 0
+        for a, b in zip(self.input_ids[: self.n_tokens], tokens[:-1]):
+            if a != b:
+                break
+            prefix += 1
+        self.n_tokens = prefix
+        self.eval(tokens[prefix:])
+        answer = self.tokenize(" ".join(WORDS).encode("utf-8"), add_bos=False)
+        for i in range(self.answer_tokens):
+            time.sleep(self.decode_seconds)
+            token = answer[(len(tokens) + i) % len(answer)]
+            self.input_ids = self.input_ids[: self.n_tokens] + [token]
+            self.n_tokens += 1
+            yield token
+        yield self.EOS
+
+    def save_state(self) -> List[int]:
+        return list(self.input_ids[: self.n_tokens])
+
+    def load_state(self, state: List[int]):
+        self.input_ids = list(state)
+        self.n_tokens = len(state)
+
+
+class StubElasticsearch:
+    """
+    Stand-in for the elasticsearch client, answering the aggregation queries of fetch_docs from a document store.
+    """
+
+    def __init__(self, document_store, *args, **kwargs):
+        self.document_store = document_store
+
+    def search(self, index: str = None, body: Optional[dict] = None, **kwargs) -> dict:
+        counts: Dict[str, int] = {}
+        uploaded: Dict[str, Optional[float]] = {}
+        for doc in self.document_store.get_all_documents_generator():
+            name = doc.meta.get("name", "")
+            counts[name] = counts.get(name, 0) + 1
+            if doc.meta.get("uploaded_at") is not None:
+                uploaded[name] = max(uploaded.get(name) or 0, doc.meta["uploaded_at"])
+        aggs = (body or {}).get("aggs", {})
+        result = {"hits": {"total": {"value": sum(counts.values())}, "hits": []}, "aggregations": {}}
+        for agg_name, agg in aggs.items():
+            if "terms" in agg:
+                size = agg["terms"].get("size", 10)
+                buckets = [{"key": k, "doc_count": v} for k, v in sorted(counts.items())][:size]
+                result["aggregations"][agg_name] = {"buckets": buckets}
+            elif "composite" in agg:
+                size = agg["composite"].get("size", 10)
+                after = (agg["composite"].get("after") or {}).get("name")
+                names = [k for k in sorted(counts) if after is None or k > after][:size]
+                buckets = [
+                    {"key": {"name": k}, "doc_count": counts[k], "uploaded_at": {"value": uploaded.get(k)}} for k in names
+                ]
+                page = {"buckets": buckets}
+                if len(names) == size:
+                    page["after_key"] = {"name": names[-1]}
+                result["aggregations"][agg_name] = page
+        return result
+
+
+class _HaystackAPIHandler(BaseHTTPRequestHandler):
+    def _json(self, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.endswith("/initialized"):
+            self._json(True)
+        elif self.path.endswith("/hs_version"):
+            self._json({"hs_version": "1.17.1"})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.endswith("/file-upload"):
+            self._json([])
+        else:
+            self.send_error(404)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubHaystackAPI:
+    """
+    Stand-in for the Haystack REST API on a local port, serving the endpoints the UI calls.
+    """
+
+    def __init__(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _HaystackAPIHandler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
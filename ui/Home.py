@@ -1,5 +1,5 @@
 import streamlit as st
-from utils.utils import haystack_is_ready, upload_doc, haystack_version, load_models, fetch_docs, query_listed_documents, check_sentiment
+from utils.utils import haystack_is_ready, upload_doc, haystack_version, load_models, start_models, model_status, fetch_docs, query_listed_documents, check_sentiment
 #from utils.llamalayer import LlamaCPPInvocationLayer
 import os
 
@@ -15,18 +15,31 @@ st.set_page_config(
 st.session_state['modellist'] = ['llama-cpp']
 
 
-modelbase = load_models(st.session_state.modellist) # Comment this line to run with only one model in cache
+# Models load and warm up in a background thread, so the page renders right away. A question asked before a model is ready
+# waits for it to finish loading.
+start_models(st.session_state.modellist) # Comment this line to run with only one model in cache
 
-# modelbase = load_models(['flan-t5-base']) # Uncomment this line to run with only one model in cache
+# start_models(['flan-t5-base']) # Uncomment this line to run with only one model in cache
 
-st.session_state['models'] = modelbase
+# Only the model names are kept in the session, the models themselves live in the process-wide registry
+st.session_state['models'] = list(st.session_state.modellist)
 print(st.session_state.modellist)
-print(modelbase)
 
 st.image("ui/pages/promptbox_banner.png")
 
 st.sidebar.success("Select a use case above.")
 
+# Startup state of the models, with the time spent reading, loading and warming up each of them
+status = model_status(st.session_state.modellist)
+st.sidebar.write("Models:")
+for name, model in status.items():
+    phases = ", ".join(f"{phase} {seconds:.1f}s" for phase, seconds in model['phases'].items())
+    st.sidebar.markdown(f"-- {name}: {model['state']}" + (f" ({phases})" if phases else ""))
+    if model['error']:
+        st.sidebar.caption(model['error'])
+if any(model['state'] not in ("ready", "failed") for model in status.values()):
+    st.sidebar.button("Refresh model status")
+
 st.markdown(
     """
     Promptbox brings Generative AI in a more intuitive, workflow-manner to your organisation. \n
@@ -7,7 +7,8 @@ from json import JSONDecodeError
 import pandas as pd
 import streamlit as st
 from markdown import markdown
-from utils.utils import haystack_is_ready, upload_doc, haystack_version, load_models, fetch_docs, query_listed_documents, check_sentiment
+from utils.streaming import TableStreamingHandler
+from utils.utils import haystack_is_ready, ingest_docs, haystack_version, load_models, lease_model, model_status, fetch_docs, query_listed_documents, query_listed_documents_batch, check_sentiment, stage_timings, run_request, cancel_request, GenerationCancelled, DEFAULT_PROMPT_AT_STARTUP_P1
 
 # Adjust to questions for demo:
 DEFAULT_QUESTION_AT_STARTUP_P1 = os.getenv("DEFAULT_QUESTION_AT_STARTUP_P1", "What are HSBC’s restrictive policies on the Oil and Gas sectors?")
@@ -17,17 +18,18 @@ DEFAULT_QUESTION_AT_STARTUP_P4 = os.getenv("DEFAULT_QUESTION_AT_STARTUP_P4", "Wh
 DEFAULT_QUESTION_AT_STARTUP_P5 = os.getenv("DEFAULT_QUESTION_AT_STARTUP_P5", "  How will Client Transition Plan affect HSBC’s decision on financing Oil and Gas clients?")
 
 
-# Standard prompt:
-DEFAULT_PROMPT_AT_STARTUP_P1 = os.getenv("DEFAULT_PROMPT_AT_STARTUP_P1","""Synthesize a comprehensive answer from the following given question and relevant paragraphs.
-Provide a clear and concise response that summarizes the key points and information presented in the paragraphs.
-Your answer should be in your own words and be no longer than necessary.
-\n\n Question: {query}
-\n\n Paragraphs: {join(documents)}  \n\n Answer:""")
+# Standard prompt: DEFAULT_PROMPT_AT_STARTUP_P1, set in utils so the models are warmed up with it
 
 
 # Whether the file upload should be enabled or not
 DISABLE_FILE_UPLOAD = bool(os.getenv("DISABLE_FILE_UPLOAD"))
 
+# Shown next to each model, by its startup state
+MODEL_STATUS = {"pending": "⏳ waiting to load", "loading": "⏳ loading", "warming up": "⏳ warming up", "ready": "✅", "failed": "❌ failed to load"}
+
+# Shown next to each uploaded file, by the status of its ingestion job
+UPLOAD_STATUS = {"queued": "⏳ queued", "running": "⏳ indexing", "done": "✅", "failed": "❌"}
+
 
 def set_state_if_absent(key, value):
     if key not in st.session_state:
@@ -52,6 +54,8 @@ def main():
 
     # Small callback to reset the interface in case the text of the question changes
     def reset_results(*args):
+        # The answer to the old question is not shown anymore, stop generating it
+        cancel_request()
         st.session_state.answer = None
         st.session_state.results = None
         st.session_state.raw_json = None
@@ -63,19 +67,25 @@ def main():
     # Sidebar
     st.sidebar.header("Options")
     st.sidebar.write("Available models: \n ")
-    for i in st.session_state.modellist:
-        st.sidebar.markdown("-- " + i)
+    for i, status in model_status(st.session_state.modellist).items():
+        st.sidebar.markdown("-- " + i + " &nbsp;&nbsp; " + MODEL_STATUS.get(status['state'], status['state']))
 
 
     # File upload block
     if not DISABLE_FILE_UPLOAD:
         st.sidebar.write("## File Upload:")
         data_files = st.sidebar.file_uploader("", type=["pdf", "txt", "docx"], accept_multiple_files=True)
-        for data_file in data_files:
-            # Upload file
-            if data_file:
-                raw_json = upload_doc(data_file)
-                st.sidebar.write(str(data_file.name) + " &nbsp;&nbsp; ✅ ")
+        if data_files:
+            # Files are indexed in the background, files that were indexed before are not sent again
+            jobs = ingest_docs([data_file for data_file in data_files if data_file])
+            done = sum(job['status'] == 'done' for job in jobs)
+            st.sidebar.progress(done / len(jobs))
+            for job in jobs:
+                st.sidebar.write(str(job['name']) + " &nbsp;&nbsp; " + UPLOAD_STATUS.get(job['status'], "⏳"))
+                if job['status'] == 'failed':
+                    st.sidebar.caption(job['error'])
+            if done < len(jobs):
+                st.sidebar.button("Refresh upload status")
 
 
     hs_version = ""
@@ -175,39 +185,43 @@ def main():
                 st.session_state.question_p1 = question_p1
 
                 try:
-                    modelbase = st.session_state.models
                     modellist = st.session_state.modellist
                     output = {}
                     detailed_output = {}
+                    table = part2.empty()
 
-                    # Load each model and answer the queries for it
+                    # Answer the queries for each model. The lease loads the model if another session had it unloaded,
+                    # and keeps it loaded until the answers are in.
                     for model in modellist:
-
-
-                        # Check if the requested model(s) has already been loaded
-                        if model in modelbase.keys():
-                            print("No loading needed")
-                        else:
-                            print("Loading next model")
-                            modelbase = load_models([model])
-
-                        output[model] = {}
-                        detailed_output[model] = {}
-
-                        # Run each model
-                        for question in [question_p1,question_p2,question_p3,question_p4,question_p5]:
-                            response = query_listed_documents(question,[],modelbase[model],prompt_p1)
-                            output[model][question] = response[0][0]['Answer']
-                            detailed_output[model][question] = response[1]
-
-                    with part2:
-                        st.table(output)
+                        with lease_model(model) as promptmodel:
+                            output[model] = {}
+                            detailed_output[model] = {}
+
+                            # Run all questions for the selected document as one batch
+                            questions = [question_p1,question_p2,question_p3,question_p4,question_p5]
+                            # Partial answers are streamed into the output table while the model generates
+                            handlers = [TableStreamingHandler(table, output, model, question) for question in questions]
+                            responses = run_request(query_listed_documents_batch,questions,[document] if document else [],promptmodel,prompt_p1,
+                                                    stream_handlers=handlers,heartbeat=handlers[0].refresh)
+                            for question,handler,response in zip(questions,handlers,responses):
+                                output[model][question] = response[0][0]['Answer']
+                                detailed_output[model][question] = response[1]
+                            handler.render()
+
+                    table.table(output)
 
                     with tab3:
                         expander = st.expander("See detailed prompt info for question 1")
                         expander.write(detailed_output)
+                        # Time spent per stage, to tell a slow retrieval from a slow model
+                        timings = stage_timings(detailed_output)
+                        if timings:
+                            st.expander("See stage timings").dataframe(pd.DataFrame(timings))
 
 
+                except GenerationCancelled:
+                    # Superseded by a newer request of this session, which shows its own answers
+                    pass
                 except Exception as e:
                     print(e)
 
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The app imports its modules as `utils.*`, relative to the ui directory Streamlit runs from
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,50 @@
+import pytest
+
+st = pytest.importorskip("streamlit")
+pytest.importorskip("haystack")
+
+from haystack import Pipeline
+from haystack.nodes import PromptModel, PromptModelInvocationLayer, PromptNode, PromptTemplate
+from haystack.schema import Document
+
+from utils.streaming import TableStreamingHandler
+from utils.utils import _stream_params
+
+
+class EchoInvocationLayer(PromptModelInvocationLayer):
+    """
+    Streams a fixed answer token by token, like the llama.cpp layer does with `stream=True`.
+    """
+
+    TOKENS = ["Oil", " and", " gas"]
+
+    def __init__(self, model_name_or_path: str, **kwargs):
+        super().__init__(model_name_or_path)
+
+    def invoke(self, *args, **kwargs):
+        stream_handler = kwargs.get("stream_handler")
+        return ["".join(stream_handler(token) for token in self.TOKENS)]
+
+    def _ensure_token_limit(self, prompt):
+        return prompt
+
+    @classmethod
+    def supports(cls, model_name_or_path: str, **kwargs) -> bool:
+        return model_name_or_path == "echo"
+
+
+def test_streamed_pipeline_run_writes_into_the_page_table():
+    model = PromptModel(model_name_or_path="echo", invocation_layer_class=EchoInvocationLayer)
+    qa = Pipeline()
+    qa.add_node(component=PromptNode(model, default_prompt_template=PromptTemplate(prompt_text="{join(documents)} {query}", name="default")),
+                name="QA", inputs=["Query"])
+    table = {}
+    placeholder = st.empty()
+    handler = TableStreamingHandler(placeholder, table, "echo", "question", refresh_interval=0)
+
+    res = qa.run(query="question", documents=[Document(content="paragraph")], params={**_stream_params(handler), "debug": True})
+
+    assert res["results"] == ["Oil and gas"]
+    # The tokens end up in the table of the page, not in a copy of it
+    assert table == {"echo": {"question": "Oil and gas"}}
+    assert handler.placeholder is placeholder
@@ -0,0 +1,143 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class AnswerCache:
+    """
+    Disk-backed cache of generated answers, stored in SQLite.
+
+    Answers are keyed by everything that determines the generation: the model, the rendered prompt, the content of
+    the documents that went into it and the generation kwargs. The names of the documents an answer was generated
+    from are stored alongside it, so all answers for a document can be dropped when that document is uploaded again.
+    """
+
+    def __init__(self, path: str, max_entries: int = 10000, ttl: Optional[float] = 7 * 24 * 3600):
+        """
+        :param path: Path of the SQLite database file.
+        :param max_entries: Maximum number of answers to keep. The least recently used answers are removed first.
+        :param ttl: Number of seconds an answer stays valid. None means answers never expire.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, results TEXT, created REAL, accessed REAL)"
+            )
+            self._conn.execute("CREATE TABLE IF NOT EXISTS answer_documents (key TEXT, name TEXT)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS uploads (name TEXT PRIMARY KEY, content_hash TEXT)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS answer_documents_name ON answer_documents (name)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS answers_accessed ON answers (accessed)")
+
+    @staticmethod
+    def make_key(model: str, prompt: str, contents: Iterable[str], generation_kwargs: Dict[str, Any]) -> str:
+        """
+        Builds the cache key of a generation.
+
+        :param model: Name or path of the model.
+        :param prompt: The rendered prompt.
+        :param contents: Content of the documents the prompt was rendered from.
+        :param generation_kwargs: Generation kwargs passed to the model, such as max_tokens.
+        """
+        key = {
+            "model": model,
+            "prompt": hashlib.sha256(prompt.encode("utf-8")).hexdigest(),
+            "documents": [hashlib.sha256(c.encode("utf-8")).hexdigest() for c in contents],
+            "generation_kwargs": generation_kwargs,
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[List[str]]:
+        """
+        Returns the cached results for the key, or None if there are none or they expired.
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT results, created FROM answers WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                self._delete([key])
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE answers SET accessed = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, results: List[str], document_names: Iterable[str]):
+        """
+        Stores the results for the key, remembering which documents they were generated from.
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO answers (key, results, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(results), now, now),
+            )
+            self._conn.execute("DELETE FROM answer_documents WHERE key = ?", (key,))
+            self._conn.executemany(
+                "INSERT INTO answer_documents (key, name) VALUES (?, ?)", [(key, name) for name in set(document_names)]
+            )
+            self._evict(now)
+
+    def document_uploaded(self, name: str, content_hash: str) -> int:
+        """
+        Records an upload of a document, and removes the answers generated from it if its content changed since
+        the last upload. Returns the number of answers removed.
+        """
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT content_hash FROM uploads WHERE name = ?", (name,)).fetchone()
+            self._conn.execute("INSERT OR REPLACE INTO uploads (name, content_hash) VALUES (?, ?)", (name, content_hash))
+        if row is not None and row[0] == content_hash:
+            return 0
+        return self.invalidate_document(name)
+
+    def invalidate_document(self, name: str) -> int:
+        """
+        Removes all answers generated from the document with the given name. Returns the number of answers removed.
+        """
+        with self._lock, self._conn:
+            keys = [row[0] for row in self._conn.execute("SELECT key FROM answer_documents WHERE name = ?", (name,))]
+            self._delete(keys)
+        if keys:
+            logger.info("Removed %s cached answers for document %s", len(keys), name)
+        return len(keys)
+
+    def clear(self):
+        """
+        Removes all answers.
+        """
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM answers")
+            self._conn.execute("DELETE FROM answer_documents")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+    def _evict(self, now: float):
+        if self.ttl is not None:
+            expired = [row[0] for row in self._conn.execute("SELECT key FROM answers WHERE created < ?", (now - self.ttl,))]
+            self._delete(expired)
+        excess = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0] - self.max_entries
+        if excess > 0:
+            oldest = [
+                row[0] for row in self._conn.execute("SELECT key FROM answers ORDER BY accessed LIMIT ?", (excess,))
+            ]
+            self._delete(oldest)
+
+    def _delete(self, keys: List[str]):
+        self._conn.executemany("DELETE FROM answers WHERE key = ?", [(k,) for k in keys])
+        self._conn.executemany("DELETE FROM answer_documents WHERE key = ?", [(k,) for k in keys])
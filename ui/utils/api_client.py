@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+
+class HaystackClient:
+    """
+    Client for the Haystack REST API, with one pooled session that keeps connections alive between calls.
+
+    Failed connections are retried with exponential backoff for every method, since the request never reached the
+    API. Responses with a 502, 503 or 504 status are only retried for GET requests, so an upload is not indexed twice.
+    """
+
+    def __init__(self, endpoint: str, timeout: float = 10, upload_timeout: float = 300, retries: int = 3,
+        backoff: float = 0.3, pool_size: int = 10):
+        """
+        :param endpoint: URL of the REST API.
+        :param timeout: Seconds to wait for a response of the status endpoints.
+        :param upload_timeout: Seconds to wait for a file to be indexed.
+        :param retries: Number of retries of a failed request.
+        :param backoff: Backoff factor, the n-th retry waits backoff * 2 ** (n - 1) seconds.
+        :param pool_size: Number of connections kept open.
+        """
+        self.endpoint = endpoint.rstrip("/")
+        self.timeout = timeout
+        self.upload_timeout = upload_timeout
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset({"GET", "HEAD"}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def url(self, path: str) -> str:
+        return f"{self.endpoint}/{path.lstrip('/')}"
+
+    def is_ready(self, timeout: Optional[float] = None) -> bool:
+        """
+        Asks the API whether its pipelines are loaded. Connection errors count as not ready.
+        """
+        try:
+            return self.session.get(self.url("initialized"), timeout=timeout or self.timeout).status_code < 400
+        except requests.RequestException as e:
+            logger.debug("Haystack is not ready: %s", e)
+            return False
+
+    def version(self) -> str:
+        response = self.session.get(self.url("hs_version"), timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()["hs_version"]
+
+    def upload(self, name: str, data: bytes, params: Optional[Dict[str, str]] = None) -> Any:
+        """
+        Sends a file to the indexing pipeline of the API and returns its response.
+
+        :param params: Form fields of the request, such as split_length and meta.
+        """
+        response = self.session.post(
+            self.url("file-upload"), files=[("files", (name, data))], data=params or {}, timeout=self.upload_timeout
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncHaystackClient:
+    """
+    Asyncio variant of HaystackClient for bulk calls. Requests run on the pooled session of the client in a thread pool,
+    with at most `concurrency` of them in flight.
+    """
+
+    def __init__(self, client: HaystackClient, concurrency: int = 8):
+        self.client = client
+        self.concurrency = concurrency
+
+    async def is_ready(self) -> bool:
+        return await asyncio.get_running_loop().run_in_executor(None, self.client.is_ready)
+
+    async def version(self) -> str:
+        return await asyncio.get_running_loop().run_in_executor(None, self.client.version)
+
+    async def upload(self, name: str, data: bytes, params: Optional[Dict[str, str]] = None) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(None, self.client.upload, name, data, params)
+
+    async def upload_many(self, files: Iterable[Tuple[str, bytes]], params: Optional[Dict[str, str]] = None) -> List[Any]:
+        """
+        Uploads files concurrently. Returns the response for every file in order, or the exception it failed with.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def upload(name: str, data: bytes) -> Any:
+            async with semaphore:
+                return await self.upload(name, data, params)
+
+        return await asyncio.gather(*(upload(name, data) for name, data in files), return_exceptions=True)
+
+
+class HealthMonitor:
+    """
+    Polls the readiness of the REST API from a background thread, so pages can read the last known state without
+    waiting for a request.
+
+    The API is polled every `interval` seconds while it is not ready, and every `ready_interval` seconds once it is.
+    """
+
+    def __init__(self, client: HaystackClient, interval: float = 2, ready_interval: float = 15, probe_timeout: float = 2):
+        self.client = client
+        self.interval = interval
+        self.ready_interval = ready_interval
+        self.probe_timeout = probe_timeout
+        self._ready = False
+        self.checked_at: Optional[float] = None
+        self.changed_at: Optional[float] = None
+        self._checked = threading.Event()
+        self._wake = threading.Event()
+        self._stopped = False
+        threading.Thread(target=self._poll, name="haystack-health", daemon=True).start()
+
+    def ready(self, wait: float = 0) -> bool:
+        """
+        Returns the last known readiness of the API. Before the first check finished, waits up to `wait` seconds for it.
+        """
+        if not self._checked.is_set() and wait:
+            self._checked.wait(wait)
+        return self._ready
+
+    def check_now(self):
+        """
+        Polls the API right away instead of at the next interval.
+        """
+        self._wake.set()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"ready": self._ready, "checked_at": self.checked_at, "changed_at": self.changed_at}
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+
+    def _poll(self):
+        while not self._stopped:
+            ready = self.client.is_ready(timeout=self.probe_timeout)
+            if ready != self._ready:
+                logger.info("Haystack is %s", "ready" if ready else "not ready")
+                self.changed_at = time.time()
+            self._ready = ready
+            self.checked_at = time.time()
+            self._checked.set()
+            self._wake.wait(self.ready_interval if ready else self.interval)
+            self._wake.clear()
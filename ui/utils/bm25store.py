@@ -0,0 +1,351 @@
+import copy
+import json
+import logging
+import os
+import re
+import threading
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+from haystack.document_stores import InMemoryDocumentStore
+from haystack.schema import Document
+
+from utils.vector_index import IVFInt8Index
+
+logger = logging.getLogger(__name__)
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercased word tokens, close to what the standard analyzer of Elasticsearch produces.
+    """
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class _Index:
+    """
+    Immutable BM25 index: postings in CSR layout, one row per document.
+    """
+
+    def __init__(self, vocab: Dict[str, int], doc_ids: List[str], doc_lengths: np.ndarray, indptr: np.ndarray,
+        rows: np.ndarray, frequencies: np.ndarray):
+        self.vocab = vocab
+        self.doc_ids = doc_ids
+        self.doc_lengths = doc_lengths
+        self.indptr = indptr
+        self.rows = rows
+        self.frequencies = frequencies
+        n = len(doc_ids)
+        document_frequencies = np.diff(indptr).astype(np.float32)
+        self.idf = np.log1p((n - document_frequencies + 0.5) / (document_frequencies + 0.5)).astype(np.float32)
+        self.average_length = float(doc_lengths.mean()) if n else 0.0
+
+    @classmethod
+    def build(cls, documents: List[Document]) -> "_Index":
+        vocab: Dict[str, int] = {}
+        term_ids, doc_rows, frequencies = [], [], []
+        doc_lengths = np.zeros(len(documents), dtype=np.float32)
+        for row, doc in enumerate(documents):
+            tokens = tokenize(doc.content if isinstance(doc.content, str) else "")
+            doc_lengths[row] = len(tokens)
+            for term, count in Counter(tokens).items():
+                term_ids.append(vocab.setdefault(term, len(vocab)))
+                doc_rows.append(row)
+                frequencies.append(count)
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        order = np.argsort(term_ids, kind="stable")
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=len(vocab)), out=indptr[1:])
+        return cls(
+            vocab,
+            [doc.id for doc in documents],
+            doc_lengths,
+            indptr,
+            np.asarray(doc_rows, dtype=np.int32)[order],
+            np.asarray(frequencies, dtype=np.float32)[order],
+        )
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        for name in ("doc_lengths", "indptr", "rows", "frequencies"):
+            tmp = os.path.join(path, f"{name}.tmp.npy")
+            np.save(tmp, getattr(self, name))
+            os.replace(tmp, os.path.join(path, f"{name}.npy"))
+        tmp = os.path.join(path, "terms.tmp.json")
+        with open(tmp, "w") as f:
+            json.dump({"vocab": self.vocab, "doc_ids": self.doc_ids}, f)
+        os.replace(tmp, os.path.join(path, "terms.json"))
+
+    @classmethod
+    def load(cls, path: str) -> "_Index":
+        with open(os.path.join(path, "terms.json")) as f:
+            terms = json.load(f)
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in ("doc_lengths", "indptr", "rows", "frequencies")}
+        return cls(terms["vocab"], terms["doc_ids"], **arrays)
+
+
+class NumpyBM25DocumentStore(InMemoryDocumentStore):
+    """
+    In-process document store with BM25 search, for corpora that do not need an Elasticsearch cluster.
+
+    Documents are kept by InMemoryDocumentStore. The BM25 index is an inverted index whose postings are numpy arrays
+    in CSR layout, saved to `path` and memory-mapped when the store is opened again, together with the documents.
+    The index is rebuilt when documents are written or deleted, which takes a fraction of a second for a few hundred
+    documents split into paragraphs.
+
+    Queries accept the same filters as the other document stores. Filters on `name` alone, as used when querying
+    listed documents, are answered from a precomputed mapping of names to documents.
+
+    With an `embedding_dim`, the store also keeps an IVFInt8Index of document embeddings for query_by_embedding,
+    filled by update_embeddings. Only the int8 codes are kept, the float embeddings are not stored on the documents.
+    """
+
+    def __init__(self, path: str = "bm25_index", index: str = "document", k1: float = 1.2, b: float = 0.75,
+        duplicate_documents: str = "overwrite", embedding_dim: Optional[int] = None, n_probe: int = 8, **kwargs):
+        """
+        :param path: Directory the documents and the index are saved to. The store is loaded from it if it exists.
+        :param index: Name of the index the documents are written to.
+        :param k1: BM25 term frequency saturation.
+        :param b: BM25 document length normalization.
+        :param embedding_dim: Dimension of the document embeddings. None disables the vector index.
+        :param n_probe: Number of clusters of the vector index scanned per query.
+        """
+        super().__init__(index=index, duplicate_documents=duplicate_documents, use_bm25=False,
+                         embedding_dim=embedding_dim or 768, similarity="cosine", **kwargs)
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self._write_lock = threading.Lock()
+        # The index, the documents in row order, the rows per name and the row per document id, swapped together when
+        # the index is rebuilt
+        self._snapshot: Tuple[Optional[_Index], List[Document], Dict[str, np.ndarray], Dict[str, int]] = (None, [], {}, {})
+        self._vectors = IVFInt8Index(embedding_dim, path=path, n_probe=n_probe) if embedding_dim else None
+        self._load()
+
+    def write_documents(self, documents: Union[List[dict], List[Document]], index: Optional[str] = None, **kwargs):
+        with self._write_lock:
+            super().write_documents(documents, index=index, **kwargs)
+            if (index or self.index) == self.index:
+                self._rebuild()
+
+    def delete_documents(self, index: Optional[str] = None, ids: Optional[List[str]] = None, filters: Optional[Dict[str, Any]] = None, headers: Optional[Dict[str, str]] = None):
+        with self._write_lock:
+            super().delete_documents(index=index, ids=ids, filters=filters, headers=headers)
+            if (index or self.index) == self.index:
+                self._rebuild()
+
+    def delete_index(self, index: str):
+        with self._write_lock:
+            super().delete_index(index)
+            if index == self.index:
+                self._rebuild()
+
+    def name_counts(self) -> Dict[str, int]:
+        """
+        Returns the number of paragraphs per document name.
+        """
+        return {name: len(rows) for name, rows in self._snapshot[2].items()}
+
+    def update_embeddings(self, retriever: Any, index: Optional[str] = None, update_existing_embeddings: bool = True,
+        filters: Optional[Dict[str, Any]] = None, batch_size: int = 32, headers: Optional[Dict[str, str]] = None):
+        """
+        Embeds the documents with the retriever, `batch_size` documents at a time, and rebuilds the vector index.
+
+        :param update_existing_embeddings: Whether to embed documents that are already in the vector index again.
+        """
+        if self._vectors is None:
+            raise ValueError("This NumpyBM25DocumentStore has no vector index, create it with an embedding_dim")
+        with self._write_lock:
+            documents = self._snapshot[1]
+            if filters:
+                allowed = {doc.id for doc in self.get_all_documents(index=self.index, filters=filters)}
+                documents = [doc for doc in documents if doc.id in allowed]
+            if not update_existing_embeddings:
+                documents = [doc for doc in documents if doc.id not in self._vectors]
+            if not documents:
+                return
+            vectors = self._vectors.clone()
+            for i in range(0, len(documents), batch_size):
+                batch = documents[i:i + batch_size]
+                vectors.add([doc.id for doc in batch], retriever.embed_documents(batch))
+            vectors.keep(list(self._snapshot[3]))
+            vectors.build()
+            self._vectors = vectors
+            logger.info("Embedded %s documents, the vector index holds %s", len(documents), len(vectors))
+
+    def query_by_embedding(self, query_emb: np.ndarray, filters: Optional[Dict[str, Any]] = None, top_k: int = 10,
+        index: Optional[str] = None, return_embedding: Optional[bool] = None, headers: Optional[Dict[str, str]] = None,
+        scale_score: bool = True) -> List[Document]:
+        """
+        Returns the top_k documents whose embeddings are closest to the query embedding, among the documents matching
+        filters. Filtered queries scan the matching documents exhaustively, the others search the IVF clusters.
+        """
+        if self._vectors is None:
+            raise ValueError("This NumpyBM25DocumentStore has no vector index, create it with an embedding_dim")
+        if index is not None and index != self.index:
+            raise ValueError(f"NumpyBM25DocumentStore only indexes '{self.index}', not '{index}'")
+        vectors = self._vectors
+        bm25, documents, rows_by_name, row_of = self._snapshot
+        rows = None
+        if filters:
+            mask = self._filter_mask(filters, len(documents), rows_by_name, row_of)
+            rows = [vectors.row(documents[row].id) for row in np.flatnonzero(mask)]
+            rows = np.asarray([row for row in rows if row is not None], dtype=np.int64)
+        results = []
+        for doc_id, score in vectors.search(query_emb, top_k, rows):
+            if doc_id not in row_of:
+                continue
+            doc = copy.copy(documents[row_of[doc_id]])
+            # Scaled the same way as cosine similarities in the other document stores
+            doc.score = (score + 1) / 2 if scale_score else score
+            results.append(doc)
+        return results
+
+    def query_by_embedding_batch(self, query_embs: Union[List[np.ndarray], np.ndarray],
+        filters: Optional[Union[Dict[str, Any], List[Optional[Dict[str, Any]]]]] = None, top_k: int = 10,
+        index: Optional[str] = None, return_embedding: Optional[bool] = None, headers: Optional[Dict[str, str]] = None,
+        scale_score: bool = True) -> List[List[Document]]:
+        if filters is None or isinstance(filters, dict):
+            filters = [filters] * len(query_embs)
+        return [
+            self.query_by_embedding(query_emb, filters=f, top_k=top_k, index=index, scale_score=scale_score)
+            for query_emb, f in zip(query_embs, filters)
+        ]
+
+    def catalog(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Returns the number of paragraphs and the latest upload time per document name, like elasticsearch_catalog.
+        """
+        _, documents, rows_by_name, _ = self._snapshot
+        catalog = {}
+        for name, rows in rows_by_name.items():
+            uploaded = [documents[row].meta.get("uploaded_at") for row in rows]
+            uploaded = [u for u in uploaded if u is not None]
+            catalog[name] = {"chunks": len(rows), "uploaded_at": max(uploaded) if uploaded else None}
+        return catalog
+
+    def query(self, query: Optional[str], filters: Optional[Dict[str, Any]] = None, top_k: int = 10,
+        custom_query: Optional[str] = None, index: Optional[str] = None, headers: Optional[Dict[str, str]] = None,
+        all_terms_must_match: bool = False, scale_score: bool = True) -> List[Document]:
+        """
+        Returns the top_k documents with the highest BM25 scores for the query, among the documents matching filters.
+        """
+        if index is not None and index != self.index:
+            raise ValueError(f"NumpyBM25DocumentStore only indexes '{self.index}', not '{index}'")
+        if custom_query is not None:
+            logger.warning("NumpyBM25DocumentStore does not support custom queries, ignoring it")
+        bm25, documents, rows_by_name, row_of = self._snapshot
+        if bm25 is None or not documents or not query:
+            return []
+
+        term_ids = [bm25.vocab[t] for t in set(tokenize(query)) if t in bm25.vocab]
+        scores = np.zeros(len(documents), dtype=np.float32)
+        matched = np.zeros(len(documents), dtype=np.int32)
+        norm = self.k1 * (1 - self.b + self.b * bm25.doc_lengths / max(bm25.average_length, 1e-9))
+        for t in term_ids:
+            start, end = bm25.indptr[t], bm25.indptr[t + 1]
+            rows = bm25.rows[start:end]
+            tf = bm25.frequencies[start:end]
+            # A term occurs once in the postings of a document, so the rows are unique
+            scores[rows] += bm25.idf[t] * tf * (self.k1 + 1) / (tf + norm[rows])
+            matched[rows] += 1
+
+        candidates = matched >= (len(term_ids) if all_terms_must_match else 1)
+        if all_terms_must_match and len(term_ids) < len(set(tokenize(query))):
+            candidates[:] = False
+        if filters:
+            candidates &= self._filter_mask(filters, len(documents), rows_by_name, row_of)
+
+        rows = np.flatnonzero(candidates)
+        if len(rows) > top_k:
+            rows = rows[np.argpartition(-scores[rows], top_k - 1)[:top_k]]
+        rows = rows[np.argsort(-scores[rows], kind="stable")]
+
+        results = []
+        for row in rows:
+            doc = copy.copy(documents[row])
+            score = float(scores[row])
+            # Scaled the same way as the BM25 scores of ElasticsearchDocumentStore
+            doc.score = float(1 / (1 + np.exp(-score / 8))) if scale_score else score
+            results.append(doc)
+        return results
+
+    def query_batch(self, queries: List[str], filters: Optional[Union[Dict[str, Any], List[Optional[Dict[str, Any]]]]] = None,
+        top_k: int = 10, custom_query: Optional[str] = None, index: Optional[str] = None,
+        headers: Optional[Dict[str, str]] = None, all_terms_must_match: bool = False, scale_score: bool = True) -> List[List[Document]]:
+        if filters is None or isinstance(filters, dict):
+            filters = [filters] * len(queries)
+        if len(filters) != len(queries):
+            raise ValueError("Number of filters does not match number of queries")
+        return [
+            self.query(query, filters=f, top_k=top_k, custom_query=custom_query, index=index, headers=headers,
+                       all_terms_must_match=all_terms_must_match, scale_score=scale_score)
+            for query, f in zip(queries, filters)
+        ]
+
+    def _filter_mask(self, filters: Dict[str, Any], size: int, rows_by_name: Dict[str, np.ndarray], row_of: Dict[str, int]) -> np.ndarray:
+        mask = np.zeros(size, dtype=bool)
+        names = filters.get("name") if list(filters) == ["name"] else None
+        if isinstance(names, str):
+            names = [names]
+        if isinstance(names, list) and all(isinstance(n, str) for n in names):
+            for name in names:
+                mask[rows_by_name.get(name, [])] = True
+            return mask
+        for doc in self.get_all_documents(index=self.index, filters=filters):
+            if doc.id in row_of:
+                mask[row_of[doc.id]] = True
+        return mask
+
+    def _rebuild(self):
+        documents = self.get_all_documents(index=self.index)
+        bm25 = _Index.build(documents)
+        self._swap(bm25, documents)
+        self._save(bm25, documents)
+        if self._vectors is not None:
+            # Drop the vectors of deleted documents
+            vectors = self._vectors.clone()
+            if vectors.keep([doc.id for doc in documents]):
+                vectors.build()
+                self._vectors = vectors
+
+    def _swap(self, bm25: _Index, documents: List[Document]):
+        names: Dict[str, List[int]] = {}
+        for row, doc in enumerate(documents):
+            names.setdefault(doc.meta.get("name", ""), []).append(row)
+        # Queries read the snapshot without a lock, a query running during a swap gets the old or the new one
+        self._snapshot = (
+            bm25,
+            documents,
+            {name: np.asarray(rows, dtype=np.int64) for name, rows in names.items()},
+            {doc.id: row for row, doc in enumerate(documents)},
+        )
+
+    def _save(self, bm25: _Index, documents: List[Document]):
+        bm25.save(self.path)
+        tmp = os.path.join(self.path, "documents.tmp.jsonl")
+        with open(tmp, "w") as f:
+            for doc in documents:
+                f.write(json.dumps(doc.to_dict(), default=str) + "\n")
+        os.replace(tmp, os.path.join(self.path, "documents.jsonl"))
+
+    def _load(self):
+        documents_path = os.path.join(self.path, "documents.jsonl")
+        if not os.path.exists(documents_path):
+            return
+        with open(documents_path) as f:
+            documents = [Document.from_dict(json.loads(line)) for line in f if line.strip()]
+        super().write_documents(documents, index=self.index)
+        try:
+            bm25 = _Index.load(self.path)
+        except (OSError, ValueError) as e:
+            logger.warning("Could not load the BM25 index from %s, rebuilding it: %s", self.path, e)
+            bm25 = None
+        if bm25 is None or bm25.doc_ids != [doc.id for doc in documents]:
+            self._rebuild()
+        else:
+            self._swap(bm25, documents)
+        logger.info("Loaded %s documents from %s", len(documents), self.path)
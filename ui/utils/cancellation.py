@@ -0,0 +1,183 @@
+import asyncio
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Optional
+
+
+class GenerationCancelled(Exception):
+    """
+    Raised inside a request whose cancellation token was cancelled, typically because the user changed the question.
+    """
+
+
+class CancellationToken:
+    """
+    Flag shared by everything working on one request. The generation loops check it between decode steps, so a
+    cancelled request stops within one token.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._callbacks: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def on_cancel(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """
+        Registers a callback that is called once when the token is cancelled, right away if it already is. Returns a
+        function that unregisters it.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._remove(callback)
+        callback()
+        return lambda: None
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise GenerationCancelled("The request was cancelled")
+
+    def _remove(self, callback: Callable[[], None]):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+
+_local = threading.local()
+
+
+def current() -> Optional[CancellationToken]:
+    """
+    The cancellation token that is active in this thread, if any.
+    """
+    return getattr(_local, "token", None)
+
+
+@contextmanager
+def activate(token: Optional[CancellationToken]) -> Iterator[Optional[CancellationToken]]:
+    """
+    Makes `token` the active cancellation token of this thread for the duration of the block.
+    """
+    previous = current()
+    _local.token = token
+    try:
+        yield token
+    finally:
+        _local.token = previous
+
+
+def raise_if_cancelled():
+    """
+    Raises GenerationCancelled if the active token of this thread is cancelled. Without an active token, does nothing.
+    """
+    token = current()
+    if token is not None:
+        token.raise_if_cancelled()
+
+
+def wait(event: threading.Event, poll_interval: float = 0.1):
+    """
+    Waits for an event, raising GenerationCancelled as soon as the active token of this thread is cancelled.
+    """
+    token = current()
+    if token is None:
+        event.wait()
+        return
+    while not event.wait(poll_interval):
+        token.raise_if_cancelled()
+
+
+@contextmanager
+def acquire(lock: Any, poll_interval: float = 0.1) -> Iterator[None]:
+    """
+    Holds a lock for the duration of the block. Waiting for it raises GenerationCancelled as soon as the active token
+    of this thread is cancelled, so a cancelled request does not queue up behind the one holding the lock.
+    """
+    token = current()
+    if token is None:
+        lock.acquire()
+    else:
+        while not lock.acquire(timeout=poll_interval):
+            token.raise_if_cancelled()
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+class RunRegistry:
+    """
+    Keeps the cancellation token of the request running for every key, such as a browser session. Beginning a new
+    request for a key cancels the one it supersedes.
+    """
+
+    def __init__(self):
+        self._tokens: Dict[Hashable, CancellationToken] = {}
+        self._lock = threading.Lock()
+
+    def begin(self, key: Hashable) -> CancellationToken:
+        token = CancellationToken()
+        with self._lock:
+            previous = self._tokens.get(key)
+            self._tokens[key] = token
+        if previous is not None:
+            previous.cancel()
+        return token
+
+    def cancel(self, key: Hashable) -> bool:
+        """
+        Cancels the running request of a key. Returns whether there was one.
+        """
+        with self._lock:
+            token = self._tokens.pop(key, None)
+        if token is None:
+            return False
+        token.cancel()
+        return True
+
+    def finish(self, key: Hashable, token: CancellationToken):
+        with self._lock:
+            if self._tokens.get(key) is token:
+                del self._tokens[key]
+
+
+async def run_cancellable(fn: Callable[..., Any], *args: Any, token: CancellationToken,
+    heartbeat: Optional[Callable[[], None]] = None, poll_interval: float = 0.1, **kwargs: Any) -> Any:
+    """
+    Runs a blocking function in a thread with `token` active, and cancels the token as soon as the awaiting side goes
+    away: when the task is cancelled, or when `heartbeat` - called every `poll_interval` seconds while waiting - raises.
+
+    Streamlit stops a script for a rerun by raising from the next Streamlit call in the script thread, so a heartbeat
+    that renders something turns a rerun into a cancellation.
+    """
+
+    def run() -> Any:
+        with activate(token):
+            return fn(*args, **kwargs)
+
+    future = asyncio.get_running_loop().run_in_executor(None, run)
+    # The result of a cancelled request is never awaited, retrieve it so asyncio does not log it as lost
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    try:
+        while True:
+            done, _ = await asyncio.wait({future}, timeout=poll_interval)
+            if done:
+                return future.result()
+            if heartbeat is not None:
+                heartbeat()
+    except BaseException:
+        token.cancel()
+        raise
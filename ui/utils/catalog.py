@@ -0,0 +1,92 @@
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Metadata of a document: the number of paragraphs it was split into, and when it was uploaded (seconds since the epoch)
+DocumentInfo = Dict[str, Any]
+
+
+class DocumentCatalog:
+    """
+    Names and metadata of the documents in a document store, cached for `ttl` seconds.
+
+    Every page render asks for the list of documents, while it only changes when a document is uploaded. The catalog
+    fetches it once, serves it from memory until the TTL expires or `invalidate` is called, and lets one caller refresh
+    it while the others wait for the result.
+    """
+
+    def __init__(self, fetch: Callable[[], Dict[str, DocumentInfo]], ttl: float = 300):
+        """
+        :param fetch: Function returning a dictionary of document names and their metadata.
+        :param ttl: Seconds before the catalog is fetched again.
+        """
+        self.fetch = fetch
+        self.ttl = ttl
+        self._entries: Optional[Dict[str, DocumentInfo]] = None
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+        self.refreshes = 0
+        self.hits = 0
+
+    def metadata(self) -> Dict[str, DocumentInfo]:
+        """
+        Returns a dictionary of document names and their metadata.
+        """
+        with self._lock:
+            if self._entries is None or time.monotonic() - self._fetched_at > self.ttl:
+                start = time.perf_counter()
+                self._entries = self.fetch()
+                self._fetched_at = time.monotonic()
+                self.refreshes += 1
+                logger.info("Fetched %s documents for the catalog in %.2fs", len(self._entries), time.perf_counter() - start)
+            else:
+                self.hits += 1
+            return self._entries
+
+    def names(self) -> List[str]:
+        return sorted(self.metadata())
+
+    def invalidate(self):
+        """
+        Drops the cached catalog, so the next call fetches it again. Called when a document is uploaded.
+        """
+        with self._lock:
+            self._entries = None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "documents": len(self._entries) if self._entries is not None else None,
+                "age": time.monotonic() - self._fetched_at if self._entries is not None else None,
+                "refreshes": self.refreshes,
+                "hits": self.hits,
+            }
+
+
+def elasticsearch_catalog(client: Any, index: str = "document", page_size: int = 1000) -> Dict[str, DocumentInfo]:
+    """
+    Fetches the names of all documents in an Elasticsearch index, with their number of paragraphs and latest upload
+    time, paging through them with a composite aggregation. A terms aggregation would cut off at its size.
+    """
+    documents: Dict[str, DocumentInfo] = {}
+    after = None
+    while True:
+        composite: Dict[str, Any] = {"size": page_size, "sources": [{"name": {"terms": {"field": "name"}}}]}
+        if after is not None:
+            composite["after"] = after
+        body = {
+            "size": 0,
+            "aggs": {"docs": {"composite": composite, "aggs": {"uploaded_at": {"max": {"field": "uploaded_at"}}}}},
+        }
+        result = client.search(index=index, body=body)["aggregations"]["docs"]
+        for bucket in result["buckets"]:
+            documents[bucket["key"]["name"]] = {
+                "chunks": bucket["doc_count"],
+                "uploaded_at": bucket.get("uploaded_at", {}).get("value"),
+            }
+        after = result.get("after_key")
+        if after is None or len(result["buckets"]) < page_size:
+            return documents
@@ -0,0 +1,65 @@
+from typing import Any, Dict, List, Optional, Union
+
+from haystack.nodes import BaseRetriever
+from haystack.schema import Document
+
+FilterType = Optional[Union[Dict[str, Any], List[Optional[Dict[str, Any]]]]]
+
+
+def reciprocal_rank_fusion(rankings: List[List[Document]], top_k: int, k: int = 60) -> List[Document]:
+    """
+    Merges rankings of documents by reciprocal rank fusion: a document scores the sum of 1 / (k + rank) over the
+    rankings it appears in. Only ranks count, so the scores of BM25 and of the embeddings do not need to be comparable.
+
+    :return: The top_k documents, with their fused score as score.
+    """
+    scores: Dict[str, float] = {}
+    documents: Dict[str, Document] = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, start=1):
+            scores[doc.id] = scores.get(doc.id, 0.0) + 1 / (k + rank)
+            documents.setdefault(doc.id, doc)
+    fused = []
+    for doc_id in sorted(scores, key=scores.get, reverse=True)[:top_k]:
+        doc = documents[doc_id]
+        doc.score = scores[doc_id]
+        fused.append(doc)
+    return fused
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Retriever combining a keyword retriever and an embedding retriever. Each fetches `candidates` documents, and the
+    two rankings are merged with reciprocal rank fusion.
+    """
+
+    def __init__(self, keyword_retriever: BaseRetriever, embedding_retriever: BaseRetriever, top_k: int = 5,
+        candidates: int = 20, rrf_k: int = 60):
+        """
+        :param keyword_retriever: Retriever ranking by keywords, such as a BM25Retriever.
+        :param embedding_retriever: Retriever ranking by embeddings, such as an EmbeddingRetriever.
+        :param top_k: Number of documents returned.
+        :param candidates: Number of documents fetched from each retriever before they are merged.
+        :param rrf_k: Constant of reciprocal rank fusion, dampening the weight of the top ranks.
+        """
+        super().__init__()
+        self.keyword_retriever = keyword_retriever
+        self.embedding_retriever = embedding_retriever
+        self.top_k = top_k
+        self.candidates = candidates
+        self.rrf_k = rrf_k
+
+    def retrieve(self, query: str, filters: Optional[Dict[str, Any]] = None, top_k: Optional[int] = None,
+        index: Optional[str] = None, headers: Optional[Dict[str, str]] = None, scale_score: Optional[bool] = None,
+        document_store: Any = None) -> List[Document]:
+        return self.retrieve_batch([query], filters=[filters], top_k=top_k, index=index, headers=headers)[0]
+
+    def retrieve_batch(self, queries: List[str], filters: FilterType = None, top_k: Optional[int] = None,
+        index: Optional[str] = None, headers: Optional[Dict[str, str]] = None, batch_size: Optional[int] = None,
+        scale_score: Optional[bool] = None, document_store: Any = None) -> List[List[Document]]:
+        candidates = max(self.candidates, top_k or self.top_k)
+        keyword = self.keyword_retriever.retrieve_batch(queries=queries, filters=filters, top_k=candidates, index=index, headers=headers)
+        embedding = self.embedding_retriever.retrieve_batch(queries=queries, filters=filters, top_k=candidates, index=index, headers=headers)
+        return [
+            reciprocal_rank_fusion([k, e], top_k or self.top_k, self.rrf_k) for k, e in zip(keyword, embedding)
+        ]
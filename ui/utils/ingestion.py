@@ -0,0 +1,181 @@
+import hashlib
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class IngestionQueue:
+    """
+    Background queue that indexes uploaded files, a pool of worker threads at a time.
+
+    Files are identified by their name and the hash of their content. Submitting a file that was already indexed, or
+    that is already waiting or being indexed, returns the existing job instead of indexing it again, so reruns of the
+    page do not upload the same files over and over.
+
+    Jobs and their status are stored in SQLite, and the content of every file is spooled to disk until it is indexed.
+    Jobs that were queued or running when the process stopped are picked up again when the queue is created.
+    """
+
+    def __init__(self, path: str, upload: Callable[[str, bytes], Any], workers: int = 4,
+        on_done: Optional[Callable[[str, str], None]] = None):
+        """
+        :param path: Directory of the job database and the spooled files.
+        :param upload: Function indexing a file, called with its name and content.
+        :param workers: Number of files indexed at the same time.
+        :param on_done: Called with the name and content hash of every file that was indexed.
+        """
+        self.path = path
+        self.upload = upload
+        self.on_done = on_done
+        self._spool = os.path.join(path, "spool")
+        os.makedirs(self._spool, exist_ok=True)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(os.path.join(path, "jobs.db"), check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (name TEXT, content_hash TEXT, status TEXT, error TEXT, size INTEGER, "
+                "created REAL, updated REAL, PRIMARY KEY (name, content_hash))"
+            )
+        self._queue: "queue.Queue[Tuple[str, str]]" = queue.Queue()
+        self._resume()
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f"ingestion-{i}", daemon=True).start()
+
+    def submit(self, name: str, data: bytes) -> Dict[str, Any]:
+        """
+        Queues a file for indexing, unless the same content was already indexed or queued under the same name.
+
+        :return: The job of the file.
+        """
+        content_hash = hashlib.sha256(data).hexdigest()
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT status FROM jobs WHERE name = ? AND content_hash = ?", (name, content_hash)
+            ).fetchone()
+            if row is not None and row[0] != FAILED:
+                return self._job(name, content_hash)
+            with open(self._spool_path(content_hash), "wb") as f:
+                f.write(data)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, NULL, ?, ?, ?)", (name, content_hash, QUEUED, len(data), now, now)
+            )
+        self._queue.put((name, content_hash))
+        return self._job(name, content_hash)
+
+    def submit_many(self, files: Iterable[Tuple[str, bytes]]) -> List[Dict[str, Any]]:
+        return [self.submit(name, data) for name, data in files]
+
+    def jobs(self, keys: Optional[Iterable[Tuple[str, str]]] = None) -> List[Dict[str, Any]]:
+        """
+        Returns the jobs with the given (name, content hash) keys, or all jobs, most recent first.
+        """
+        if keys is not None:
+            return [self._job(name, content_hash) for name, content_hash in keys]
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT name, content_hash FROM jobs ORDER BY updated DESC"
+            ).fetchall()
+        return [self._job(name, content_hash) for name, content_hash in rows]
+
+    def retry_failed(self) -> int:
+        """
+        Queues the failed jobs again. Returns the number of jobs queued.
+        """
+        with self._lock, self._conn:
+            rows = self._conn.execute("SELECT name, content_hash FROM jobs WHERE status = ?", (FAILED,)).fetchall()
+            rows = [r for r in rows if os.path.exists(self._spool_path(r[1]))]
+            self._conn.executemany(
+                "UPDATE jobs SET status = ?, error = NULL, updated = ? WHERE name = ? AND content_hash = ?",
+                [(QUEUED, time.time(), name, content_hash) for name, content_hash in rows],
+            )
+        for row in rows:
+            self._queue.put(tuple(row))
+        return len(rows)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            counts = dict(self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        return {status: counts.get(status, 0) for status in (QUEUED, RUNNING, DONE, FAILED)}
+
+    def _job(self, name: str, content_hash: str) -> Dict[str, Any]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT status, error, size, created, updated FROM jobs WHERE name = ? AND content_hash = ?", (name, content_hash)
+            ).fetchone()
+        if row is None:
+            return {"name": name, "content_hash": content_hash, "status": None}
+        status, error, size, created, updated = row
+        return {"name": name, "content_hash": content_hash, "status": status, "error": error, "size": size,
+                "created": created, "updated": updated}
+
+    def _set_status(self, name: str, content_hash: str, status: str, error: Optional[str] = None):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated = ? WHERE name = ? AND content_hash = ?",
+                (status, error, time.time(), name, content_hash),
+            )
+
+    def _spool_path(self, content_hash: str) -> str:
+        return os.path.join(self._spool, content_hash)
+
+    def _resume(self):
+        with self._lock, self._conn:
+            rows = self._conn.execute(
+                "SELECT name, content_hash FROM jobs WHERE status IN (?, ?) ORDER BY created", (QUEUED, RUNNING)
+            ).fetchall()
+            self._conn.execute("UPDATE jobs SET status = ? WHERE status = ?", (QUEUED, RUNNING))
+        if rows:
+            logger.info("Resuming %s unfinished ingestion jobs", len(rows))
+        for row in rows:
+            self._queue.put(tuple(row))
+
+    def _work(self):
+        while True:
+            name, content_hash = self._queue.get()
+            try:
+                with open(self._spool_path(content_hash), "rb") as f:
+                    data = f.read()
+            except OSError as e:
+                self._set_status(name, content_hash, FAILED, f"The spooled file is gone: {e}")
+                continue
+            self._set_status(name, content_hash, RUNNING)
+            start = time.perf_counter()
+            try:
+                self.upload(name, data)
+            except Exception as e:
+                logger.exception(e)
+                self._set_status(name, content_hash, FAILED, str(e))
+                continue
+            self._set_status(name, content_hash, DONE)
+            logger.info("Indexed %s in %.1fs", name, time.perf_counter() - start)
+            self._remove_spool(content_hash)
+            if self.on_done is not None:
+                try:
+                    self.on_done(name, content_hash)
+                except Exception as e:
+                    logger.exception(e)
+
+    def _remove_spool(self, content_hash: str):
+        # The same content can be queued under another name, keep it until that job is done too
+        with self._lock:
+            pending = self._conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE content_hash = ? AND status IN (?, ?, ?)",
+                (content_hash, QUEUED, RUNNING, FAILED),
+            ).fetchone()[0]
+            if not pending:
+                try:
+                    os.remove(self._spool_path(content_hash))
+                except OSError:
+                    pass
@@ -1,12 +1,168 @@
 from haystack.nodes import PromptModelInvocationLayer
+from haystack.nodes.prompt.invocation_layer import DefaultTokenStreamingHandler, TokenStreamingHandler
+import codecs
+import llama_cpp
 from llama_cpp import Llama
+import numpy as np
 import os
-from typing import Dict, List, Union, Type, Optional
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Union, Type, Optional, Sequence, Tuple
 
 import logging 
 
+from utils import cancellation, tracing
+from utils.packing import TokenCounter
+
 logger = logging.getLogger(__name__)
 
+
+def _common_prefix_length(a: Sequence[int], b: Sequence[int]) -> int:
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def _logits(model: Llama, rows: int = 1) -> np.ndarray:
+    """
+    Returns the logits of the last evaluation. A model with logits_all has one row per token of that evaluation,
+    otherwise there is only the row of its last token.
+    """
+    return np.ctypeslib.as_array(llama_cpp.llama_get_logits(model.ctx), shape=(rows, model.n_vocab()))
+
+
+def _rewind(model: Llama, n_past: int) -> int:
+    """
+    Drops the evaluated tokens after the first n_past, so the next evaluation continues from there. Returns the number
+    of tokens that are kept.
+    """
+    if n_past > 0 and hasattr(model, "n_tokens"):
+        model.n_tokens = n_past
+        return n_past
+    model.reset()
+    return 0
+
+
+def _greedy_token(logits: np.ndarray, recent: Sequence[int], repeat_penalty: float) -> int:
+    """
+    Picks the token Llama.generate picks at temperature 0: the highest logit after the repetition penalty of llama.cpp,
+    which divides positive logits of recent tokens by the penalty and multiplies the others.
+    """
+    if repeat_penalty != 1.0 and len(recent):
+        ids = np.unique(np.asarray(recent, dtype=np.int64))
+        penalized = logits[ids]
+        logits = logits.copy()
+        logits[ids] = np.where(penalized > 0, penalized / repeat_penalty, penalized * repeat_penalty)
+    return int(np.argmax(logits))
+
+
+class SpeculationStats:
+    """
+    Counts of the tokens a draft model proposed and the main model accepted during speculative decoding.
+    """
+
+    def __init__(self):
+        self.rounds = 0
+        self.drafted = 0
+        self.accepted = 0
+
+    def add(self, rounds: int, drafted: int, accepted: int):
+        self.rounds += rounds
+        self.drafted += drafted
+        self.accepted += accepted
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted / self.drafted if self.drafted else 0.0
+
+    def to_dict(self) -> Dict[str, float]:
+        return {
+            "rounds": self.rounds,
+            "drafted": self.drafted,
+            "accepted": self.accepted,
+            "acceptance_rate": self.acceptance_rate,
+            # Every round is one evaluation of the main model, and yields the accepted tokens plus one of its own
+            "tokens_per_round": (self.accepted + self.rounds) / self.rounds if self.rounds else 0.0,
+        }
+
+
+def _state_size(state: Any) -> int:
+    """
+    Estimates the memory a saved llama state takes: its copy of the KV cache, plus the logits it keeps as Python
+    floats - one row per evaluated token with logits_all - at about 32 bytes per logit.
+    """
+    logits = getattr(state, "eval_logits", None) or ()
+    return getattr(state, "llama_state_size", 0) + 32 * sum(len(row) for row in logits)
+
+
+class LlamaStateCache:
+    """
+    Bounded cache of evaluated llama states, keyed by the tokens that were evaluated to reach them.
+
+    Looking up a prompt returns the state that shares the longest token prefix with it, so a prompt that starts with
+    the same template header or the same paragraphs as an earlier one only has to prefill the tokens after that prefix.
+    States are evicted least recently used first, when there are more than `slots` of them or they take more than
+    `max_bytes` together.
+    """
+
+    def __init__(self, slots: int = 1, max_bytes: Optional[int] = 2**30):
+        """
+        :param slots: Maximum number of states to keep.
+        :param max_bytes: Maximum total size of the states, see _state_size. A state holds the KV cache of the
+        evaluated tokens, about 0.5 MB per token for a 7B model with an f16 KV cache, so a 4k-token prompt takes 2 GB.
+        A state larger than this is not kept at all. None means no limit.
+        """
+        self.slots = slots
+        self.max_bytes = max_bytes
+        self._states: "OrderedDict[Tuple[int, ...], Tuple[Any, int]]" = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def longest_prefix(self, tokens: Sequence[int], count: bool = True) -> Tuple[Optional[Tuple[int, ...]], int]:
+        """
+        Returns the key of the cached state sharing the longest prefix with `tokens`, and the length of that prefix.
+
+        :param count: Whether to count the lookup as a hit or miss.
+        """
+        best_key, best_length = None, 0
+        for key in self._states:
+            length = _common_prefix_length(key, tokens)
+            if length > best_length:
+                best_key, best_length = key, length
+        if count:
+            if best_key is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return best_key, best_length
+
+    def get(self, key: Tuple[int, ...]) -> Any:
+        self._states.move_to_end(key)
+        return self._states[key][0]
+
+    def put(self, key: Tuple[int, ...], state: Any):
+        size = _state_size(state)
+        if self.max_bytes is not None and size > self.max_bytes:
+            logger.debug("Not caching a state of %.1f MB, over the limit of %.1f MB", size / 2**20, self.max_bytes / 2**20)
+            return
+        if key in self._states:
+            self.bytes -= self._states.pop(key)[1]
+        self._states[key] = (state, size)
+        self.bytes += size
+        while len(self._states) > self.slots or (self.max_bytes is not None and self.bytes > self.max_bytes):
+            self.bytes -= self._states.popitem(last=False)[1][1]
+
+    def __contains__(self, key: Tuple[int, ...]) -> bool:
+        return key in self._states
+
+    def __len__(self) -> int:
+        return len(self._states)
+
 class LlamaCPPInvocationLayer(PromptModelInvocationLayer):
     def __init__(self, model_name_or_path: Union[str,os.PathLike],
         max_length: Optional[int] = 128,
@@ -25,12 +181,22 @@ class LlamaCPPInvocationLayer(PromptModelInvocationLayer):
         lora_base: Optional[str] = None,
         lora_path: Optional[str] = None,
         verbose: Optional[bool] = True,
+        prefix_cache_slots: Optional[int] = 1,
+        prefix_cache_bytes: Optional[int] = 2**30,
+        draft_model_path: Optional[str] = None,
+        speculative_tokens: Optional[int] = 4,
         **kwargs):
 
         """
         Creates a new Llama CPP InvocationLayer instance.
 
         :param model_name_or_path: The name or path of the underlying model.
+        :param prefix_cache_slots: Number of evaluated prompt states to keep for prefix reuse. Set to 0 to disable.
+        :param prefix_cache_bytes: Maximum total size in bytes of the kept states. None means no limit.
+        :param draft_model_path: Path of a small GGML model with the same tokenizer, to decode with speculative decoding.
+        The model then decodes greedily unless a temperature is passed, and keeps the logits of every evaluated token,
+        which takes max_context * vocabulary size floats.
+        :param speculative_tokens: Number of tokens the draft model proposes per evaluation of the model.
         :param kwargs: See `https://abetlen.github.io/llama-cpp-python/#llama_cpp.llama.Llama.__init__`. For max_length, we use the 128 'max_tokens' setting.
         """
         if model_name_or_path is None or len(model_name_or_path) == 0:
@@ -58,7 +224,8 @@ class LlamaCPPInvocationLayer(PromptModelInvocationLayer):
             n_parts = n_parts,
             seed = seed,
             f16_kv = f16_kv,
-            logits_all = logits_all,
+            # Verifying drafted tokens needs the logits of every token of the batch
+            logits_all = logits_all or draft_model_path is not None,
             vocab_only = vocab_only,
             use_mmap = use_mmap,
             use_mlock = use_mlock,
@@ -69,7 +236,42 @@ class LlamaCPPInvocationLayer(PromptModelInvocationLayer):
             lora_base = lora_base,
             lora_path = lora_path,
             verbose = verbose)
-    
+        self.draft_model_path = draft_model_path
+        self.speculative_tokens = speculative_tokens
+        self.draft: Optional[Llama] = None
+        if draft_model_path:
+            self.draft = Llama(model_path = draft_model_path,
+                n_ctx = max_context,
+                seed = seed,
+                f16_kv = f16_kv,
+                use_mmap = use_mmap,
+                use_mlock = use_mlock,
+                n_threads = n_threads,
+                n_batch = n_batch,
+                verbose = verbose)
+        self.speculation = SpeculationStats()
+        # Tokens evaluated in the context of the draft model
+        self._draft_live: Sequence[int] = ()
+        # The model registry shares one instance between all sessions, and a llama context can only run one evaluation at a time
+        self._lock = threading.Lock()
+        self.prefix_cache = LlamaStateCache(prefix_cache_slots, prefix_cache_bytes) if prefix_cache_slots else None
+        # Tokens at the start of the state that is currently loaded in the llama context
+        self._live_tokens: Tuple[int, ...] = ()
+        # Token arrays of the prompts that passed _ensure_token_limit, so invoke does not tokenize them again
+        self._prompt_tokens: "OrderedDict[str, Tuple[int, ...]]" = OrderedDict()
+        self._prompt_tokens_lock = threading.Lock()
+        # Token arrays of retrieved paragraphs, by content hash
+        self.count_tokens = TokenCounter(lambda text: self.model.tokenize(text.encode("utf-8"), add_bos=False))
+
+    def context_length(self) -> int:
+        return self.model.n_ctx()
+
+    def count_prompt_tokens(self, prompt: str) -> int:
+        """
+        Number of tokens of a prompt as _ensure_token_limit counts them, including the BOS token and the leading space.
+        """
+        return len(self._tokenize(prompt))
+
 
     def _ensure_token_limit(self, prompt: Union[str, List[Dict[str, str]]]) -> Union[str, List[Dict[str, str]]]:
         """Ensure that length of the prompt and answer is within the maximum token length of the PromptModel.
@@ -80,7 +282,9 @@ class LlamaCPPInvocationLayer(PromptModelInvocationLayer):
             raise ValueError(f"Prompt must be of type str but got {type(prompt)}")
         
         context_length = self.model.n_ctx()
-        tokenized_prompt = self.model.tokenize(bytes(prompt,'utf-8'))
+        with tracing.stage("tokenize") as record:
+            tokenized_prompt = self._tokenize(prompt)
+            record["tokens"] = len(tokenized_prompt)
         if len(tokenized_prompt) + self.max_length > context_length:
             logger.warning(
             "The prompt has been truncated from %s tokens to %s tokens so that the prompt length and "
@@ -91,17 +295,27 @@ class LlamaCPPInvocationLayer(PromptModelInvocationLayer):
             self.max_length,
             context_length,
             )
-            return self.model.detokenize(tokenized_prompt[:max(0, context_length -  self.max_length)])
+            tokenized_prompt = tokenized_prompt[:max(0, context_length -  self.max_length)]
+            # Drop the BOS token and the space _tokenize put in front, so the prompt tokenizes back to the same tokens
+            prompt = self.model.detokenize(tokenized_prompt[1:]).decode("utf-8", errors="ignore")
+            prompt = prompt[1:] if prompt.startswith(" ") else prompt
 
+        self._remember_tokens(prompt, tokenized_prompt)
         return prompt
 
     def invoke(self, *args, **kwargs):
         """
         It takes a prompt and returns a list of generated text using the underlying model.
+
+        With `stream=True`, every token is passed to the `stream_handler` (a Haystack TokenStreamingHandler) as soon as
+        it is decoded, so callers can render the answer while it is being generated.
         :return: A list of generated text.
         """
         output: List[Dict[str, str]] = []
         stream = kwargs.pop("stream",False)
+        stream_handler: Optional[TokenStreamingHandler] = kwargs.pop("stream_handler", None)
+        if stream and stream_handler is None:
+            stream_handler = DefaultTokenStreamingHandler()
 
         generated_texts = []
         
@@ -124,14 +338,255 @@ class LlamaCPPInvocationLayer(PromptModelInvocationLayer):
                 if key in kwargs
             }
             
-        if stream:
-            for token in self.model(prompt,stream=True,**model_input_kwargs):
-                generated_texts.append(token['choices'][0]['text'])
-        else:
-            output = self.model(prompt,**model_input_kwargs)
-            generated_texts = [o['text'] for o in output['choices']]
+        tokens = self._tokens_for(prompt)
+        with cancellation.acquire(self._lock):
+            cancellation.raise_if_cancelled()
+            self._restore_prefix(tokens)
+            try:
+                if set(model_input_kwargs) - {"max_tokens", "temperature", "top_p", "top_k", "repeat_penalty"}:
+                    # suffix, logprobs and echo are only supported by Llama.__call__, which does not tell prefill and decode apart
+                    with tracing.stage("generate"):
+                        if stream:
+                            tokens_received = []
+                            for token in self.model(prompt,stream=True,**model_input_kwargs):
+                                cancellation.raise_if_cancelled()
+                                tokens_received.append(stream_handler(token['choices'][0]['text']))
+                            generated_texts = ["".join(tokens_received)]
+                        else:
+                            output = self.model(prompt,**model_input_kwargs)
+                            generated_texts = [o['text'] for o in output['choices']]
+                elif self.draft is not None and model_input_kwargs.get("temperature", 0) == 0:
+                    generated_texts = [self._speculate(tokens, stream_handler if stream else None, **model_input_kwargs)]
+                else:
+                    generated_texts = [self._generate(tokens, stream_handler if stream else None, **model_input_kwargs)]
+            except cancellation.GenerationCancelled:
+                # Decoding only stops after the prompt is evaluated, so the context still starts with the prompt
+                self._live_tokens = tokens
+                raise
+            self._save_prefix(tokens)
         return generated_texts
 
+    def _generate(self, tokens: Tuple[int, ...], stream_handler: Optional[TokenStreamingHandler] = None,
+        max_tokens: Optional[int] = None,
+        temperature: float = 0.8,
+        top_p: float = 0.95,
+        top_k: int = 40,
+        repeat_penalty: float = 1.1) -> str:
+        """
+        Samples a completion for the already tokenized prompt, with the same defaults as Llama.__call__.
+        Tokens are decoded incrementally, so characters spanning several tokens are passed to the stream handler whole.
+        """
+        max_tokens = min(max_tokens or self.max_length, self.model.n_ctx() - len(tokens))
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        eos = self.model.token_eos()
+        texts = []
+        # Llama.generate only evaluates the tokens after the prefix that is already in the context
+        prefill_tokens = len(tokens) - min(_common_prefix_length(self._live_tokens, tokens), len(tokens) - 1)
+        start = time.perf_counter()
+        first = None
+        generated = 0
+        for token in self.model.generate(tokens, top_k=top_k, top_p=top_p, temp=temperature, repeat_penalty=repeat_penalty):
+            if first is None:
+                first = time.perf_counter()
+            # Checked before every decode step, Llama.generate only yields after the prompt is evaluated
+            cancellation.raise_if_cancelled()
+            if token == eos:
+                break
+            generated += 1
+            text = decoder.decode(self.model.detokenize([token]))
+            if text:
+                texts.append(stream_handler(text) if stream_handler else text)
+            if generated >= max_tokens:
+                break
+        trace = tracing.current()
+        if trace is not None and first is not None:
+            trace.add("prefill", first - start, tokens=prefill_tokens, reused_tokens=len(tokens) - prefill_tokens)
+            trace.add("decode", time.perf_counter() - first, tokens=generated)
+        return "".join(texts)
+
+    def _speculate(self, tokens: Tuple[int, ...], stream_handler: Optional[TokenStreamingHandler] = None,
+        max_tokens: Optional[int] = None,
+        repeat_penalty: float = 1.1,
+        **kwargs) -> str:
+        """
+        Greedy decoding of the already tokenized prompt with speculative decoding. The draft model proposes
+        `speculative_tokens` tokens, and the model evaluates them in one batch after the last accepted token. Drafted
+        tokens are accepted as long as they are the tokens the model picks itself, and the first token it picks
+        differently is taken from the model, so the output is the same as greedy decoding without a draft.
+        """
+        max_tokens = min(max_tokens or self.max_length, self.model.n_ctx() - len(tokens))
+        k = max(1, min(self.speculative_tokens, self.n_batch - 1))
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        eos = self.model.token_eos()
+        texts = []
+        start = time.perf_counter()
+        # The last prompt token is evaluated as the first token of the first batch
+        n_past = _rewind(self.model, min(_common_prefix_length(self._live_tokens, tokens), len(tokens) - 1))
+        if n_past < len(tokens) - 1:
+            self.model.eval(tokens[n_past:-1])
+        first = time.perf_counter()
+        sequence = list(tokens)
+        generated, rounds, drafted, accepted = 0, 0, 0, 0
+        done = False
+        while not done and generated < max_tokens:
+            proposals = self._draft_tokens(sequence, min(k, max_tokens - generated), repeat_penalty)
+            batch = [sequence[-1]] + proposals
+            _rewind(self.model, len(sequence) - 1)
+            self.model.eval(batch)
+            # Checked after the batch, so the last prompt token is always evaluated when the prompt is kept as prefix
+            cancellation.raise_if_cancelled()
+            logits = _logits(self.model, len(batch))
+            rounds += 1
+            drafted += len(proposals)
+            for i in range(len(batch)):
+                token = _greedy_token(logits[i], self._recent_tokens(sequence), repeat_penalty)
+                hit = i < len(proposals) and proposals[i] == token
+                accepted += hit
+                sequence.append(token)
+                if token == eos:
+                    done = True
+                    break
+                generated += 1
+                text = decoder.decode(self.model.detokenize([token]))
+                if text:
+                    texts.append(stream_handler(text) if stream_handler else text)
+                if generated >= max_tokens:
+                    done = True
+                    break
+                if not hit:
+                    break
+        self.speculation.add(rounds, drafted, accepted)
+        trace = tracing.current()
+        if trace is not None:
+            trace.add("prefill", first - start, tokens=len(tokens) - n_past - 1, reused_tokens=n_past)
+            trace.add("decode", time.perf_counter() - first, tokens=generated, drafted=drafted, accepted=accepted)
+        return "".join(texts)
+
+    def _draft_tokens(self, sequence: List[int], n: int, repeat_penalty: float) -> List[int]:
+        """
+        Proposes the next n tokens greedily with the draft model, evaluating only the tokens its context does not hold
+        yet. Stops early at the end of sequence token.
+        """
+        eos = self.model.token_eos()
+        n_past = _rewind(self.draft, min(_common_prefix_length(self._draft_live, sequence), len(sequence) - 1))
+        self.draft.eval(sequence[n_past:])
+        live = list(sequence)
+        proposals = []
+        for i in range(n):
+            token = _greedy_token(_logits(self.draft)[0], self._recent_tokens(live), repeat_penalty)
+            proposals.append(token)
+            live.append(token)
+            if token == eos or i == n - 1:
+                break
+            self.draft.eval([token])
+        # The last proposal is not evaluated yet
+        self._draft_live = live[:-1]
+        return proposals
+
+    def _recent_tokens(self, sequence: Sequence[int]) -> List[int]:
+        # The tokens Llama.generate penalizes: the last last_n_tokens_size, padded with token 0 at the start
+        recent = list(sequence[-self.last_n_tokens_size:])
+        return [0] * (self.last_n_tokens_size - len(recent)) + recent
+
+    def score_labels(self, prompts: List[str], labels: Dict[str, List[str]]) -> List[Dict[str, float]]:
+        """
+        Scores candidate labels as the continuation of each prompt, from the next-token log-probabilities of a single
+        forward pass. Nothing is sampled or decoded.
+
+        A label is scored by the probability mass of the first tokens of its spellings, for example " yes" and " Yes".
+        Tokens shared by the spellings of different labels are ambiguous and ignored. Prompts are evaluated one after
+        the other, resuming from the longest evaluated prefix they share, so a batch of prompts built from the same
+        template and query only prefills what differs between them.
+
+        :param prompts: Prompts to score the labels for.
+        :param labels: Dictionary of label names and their spellings.
+        :return: A dictionary of label names and log-probabilities per prompt, normalized over the labels.
+        """
+        label_tokens = self._label_tokens(labels)
+        scores = []
+        with cancellation.acquire(self._lock):
+            for prompt in prompts:
+                cancellation.raise_if_cancelled()
+                tokens = self._tokens_for(prompt)
+                self._restore_prefix(tokens)
+                self._prefill(tokens)
+                logits = np.ctypeslib.as_array(llama_cpp.llama_get_logits(self.model.ctx), shape=(self.model.n_vocab(),))
+                logprobs = logits - np.logaddexp.reduce(logits)
+                label_scores = {label: float(np.logaddexp.reduce(logprobs[ids])) for label, ids in label_tokens.items()}
+                total = np.logaddexp.reduce(list(label_scores.values()))
+                scores.append({label: score - total for label, score in label_scores.items()})
+                # Not saved to the prefix cache, the prompts only differ after the prefix that stays live anyway
+                self._live_tokens = tokens
+        return scores
+
+    def _label_tokens(self, labels: Dict[str, List[str]]) -> Dict[str, List[int]]:
+        first_tokens = {
+            label: {
+                self.model.tokenize(text.encode("utf-8"), add_bos=False)[0]
+                for spelling in spellings
+                for text in (spelling, " " + spelling)
+            }
+            for label, spellings in labels.items()
+        }
+        label_tokens = {}
+        for label, ids in first_tokens.items():
+            others = set().union(*(t for l, t in first_tokens.items() if l != label))
+            label_tokens[label] = sorted(ids - others)
+            if not label_tokens[label]:
+                raise ValueError(f"The spellings of label '{label}' all start with a token that other labels share")
+        return label_tokens
+
+    def _prefill(self, tokens: Tuple[int, ...]):
+        """
+        Evaluates the prompt tokens, skipping the prefix that is already evaluated in the llama context. The last token
+        is always evaluated, so the logits are those of the next token after the prompt.
+        """
+        n_past = _rewind(self.model, min(_common_prefix_length(self._live_tokens, tokens), len(tokens) - 1))
+        if n_past < len(tokens) - 1:
+            self.model.eval(tokens[n_past:-1])
+        # The last token on its own, so the logits hold just its row even when the model keeps those of every token
+        self.model.eval(tokens[-1:])
+
+    def _tokenize(self, prompt: str) -> Tuple[int, ...]:
+        # Tokenized the same way Llama.__call__ does, so the tokens line up with what the llama context evaluates
+        return tuple(self.model.tokenize(b" " + prompt.encode("utf-8")))
+
+    def _remember_tokens(self, prompt: str, tokens: Tuple[int, ...]):
+        with self._prompt_tokens_lock:
+            self._prompt_tokens[prompt] = tokens
+            while len(self._prompt_tokens) > 16:
+                self._prompt_tokens.popitem(last=False)
+
+    def _tokens_for(self, prompt: str) -> Tuple[int, ...]:
+        """
+        Returns the tokens of a prompt, reusing the ones produced by _ensure_token_limit if it checked this prompt.
+        """
+        with self._prompt_tokens_lock:
+            tokens = self._prompt_tokens.pop(prompt, None)
+        return tokens if tokens is not None else self._tokenize(prompt)
+
+    def _restore_prefix(self, tokens: Tuple[int, ...]):
+        """
+        Loads the cached state sharing the longest prefix with the prompt, if it shares more than the state that is
+        already loaded. Llama.generate then only evaluates the tokens after the common prefix.
+        """
+        if self.prefix_cache is None:
+            return
+        key, length = self.prefix_cache.longest_prefix(tokens)
+        if key is not None and length > _common_prefix_length(self._live_tokens, tokens):
+            logger.debug("Resuming from a cached state sharing %s of %s prompt tokens", length, len(tokens))
+            self.model.load_state(self.prefix_cache.get(key))
+            self._live_tokens = key
+
+    def _save_prefix(self, tokens: Tuple[int, ...]):
+        self._live_tokens = tokens
+        if self.prefix_cache is None:
+            return
+        # Saving copies the whole KV cache, skip it if a cached state already covers the prompt
+        _, length = self.prefix_cache.longest_prefix(tokens, count=False)
+        if length < len(tokens):
+            self.prefix_cache.put(tokens, self.model.save_state())
+
     def supports(cls, model_name_or_path: str, **kwargs) -> bool:
         """
         Checks if the given model is supported by this invocation layer.
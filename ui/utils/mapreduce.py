@@ -0,0 +1,161 @@
+import logging
+from concurrent.futures import Executor, as_completed
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from haystack.schema import Document
+
+from utils.cancellation import GenerationCancelled
+
+logger = logging.getLogger(__name__)
+
+
+def chunk_groups(documents: List[Document], budget: int, count_tokens: Callable[[str], int]) -> List[List[Document]]:
+    """
+    Groups retrieved paragraphs by the document they come from, and splits the paragraphs of a document into chunk
+    groups that fit in the token budget of one prompt.
+
+    :param documents: Retrieved paragraphs.
+    :param budget: Number of tokens available for the paragraphs of a prompt.
+    :param count_tokens: Function returning the number of tokens of a text.
+    :return: The chunk groups, highest scoring paragraph first within each group and across the groups.
+    """
+    ranked = sorted(documents, key=lambda d: d.score if d.score is not None else 0, reverse=True)
+    by_name: Dict[str, List[Document]] = {}
+    for doc in ranked:
+        by_name.setdefault(doc.meta.get("name", ""), []).append(doc)
+    groups = []
+    for docs in by_name.values():
+        group: List[Document] = []
+        used = 0
+        for doc in docs:
+            # One extra token for the delimiter the template joins the paragraphs with
+            tokens = count_tokens(doc.content) + 1
+            if group and used + tokens > budget:
+                groups.append(group)
+                group, used = [], 0
+            group.append(doc)
+            used += tokens
+        groups.append(group)
+    return groups
+
+
+def reduce_batches(partials: List[Document], budget: int, count_tokens: Callable[[str], int]) -> List[List[Document]]:
+    """
+    Splits partial answers into consecutive batches that fit in the token budget of one prompt. A batch takes at least
+    two partials even if they do not fit, so every reduce level merges something; the context packer then drops the
+    lowest scoring one.
+    """
+    batches = []
+    batch: List[Document] = []
+    used = 0
+    for partial in partials:
+        tokens = count_tokens(partial.content) + 1
+        if len(batch) >= 2 and used + tokens > budget:
+            batches.append(batch)
+            batch, used = [], 0
+        batch.append(partial)
+        used += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class MapReduce:
+    """
+    Answers a question from more paragraphs than fit in one prompt.
+
+    The map step answers the question from every chunk group on its own, all groups at the same time. The reduce step
+    merges the partial answers, as many as fit in a prompt at a time, level after level until one answer is left.
+    Only that last merge streams its tokens; the partial answers are passed to `on_partial` as they come in.
+    """
+
+    def __init__(self, map_answer: Callable[[List[Document], Any], str], reduce_answer: Callable[[List[Document], Any], str],
+        budget: int, count_tokens: Callable[[str], int], executor: Executor,
+        on_partial: Optional[Callable[[Dict[str, Any]], None]] = None):
+        """
+        :param map_answer: Function answering the question from a chunk group, called with the paragraphs and a stream
+        handler (or None).
+        :param reduce_answer: Function merging partial answers, given as documents, with the same arguments.
+        :param budget: Number of tokens available for the partial answers of a reduce prompt.
+        :param count_tokens: Function returning the number of tokens of a text.
+        :param executor: Pool the map and reduce steps of a level run on.
+        :param on_partial: Called with a dictionary describing every partial answer: its level (0 for the map step),
+        the names of the documents it covers, and its text.
+        """
+        self.map_answer = map_answer
+        self.reduce_answer = reduce_answer
+        self.budget = budget
+        self.count_tokens = count_tokens
+        self.executor = executor
+        self.on_partial = on_partial
+
+    def run(self, groups: List[List[Document]], stream_handler: Any = None) -> Tuple[str, List[Dict[str, Any]]]:
+        """
+        :param groups: Chunk groups, see chunk_groups.
+        :param stream_handler: Stream handler of the final answer.
+        :return: The final answer, and the partial answers of every level.
+        """
+        if not groups:
+            raise ValueError("No paragraphs to answer the question from")
+        log: List[Dict[str, Any]] = []
+        if len(groups) == 1:
+            answer = self.map_answer(groups[0], stream_handler)
+            self._record(log, 0, groups[0], answer)
+            return answer, log
+
+        partials = self._level(0, self.map_answer, groups, log)
+        level = 1
+        while len(partials) > 1:
+            batches = reduce_batches(partials, self.budget, self.count_tokens)
+            if len(batches) == 1:
+                answer = self.reduce_answer(batches[0], stream_handler)
+                self._record(log, level, batches[0], answer)
+                return answer, log
+            # A partial left on its own is carried to the next level as it is
+            merged = self._level(level, self.reduce_answer, [b for b in batches if len(b) > 1], log)
+            partials = sorted(merged + [b[0] for b in batches if len(b) == 1], key=lambda d: d.score or 0, reverse=True)
+            level += 1
+        if not partials:
+            raise RuntimeError("None of the partial answers could be generated")
+        return partials[0].content, log
+
+    def _level(self, level: int, answer: Callable[[List[Document], Any], str], groups: List[List[Document]],
+        log: List[Dict[str, Any]]) -> List[Document]:
+        futures = {self.executor.submit(answer, group, None): group for group in groups}
+        partials = []
+        for future in as_completed(futures):
+            group = futures[future]
+            try:
+                text = future.result().strip()
+            except GenerationCancelled:
+                raise
+            except Exception as e:
+                # One failed group should not lose the answer, the others still cover most of the paragraphs
+                logger.exception(e)
+                self._record(log, level, group, None, error=str(e))
+                continue
+            self._record(log, level, group, text)
+            if text:
+                partials.append(self._partial(group, text))
+        return sorted(partials, key=lambda d: d.score or 0, reverse=True)
+
+    def _partial(self, group: List[Document], text: str) -> Document:
+        return Document(content=text, meta={"name": ", ".join(_names(group))},
+                        score=max((d.score or 0 for d in group), default=0))
+
+    def _record(self, log: List[Dict[str, Any]], level: int, group: List[Document], text: Optional[str], error: Optional[str] = None):
+        entry = {"level": level, "documents": _names(group), "paragraphs": len(group), "answer": text}
+        if error is not None:
+            entry["error"] = error
+        log.append(entry)
+        if self.on_partial is not None:
+            self.on_partial(entry)
+
+
+def _names(group: List[Document]) -> List[str]:
+    names: List[str] = []
+    for doc in group:
+        for name in doc.meta.get("name", "").split(", "):
+            if name and name not in names:
+                names.append(name)
+    return names
@@ -0,0 +1,111 @@
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from haystack.schema import Document
+
+
+class TokenCounter:
+    """
+    Counts tokens with a tokenize function, remembering the token arrays of the texts it has seen by their content
+    hash. Retrieved paragraphs come back again and again, so most of them are never tokenized twice.
+    """
+
+    def __init__(self, tokenize: Callable[[str], List[int]], max_entries: int = 4096):
+        self.tokenize = tokenize
+        self.max_entries = max_entries
+        self._tokens: "OrderedDict[str, Tuple[int, ...]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, text: str) -> int:
+        return len(self.tokens(text))
+
+    def tokens(self, text: str) -> Tuple[int, ...]:
+        key = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        with self._lock:
+            if key in self._tokens:
+                self._tokens.move_to_end(key)
+                return self._tokens[key]
+        tokens = tuple(self.tokenize(text))
+        with self._lock:
+            self._tokens[key] = tokens
+            while len(self._tokens) > self.max_entries:
+                self._tokens.popitem(last=False)
+        return tokens
+
+
+def pack_documents(
+    documents: List[Document], budget: int, count_tokens: Callable[[str], int]
+) -> Tuple[List[Document], List[Dict[str, Any]]]:
+    """
+    Selects the documents that fit in a token budget, highest score first. A document that does not fit is skipped,
+    and smaller lower-scoring documents can still take its place.
+
+    :param documents: Retrieved documents.
+    :param budget: Number of tokens available for the documents.
+    :param count_tokens: Function returning the number of tokens of a text.
+    :return: The kept documents, in order of score, and a description of each dropped document.
+    """
+    ranked = sorted(documents, key=lambda d: d.score if d.score is not None else 0, reverse=True)
+    kept = []
+    dropped = []
+    used = 0
+    for doc in ranked:
+        # One extra token for the delimiter the template joins the documents with
+        tokens = count_tokens(doc.content) + 1
+        if used + tokens <= budget:
+            kept.append(doc)
+            used += tokens
+        else:
+            dropped.append({"id": doc.id, "name": doc.meta.get("name", ""), "score": doc.score, "tokens": tokens})
+    return kept, dropped
+
+
+# Token counters of the invocation layers that do not have one of their own
+_counters: "weakref.WeakKeyDictionary[Any, TokenCounter]" = weakref.WeakKeyDictionary()
+
+
+# Tokens kept free besides the documents, template and answer. Paragraphs can tokenize to a few more tokens inside the prompt
+# than on their own, where the text around them merges differently.
+PROMPT_TOKEN_MARGIN = 8
+
+
+def count_prompt_tokens(model: Any, prompt: str, count_tokens: Callable[[str], int]) -> int:
+    """
+    Counts the tokens of a rendered prompt the way the invocation layer counts them for its token limit, with the
+    tokens it adds such as BOS, plus PROMPT_TOKEN_MARGIN.
+
+    :param model: The PromptModel.
+    :param prompt: The rendered prompt.
+    :param count_tokens: Token counter of the model, see model_token_limits. Used for invocation layers that do not
+    count prompts themselves.
+    """
+    layer = model.model_invocation_layer
+    if hasattr(layer, "count_prompt_tokens"):
+        tokens = layer.count_prompt_tokens(prompt)
+    else:
+        tokens = count_tokens(prompt)
+    return tokens + PROMPT_TOKEN_MARGIN
+
+
+def model_token_limits(model: Any, generation_kwargs: Dict[str, Any]) -> Optional[Tuple[Callable[[str], int], int, int]]:
+    """
+    Returns the token counter, context length and answer length of a PromptModel, or None if they are not known for
+    its invocation layer.
+
+    :param model: The PromptModel.
+    :param generation_kwargs: Generation kwargs of the PromptNode. The llama layer generates up to `max_tokens` in the
+    same context as the prompt.
+    """
+    layer = model.model_invocation_layer
+    if hasattr(layer, "count_tokens") and hasattr(layer, "context_length"):
+        answer_length = max(layer.max_length or 0, generation_kwargs.get("max_tokens", 0))
+        return layer.count_tokens, layer.context_length(), answer_length
+    tokenizer = getattr(getattr(layer, "pipe", None), "tokenizer", None)
+    if tokenizer is not None:
+        if layer not in _counters:
+            _counters[layer] = TokenCounter(tokenizer.encode)
+        return _counters[layer], tokenizer.model_max_length, layer.max_length
+    return None
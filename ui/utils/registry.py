@@ -0,0 +1,183 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class ModelRegistry:
+    """
+    Process-wide registry of loaded models.
+
+    Every Streamlit session shares the same registry, so a model is loaded once per process instead of once per
+    browser session. Loaded models are kept in least-recently-used order and evicted when the total estimated size
+    goes over the memory budget. A model that is leased by a running request is never evicted.
+    """
+
+    def __init__(self, loader: Callable[[str], Tuple[Any, int]], memory_budget: Optional[int] = None,
+        estimate_size: Optional[Callable[[str], int]] = None):
+        """
+        :param loader: Callable that takes a model name and returns a tuple of the loaded model and its estimated size in bytes.
+        :param memory_budget: Maximum total size in bytes of the loaded models. None means no limit.
+        :param estimate_size: Callable that takes a model name and returns its estimated size in bytes without loading it,
+        such as the size of its weights on disk. Room is made for that size before the model is loaded, so the loaded
+        models and the one being loaded stay within the budget together.
+        """
+        self.loader = loader
+        self.memory_budget = memory_budget
+        self.estimate_size = estimate_size
+        self._models: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        # Estimated sizes of the models that are being loaded
+        self._reserved: Dict[str, int] = {}
+        self._lock = threading.RLock()
+        self._loading: Dict[str, threading.Lock] = {}
+        self._evict_callbacks: List[Callable[[str, Any], None]] = []
+        self._metrics = {"hits": 0, "misses": 0, "evictions": 0, "failures": 0, "load_seconds": {}}
+
+    def get(self, name: str) -> Any:
+        """
+        Returns the model with the given name, loading it if needed. The model is not leased, so it can be evicted
+        as soon as it is not the most recently used one. Use `lease` while a request runs on the model.
+        """
+        entry = self._acquire(name)
+        self._release(name)
+        return entry["model"]
+
+    @contextmanager
+    def lease(self, name: str):
+        """
+        Context manager that yields the model with the given name and keeps it from being evicted until the block exits.
+        """
+        entry = self._acquire(name)
+        try:
+            yield entry["model"]
+        finally:
+            self._release(name)
+
+    def on_evict(self, callback: Callable[[str, Any], None]):
+        """
+        Registers a callback that is called with the model name and model whenever a model is evicted or unloaded,
+        so caches holding on to the model can drop it as well.
+        """
+        self._evict_callbacks.append(callback)
+
+    def unload(self, name: str) -> bool:
+        """
+        Removes a model from the registry if it is not in use. Returns True if the model was removed.
+        """
+        with self._lock:
+            entry = self._models.get(name)
+            if entry is None or entry["refcount"] > 0:
+                return False
+            self._drop(name)
+        return True
+
+    def loaded(self) -> List[str]:
+        """
+        Names of the loaded models, from least to most recently used.
+        """
+        with self._lock:
+            return list(self._models)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns the registry metrics: cache hits and misses, evictions, load time per model and memory in use.
+        """
+        with self._lock:
+            return {
+                "hits": self._metrics["hits"],
+                "misses": self._metrics["misses"],
+                "evictions": self._metrics["evictions"],
+                "failures": self._metrics["failures"],
+                "load_seconds": dict(self._metrics["load_seconds"]),
+                "memory_used": self._memory_used(),
+                "memory_budget": self.memory_budget,
+                "models": {name: {"size": e["size"], "refcount": e["refcount"]} for name, e in self._models.items()},
+            }
+
+    def _acquire(self, name: str) -> Dict[str, Any]:
+        with self._lock:
+            entry = self._models.get(name)
+            if entry is not None:
+                self._metrics["hits"] += 1
+                entry["refcount"] += 1
+                self._models.move_to_end(name)
+                return entry
+            load_lock = self._loading.setdefault(name, threading.Lock())
+
+        # Load outside of the registry lock, so other models can still be served while the weights are read.
+        # The per-model lock makes concurrent sessions asking for the same model wait for a single load.
+        with load_lock:
+            with self._lock:
+                entry = self._models.get(name)
+                if entry is not None:
+                    self._metrics["hits"] += 1
+                    entry["refcount"] += 1
+                    self._models.move_to_end(name)
+                    return entry
+                self._metrics["misses"] += 1
+
+            start = time.perf_counter()
+            try:
+                if self.estimate_size is not None:
+                    estimate = self.estimate_size(name)
+                    with self._lock:
+                        self._make_room(estimate)
+                        self._reserved[name] = estimate
+                model, size = self.loader(name)
+            except Exception:
+                with self._lock:
+                    self._metrics["failures"] += 1
+                    self._metrics["load_seconds"][name] = time.perf_counter() - start
+                raise
+            finally:
+                with self._lock:
+                    self._reserved.pop(name, None)
+                    self._loading.pop(name, None)
+            elapsed = time.perf_counter() - start
+            logger.info("Loaded model %s (%.1f MB) in %.2f s", name, size / 2**20, elapsed)
+
+            with self._lock:
+                # Evicts more if the model turned out larger than estimated
+                self._make_room(size)
+                entry = {"model": model, "size": size, "refcount": 1}
+                self._models[name] = entry
+                self._metrics["load_seconds"][name] = elapsed
+                return entry
+
+    def _release(self, name: str):
+        with self._lock:
+            entry = self._models.get(name)
+            if entry is not None:
+                entry["refcount"] -= 1
+
+    def _memory_used(self) -> int:
+        return sum(e["size"] for e in self._models.values()) + sum(self._reserved.values())
+
+    def _make_room(self, size: int):
+        if self.memory_budget is None:
+            return
+        for name in list(self._models):
+            if self._memory_used() + size <= self.memory_budget:
+                return
+            if self._models[name]["refcount"] == 0:
+                self._drop(name)
+                self._metrics["evictions"] += 1
+        if self._memory_used() + size > self.memory_budget:
+            logger.warning(
+                "Loading a model of %.1f MB goes over the memory budget of %.1f MB because all loaded models are in use",
+                size / 2**20,
+                self.memory_budget / 2**20,
+            )
+
+    def _drop(self, name: str):
+        entry = self._models.pop(name)
+        logger.info("Unloaded model %s", name)
+        for callback in self._evict_callbacks:
+            try:
+                callback(name, entry["model"])
+            except Exception as e:
+                logging.exception(e)
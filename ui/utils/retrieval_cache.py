@@ -0,0 +1,141 @@
+import copy
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from haystack.nodes import BaseRetriever
+from haystack.schema import Document
+
+from utils.hybrid import FilterType
+
+
+def normalize_query(query: str) -> str:
+    """
+    Lowercases a query and collapses its whitespace. The analyzers of BM25 and the embedding models ignore both.
+    """
+    return " ".join(query.lower().split())
+
+
+class RetrievalCache:
+    """
+    Bounded cache of retrieval results: the ids and scores of the documents retrieved for a normalized query, filters
+    and top_k, plus the retrieved documents themselves by id.
+
+    Entries are stamped with the index version they were retrieved at. `invalidate` bumps the version whenever documents
+    are indexed, so results retrieved before that are never served again. Entries also expire after `ttl` seconds, for
+    documents indexed by other processes.
+    """
+
+    def __init__(self, max_entries: int = 2048, max_documents: int = 10000, ttl: Optional[float] = 300):
+        """
+        :param max_entries: Maximum number of cached results, least recently used are evicted first.
+        :param max_documents: Maximum number of cached documents.
+        :param ttl: Seconds a result is served for. None keeps results until the version changes.
+        """
+        self.max_entries = max_entries
+        self.max_documents = max_documents
+        self.ttl = ttl
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self._results: "OrderedDict[Tuple[str, str, int], Tuple[int, float, List[Tuple[str, Optional[float]]]]]" = OrderedDict()
+        self._documents: "OrderedDict[str, Document]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(query: str, filters: Optional[Dict[str, Any]], top_k: int) -> Tuple[str, str, int]:
+        return normalize_query(query), json.dumps(filters, sort_keys=True, default=str), top_k
+
+    def get(self, key: Tuple[str, str, int]) -> Optional[List[Document]]:
+        """
+        Returns copies of the cached documents for a key, with the scores they were retrieved with, or None on a miss.
+        """
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None:
+                version, stored, hits = entry
+                if version == self.version and (self.ttl is None or time.time() - stored < self.ttl) \
+                        and all(doc_id in self._documents for doc_id, _ in hits):
+                    self._results.move_to_end(key)
+                    self.hits += 1
+                    documents = []
+                    for doc_id, score in hits:
+                        self._documents.move_to_end(doc_id)
+                        # Copies, since callers such as rank fusion and the context packer change the scores
+                        doc = copy.copy(self._documents[doc_id])
+                        doc.score = score
+                        documents.append(doc)
+                    return documents
+                del self._results[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: Tuple[str, str, int], documents: List[Document], version: int):
+        """
+        Caches the documents retrieved for a key at `version`. Results retrieved before an invalidation are dropped.
+        """
+        with self._lock:
+            if version != self.version:
+                return
+            self._results[key] = (version, time.time(), [(doc.id, doc.score) for doc in documents])
+            self._results.move_to_end(key)
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+            for doc in documents:
+                self._documents[doc.id] = copy.copy(doc)
+                self._documents.move_to_end(doc.id)
+            while len(self._documents) > self.max_documents:
+                self._documents.popitem(last=False)
+
+    def invalidate(self):
+        """
+        Bumps the index version, so no result cached so far is served again.
+        """
+        with self._lock:
+            self.version += 1
+            self._results.clear()
+            self._documents.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"version": self.version, "entries": len(self._results), "documents": len(self._documents),
+                    "hits": self.hits, "misses": self.misses}
+
+
+class CachingRetriever(BaseRetriever):
+    """
+    Retriever serving repeated retrievals from a RetrievalCache, and passing the others on to the wrapped retriever.
+    """
+
+    def __init__(self, retriever: BaseRetriever, cache: RetrievalCache, top_k: int = 5):
+        super().__init__()
+        self.retriever = retriever
+        self.cache = cache
+        self.top_k = top_k
+
+    def retrieve(self, query: str, filters: Optional[Dict[str, Any]] = None, top_k: Optional[int] = None,
+        index: Optional[str] = None, headers: Optional[Dict[str, str]] = None, scale_score: Optional[bool] = None,
+        document_store: Any = None) -> List[Document]:
+        return self.retrieve_batch([query], filters=[filters], top_k=top_k, index=index, headers=headers)[0]
+
+    def retrieve_batch(self, queries: List[str], filters: FilterType = None, top_k: Optional[int] = None,
+        index: Optional[str] = None, headers: Optional[Dict[str, str]] = None, batch_size: Optional[int] = None,
+        scale_score: Optional[bool] = None, document_store: Any = None) -> List[List[Document]]:
+        top_k = top_k or self.top_k
+        if not isinstance(filters, list):
+            filters = [filters] * len(queries)
+        # The version is read before retrieving, so results that race with an upload are not cached under the new version
+        version = self.cache.version
+        keys = [self.cache.make_key(query, f, top_k) for query, f in zip(queries, filters)]
+        results: List[Optional[List[Document]]] = [self.cache.get(key) for key in keys]
+        misses = [i for i, result in enumerate(results) if result is None]
+        if misses:
+            retrieved = self.retriever.retrieve_batch(
+                queries=[queries[i] for i in misses], filters=[filters[i] for i in misses], top_k=top_k, index=index, headers=headers
+            )
+            for i, documents in zip(misses, retrieved):
+                self.cache.put(keys[i], documents, version)
+                results[i] = documents
+        return results
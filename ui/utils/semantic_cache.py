@@ -0,0 +1,198 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from utils.retrieval_cache import normalize_query
+
+logger = logging.getLogger(__name__)
+
+
+class SemanticAnswerCache:
+    """
+    Cache of generated answers that also serves questions phrased differently from the one that was answered.
+
+    Entries are grouped by scope - everything besides the question that determines the answer, such as the document
+    filter, the model and the prompt template. A question is embedded, and the answer of the most similar earlier
+    question in the same scope is reused if their cosine similarity reaches `threshold`. The embeddings of a scope are
+    kept in memory as one matrix, so a lookup is a single matrix-vector product.
+
+    Entries are stored in SQLite, with the names of the documents they were generated from, so they survive restarts
+    and can be dropped when one of those documents is indexed again.
+    """
+
+    def __init__(self, path: str, embed: Callable[[List[str]], np.ndarray], threshold: float = 0.92,
+        max_entries: int = 10000, ttl: Optional[float] = 7 * 24 * 3600):
+        """
+        :param path: Path of the SQLite database file.
+        :param embed: Function returning the embeddings of a list of questions, one row per question.
+        :param threshold: Minimum cosine similarity for an answer to be reused.
+        :param max_entries: Maximum number of answers to keep. The oldest answers are removed first.
+        :param ttl: Number of seconds an answer stays valid. None means answers never expire.
+        """
+        self.path = path
+        self.embed = embed
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS semantic_answers (id INTEGER PRIMARY KEY, scope TEXT, query TEXT, "
+                "embedding BLOB, results TEXT, names TEXT, created REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS semantic_answers_created ON semantic_answers (created)")
+        # Per scope: the entry ids, their normalized embeddings and their creation times
+        self._scopes: Dict[str, Tuple[List[int], np.ndarray, List[float]]] = {}
+        self._load()
+
+    @staticmethod
+    def make_scope(model: str, prompt_text: str, documents: Optional[Iterable[str]], generation_kwargs: Dict[str, Any],
+        paragraphs: Iterable[str] = ()) -> str:
+        """
+        Builds the scope of a question.
+
+        :param model: Name or path of the model.
+        :param prompt_text: The prompt template, before it is rendered.
+        :param documents: Names of the documents the question is asked about, None for all documents.
+        :param generation_kwargs: Generation kwargs passed to the model, such as max_tokens.
+        :param paragraphs: Ids of the paragraphs retrieved for the question. An answer is only reused for a question that
+        retrieves the same paragraphs, so an upload that changes what is retrieved - also when the question is about all
+        documents - does not serve answers that miss it.
+        """
+        scope = {
+            "model": model,
+            "prompt": hashlib.sha256(prompt_text.encode("utf-8")).hexdigest(),
+            "documents": sorted(documents) if documents is not None else None,
+            "generation_kwargs": generation_kwargs,
+            "paragraphs": sorted(paragraphs),
+        }
+        return hashlib.sha256(json.dumps(scope, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def get(self, scope: str, query: str) -> Optional[Dict[str, Any]]:
+        """
+        Returns the answer to the most similar question in the scope, or None if no question is similar enough. The
+        same question asked again is left to the exact-match answer cache, so it is not served as a similar one.
+
+        :return: A dictionary with the 'results', the 'query' they answered and the 'similarity' of the two questions.
+        """
+        embedding = self._embed(query)
+        now = time.time()
+        with self._lock:
+            ids, matrix, created = self._scopes.get(scope, ([], None, []))
+            best = None
+            if ids:
+                similarities = matrix @ embedding
+                if self.ttl is not None:
+                    similarities = np.where(now - np.asarray(created) > self.ttl, -1.0, similarities)
+                i = int(np.argmax(similarities))
+                if similarities[i] >= self.threshold:
+                    best = ids[i], float(similarities[i])
+            if best is None:
+                self.misses += 1
+                return None
+            row = self._conn.execute("SELECT query, results FROM semantic_answers WHERE id = ?", (best[0],)).fetchone()
+            if row is None or normalize_query(row[0]) == normalize_query(query):
+                self.misses += 1
+                return None
+            self.hits += 1
+        return {"query": row[0], "results": json.loads(row[1]), "similarity": best[1]}
+
+    def put(self, scope: str, query: str, results: List[str], document_names: Iterable[str]):
+        """
+        Stores the results for a question in a scope, remembering which documents they were generated from.
+        """
+        embedding = self._embed(query)
+        now = time.time()
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO semantic_answers (scope, query, embedding, results, names, created) VALUES (?, ?, ?, ?, ?, ?)",
+                (scope, query, embedding.tobytes(), json.dumps(results), json.dumps(sorted(set(document_names))), now),
+            )
+            self._add(scope, cursor.lastrowid, embedding, now)
+            self._evict(now)
+
+    def invalidate_document(self, name: str) -> int:
+        """
+        Removes all answers generated from the document with the given name. Returns the number of answers removed.
+        """
+        with self._lock, self._conn:
+            # Names are stored as a JSON list, match the quoted name and check the list to be sure
+            rows = self._conn.execute(
+                "SELECT id, names FROM semantic_answers WHERE names LIKE ?", ("%" + json.dumps(name) + "%",)
+            ).fetchall()
+            ids = [row[0] for row in rows if name in json.loads(row[1])]
+            self._delete(ids)
+        if ids:
+            logger.info("Removed %s similar-question answers for document %s", len(ids), name)
+        return len(ids)
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM semantic_answers")
+            self._scopes.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = sum(len(ids) for ids, _, _ in self._scopes.values())
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "scopes": len(self._scopes)}
+
+    def _embed(self, query: str) -> np.ndarray:
+        embedding = np.asarray(self.embed([query]), dtype=np.float32).reshape(-1)
+        return embedding / max(float(np.linalg.norm(embedding)), 1e-12)
+
+    def _add(self, scope: str, entry_id: int, embedding: np.ndarray, created: float):
+        ids, matrix, times = self._scopes.get(scope, ([], None, []))
+        matrix = embedding[None, :] if matrix is None else np.vstack([matrix, embedding])
+        self._scopes[scope] = (ids + [entry_id], matrix, times + [created])
+
+    def _load(self):
+        rows = self._conn.execute("SELECT id, scope, embedding, created FROM semantic_answers ORDER BY id").fetchall()
+        by_scope: Dict[str, Tuple[List[int], List[np.ndarray], List[float]]] = {}
+        for entry_id, scope, blob, created in rows:
+            ids, embeddings, times = by_scope.setdefault(scope, ([], [], []))
+            ids.append(entry_id)
+            embeddings.append(np.frombuffer(blob, dtype=np.float32))
+            times.append(created)
+        for scope, (ids, embeddings, times) in by_scope.items():
+            try:
+                self._scopes[scope] = (ids, np.vstack(embeddings), times)
+            except ValueError:
+                # Embeddings of another dimension, from before the embedding model changed
+                logger.warning("Ignoring %s cached answers with embeddings of a different dimension", len(ids))
+
+    def _evict(self, now: float):
+        stale = []
+        if self.ttl is not None:
+            stale = [row[0] for row in self._conn.execute("SELECT id FROM semantic_answers WHERE created < ?", (now - self.ttl,))]
+        excess = self._conn.execute("SELECT COUNT(*) FROM semantic_answers").fetchone()[0] - len(stale) - self.max_entries
+        if excess > 0:
+            stale += [
+                row[0] for row in self._conn.execute(
+                    "SELECT id FROM semantic_answers WHERE created >= ? ORDER BY created LIMIT ?",
+                    (now - self.ttl if self.ttl is not None else 0, excess),
+                )
+            ]
+        self._delete(stale)
+
+    def _delete(self, ids: List[int]):
+        if not ids:
+            return
+        self._conn.executemany("DELETE FROM semantic_answers WHERE id = ?", [(i,) for i in ids])
+        removed = set(ids)
+        for scope, (scope_ids, matrix, times) in list(self._scopes.items()):
+            keep = [i for i, entry_id in enumerate(scope_ids) if entry_id not in removed]
+            if len(keep) == len(scope_ids):
+                continue
+            if keep:
+                self._scopes[scope] = ([scope_ids[i] for i in keep], matrix[keep], [times[i] for i in keep])
+            else:
+                del self._scopes[scope]
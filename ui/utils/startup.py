@@ -0,0 +1,131 @@
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from utils.registry import ModelRegistry
+from utils.tracing import Trace
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+LOADING = "loading"
+WARMING = "warming up"
+READY = "ready"
+FAILED = "failed"
+
+
+def prefault(path: str, chunk_size: int = 64 * 2**20) -> int:
+    """
+    Reads a model file, or every file of a model directory, once from start to end, so its pages are in the page cache
+    when the model memory-maps it. Returns the number of bytes read.
+    """
+    if os.path.isdir(path):
+        return sum(prefault(os.path.join(root, f), chunk_size) for root, _, files in os.walk(path) for f in files)
+    buffer = bytearray(chunk_size)
+    total = 0
+    with open(path, "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            # Lets the kernel read ahead in large requests
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            total += n
+    return total
+
+
+class ModelStartup:
+    """
+    Loads models into a ModelRegistry from a background thread, one after the other, so pages render while the
+    weights are read.
+
+    Each model goes through up to three phases, each timed in a Trace passed to `on_trace`: prefault reads the weights
+    into the page cache, load creates the model in the registry, and warmup runs a short generation so the first
+    request finds warm caches. Pages read the state of every model with `status`.
+    """
+
+    def __init__(self, registry: ModelRegistry, prefault: Optional[Callable[[str], Any]] = None,
+        warm_up: Optional[Callable[[str, Any], Any]] = None, on_trace: Optional[Callable[[Trace], None]] = None):
+        """
+        :param registry: The registry the models are loaded into.
+        :param prefault: Called with a model name before it is loaded, to read its weights into the page cache.
+        :param warm_up: Called with a model name and the loaded model, to run a warm-up generation.
+        :param on_trace: Called with the trace of the phases of every model once it is ready or failed.
+        """
+        self.registry = registry
+        self.prefault = prefault
+        self.warm_up = warm_up
+        self.on_trace = on_trace
+        self._status: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Condition()
+        self._queue: "queue.Queue[str]" = queue.Queue()
+        threading.Thread(target=self._run, name="model-startup", daemon=True).start()
+
+    def start(self, models: Iterable[str]):
+        """
+        Queues models for loading, unless they are already queued, loading or loaded. Failed models are tried again.
+        """
+        with self._lock:
+            for name in models:
+                if name in self._status and self._status[name]["state"] != FAILED:
+                    continue
+                self._status[name] = {"state": PENDING, "error": None, "phases": {}, "queued": time.time()}
+                self._queue.put(name)
+
+    def status(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Returns the state, error and phase timings in seconds of every model that was started.
+        """
+        with self._lock:
+            return {name: {**s, "phases": dict(s["phases"])} for name, s in self._status.items()}
+
+    def ready(self, name: str) -> bool:
+        with self._lock:
+            return self._status.get(name, {}).get("state") == READY
+
+    def wait(self, name: str, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until a model is ready or failed. Returns whether it is ready.
+        """
+        with self._lock:
+            self._lock.wait_for(lambda: self._status.get(name, {}).get("state") in (READY, FAILED), timeout)
+            return self._status.get(name, {}).get("state") == READY
+
+    def _set(self, name: str, **values: Any):
+        with self._lock:
+            self._status[name].update(values)
+            self._lock.notify_all()
+
+    def _phase(self, trace: Trace, name: str, phase: str, run: Callable[[], Any]) -> Any:
+        with trace.stage(phase) as record:
+            result = run()
+        with self._lock:
+            self._status[name]["phases"][phase] = record["seconds"]
+        return result
+
+    def _run(self):
+        while True:
+            name = self._queue.get()
+            trace = Trace("startup", model=name)
+            start = time.perf_counter()
+            try:
+                self._set(name, state=LOADING)
+                if self.prefault is not None:
+                    self._phase(trace, name, "prefault", lambda: self.prefault(name))
+                self._phase(trace, name, "load", lambda: self.registry.get(name))
+                if self.warm_up is not None:
+                    self._set(name, state=WARMING)
+                    # Leased, so the model cannot be evicted halfway through the warm-up
+                    with self.registry.lease(name) as model:
+                        self._phase(trace, name, "warmup", lambda: self.warm_up(name, model))
+                self._set(name, state=READY, seconds=time.perf_counter() - start)
+                logger.info("Model %s is ready after %.1fs: %s", name, time.perf_counter() - start, self._status[name]["phases"])
+            except Exception as e:
+                logger.exception(e)
+                self._set(name, state=FAILED, error=str(e), seconds=time.perf_counter() - start)
+            if self.on_trace is not None:
+                self.on_trace(trace)
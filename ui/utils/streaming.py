@@ -0,0 +1,62 @@
+import time
+from typing import Any, Dict
+
+from haystack.nodes.prompt.invocation_layer import TokenStreamingHandler
+
+
+class TableStreamingHandler(TokenStreamingHandler):
+    """
+    Streams generated tokens into one cell of an output table and re-renders the table in a Streamlit placeholder,
+    so partial answers show up while the model is still generating.
+
+    The table is the same dictionary of columns to rows that the pages pass to `st.table`.
+    """
+
+    def __init__(self, placeholder: Any, table: Dict[str, Dict[str, str]], column: str, row: str, refresh_interval: float = 0.1,
+        idle_interval: float = 1.0):
+        """
+        :param placeholder: Streamlit placeholder (`st.empty()`) the table is rendered into.
+        :param table: Output table, a dictionary of columns to dictionaries of rows to cell text.
+        :param column: Column of the cell the tokens are written to.
+        :param row: Row of the cell the tokens are written to.
+        :param refresh_interval: Minimum number of seconds between two renders of the table.
+        :param idle_interval: Number of seconds after which `refresh` renders the table even if it did not change.
+        """
+        self.placeholder = placeholder
+        self.table = table
+        self.column = column
+        self.row = row
+        self.refresh_interval = refresh_interval
+        self.idle_interval = idle_interval
+        self._last_render = 0.0
+        self._rendered: Dict[str, Dict[str, str]] = {}
+        self.table.setdefault(column, {}).setdefault(row, "")
+
+    def __call__(self, token_received: str, **kwargs) -> str:
+        self.table[self.column][self.row] += token_received
+        now = time.monotonic()
+        if now - self._last_render >= self.refresh_interval:
+            self.render()
+            self._last_render = now
+        return token_received
+
+    def __deepcopy__(self, memo: Dict[int, Any]) -> "TableStreamingHandler":
+        # Haystack deep-copies the params of every node run. A copy would write into a copy of the table, and Streamlit
+        # placeholders cannot be copied at all, so the handler is shared as it is.
+        return self
+
+    def refresh(self):
+        """
+        Heartbeat for run_request: called from the script thread while the answers generate. Renders the table if it
+        changed, at most every `refresh_interval` seconds, and otherwise every `idle_interval` seconds, since it is the
+        Streamlit call through which a rerun stops the script.
+        """
+        interval = self.refresh_interval if self.table != self._rendered else self.idle_interval
+        now = time.monotonic()
+        if now - self._last_render >= interval:
+            self.render()
+            self._last_render = now
+
+    def render(self):
+        self._rendered = {column: dict(rows) for column, rows in self.table.items()}
+        self.placeholder.table(self.table)
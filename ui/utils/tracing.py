@@ -0,0 +1,194 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+# Upper bounds of the histogram buckets of the stage durations, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+
+
+class Trace:
+    """
+    Timings of the stages of a single request, such as retrieval, prefill and decode.
+
+    Stages are recorded from whichever thread runs them, so a trace can follow a request through the thread pools.
+    """
+
+    def __init__(self, name: str, **attributes: Any):
+        self.name = name
+        self.attributes = attributes
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self.stages: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str, **attributes: Any) -> Iterator[Dict[str, Any]]:
+        """
+        Times the block as a stage. Yields the stage record, so the block can add attributes such as token counts.
+        """
+        record = {"stage": name, **attributes}
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            self.add_record(record)
+
+    def add(self, name: str, seconds: float, **attributes: Any):
+        """
+        Records a stage that was timed elsewhere.
+        """
+        self.add_record({"stage": name, **attributes, "seconds": seconds})
+
+    def add_record(self, record: Dict[str, Any]):
+        with self._lock:
+            self.stages.append(record)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            stages = [dict(s) for s in self.stages]
+        return {
+            "name": self.name,
+            **self.attributes,
+            "started": self.started,
+            "total_seconds": time.perf_counter() - self._start,
+            "stages": stages,
+        }
+
+
+_local = threading.local()
+
+
+def current() -> Optional[Trace]:
+    """
+    The trace that is active in this thread, if any.
+    """
+    return getattr(_local, "trace", None)
+
+
+@contextmanager
+def activate(trace: Optional[Trace]) -> Iterator[Optional[Trace]]:
+    """
+    Makes `trace` the active trace of this thread for the duration of the block.
+    """
+    previous = current()
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+@contextmanager
+def stage(name: str, **attributes: Any) -> Iterator[Dict[str, Any]]:
+    """
+    Times the block as a stage of the active trace. Without an active trace, the block runs untimed.
+    """
+    trace = current()
+    if trace is None:
+        yield {}
+        return
+    with trace.stage(name, **attributes) as record:
+        yield record
+
+
+class TraceExporter:
+    """
+    Aggregates finished traces into per-stage histograms, served in the Prometheus text format, and optionally
+    appends every trace to a JSON-lines log.
+    """
+
+    def __init__(self, log_path: Optional[str] = None):
+        self.log_path = log_path
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, Dict[str, Any]] = {}
+        self._tokens: Dict[str, int] = {}
+        self._traces = 0
+        self._metrics: List[Tuple[str, str, str, str, Callable[[], Dict[str, float]]]] = []
+
+    def add_metric(self, name: str, kind: str, help: str, label: str, collect: Callable[[], Dict[str, float]]):
+        """
+        Adds a metric that is not derived from traces, such as the counters of a cache, to the Prometheus text.
+
+        :param name: Name of the metric.
+        :param kind: Prometheus type of the metric, "counter" or "gauge".
+        :param help: Description of the metric.
+        :param label: Name of the label the values are told apart by.
+        :param collect: Function returning the value of the metric for every value of the label, called on every scrape.
+        """
+        self._metrics.append((name, kind, help, label, collect))
+
+    def export(self, trace: Trace):
+        data = trace.to_dict()
+        with self._lock:
+            self._traces += 1
+            for record in data["stages"]:
+                histogram = self._histograms.setdefault(record["stage"], {"buckets": [0] * len(BUCKETS), "count": 0, "sum": 0.0})
+                histogram["count"] += 1
+                histogram["sum"] += record["seconds"]
+                for i, bound in enumerate(BUCKETS):
+                    if record["seconds"] <= bound:
+                        histogram["buckets"][i] += 1
+                if "tokens" in record:
+                    self._tokens[record["stage"]] = self._tokens.get(record["stage"], 0) + record["tokens"]
+            if self.log_path:
+                with open(self.log_path, "a") as f:
+                    f.write(json.dumps(data, default=str) + "\n")
+
+    def prometheus(self) -> str:
+        """
+        Renders the aggregated stage timings in the Prometheus text exposition format.
+        """
+        lines = [
+            "# HELP promptbox_traces_total Number of traced requests.",
+            "# TYPE promptbox_traces_total counter",
+            "# HELP promptbox_stage_seconds Duration of the stages of a request.",
+            "# TYPE promptbox_stage_seconds histogram",
+        ]
+        with self._lock:
+            lines.insert(2, f"promptbox_traces_total {self._traces}")
+            for name, histogram in sorted(self._histograms.items()):
+                for bound, count in zip(BUCKETS, histogram["buckets"]):
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'promptbox_stage_seconds_bucket{{stage="{name}",le="{le}"}} {count}')
+                lines.append(f'promptbox_stage_seconds_sum{{stage="{name}"}} {histogram["sum"]}')
+                lines.append(f'promptbox_stage_seconds_count{{stage="{name}"}} {histogram["count"]}')
+            lines.append("# HELP promptbox_stage_tokens_total Tokens processed by the prefill and decode stages.")
+            lines.append("# TYPE promptbox_stage_tokens_total counter")
+            for name, tokens in sorted(self._tokens.items()):
+                lines.append(f'promptbox_stage_tokens_total{{stage="{name}"}} {tokens}')
+        for name, kind, help, label, collect in self._metrics:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for value, metric in sorted(collect().items()):
+                lines.append(f'{name}{{{label}="{value}"}} {metric}')
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        """
+        Serves the Prometheus text on http://host:port/metrics from a background thread. Only on the loopback interface by
+        default, pass host="0.0.0.0" to serve it on every interface.
+        """
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") != "/metrics":
+                    self.send_error(404)
+                    return
+                body = exporter.prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
@@ -1,66 +1,291 @@
 from utils.llamalayer import LlamaCPPInvocationLayer
+from utils.registry import ModelRegistry
+from utils.startup import ModelStartup, prefault
+from utils.workers import LlamaCPPWorkerInvocationLayer
+from utils.answer_cache import AnswerCache
+from utils.semantic_cache import SemanticAnswerCache
+from utils.bm25store import NumpyBM25DocumentStore
+from utils.hybrid import HybridRetriever
+from utils.retrieval_cache import CachingRetriever, RetrievalCache
+from utils.catalog import DocumentCatalog, elasticsearch_catalog
+from utils.ingestion import IngestionQueue
+from utils.api_client import AsyncHaystackClient, HaystackClient, HealthMonitor
+from utils.singleflight import SingleFlight
+from utils.packing import count_prompt_tokens, model_token_limits, pack_documents
+from utils.mapreduce import MapReduce, chunk_groups
+from utils.tracing import Trace, TraceExporter
+from utils import tracing
+from utils import cancellation
+from utils.cancellation import GenerationCancelled, RunRegistry, run_cancellable
+import asyncio
 import os
+import tempfile
 
+import hashlib
+import json
 import logging
-from time import sleep
+import math
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import requests
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 from haystack import Pipeline
 from haystack.document_stores import ElasticsearchDocumentStore
 from haystack.nodes import BM25Retriever, EmbeddingRetriever
 from haystack.nodes import  PromptNode, PromptTemplate,AnswerParser,PromptModel,PromptModelInvocationLayer
+from haystack.nodes import FileTypeClassifier, TextConverter, PDFToTextConverter, DocxToTextConverter, PreProcessor
 from elasticsearch import Elasticsearch
 
 model_path = "../hf/"
 
 from haystack.schema import Document
 
-#@st.cache_resource
-def load_models(models=['flan-t5-base']):
-    """ Load model and store it in cache. If a different model is loaded, we overwrite the old model.
-
-    Takes a list of models as an input, *however*, until this code has been refactored the input list should contain only one model.
-    """
-    models = dict.fromkeys(models,'')
-    cpp_models = {'llama-cpp':'llama2-7b/Llama-2-7B-Chat-GGML/llama-2-7b-chat.ggmlv3.q4_1.bin','nous':'nous/nous-hermes-llama-2-7b.ggmlv3.q3_K_M.bin'}
-    for model in models:
-        print("-----------------------------")
-        print(model)
-        if model in cpp_models.keys():
-            print("LLAMA")
-            models[model] = PromptModel(model_name_or_path="../llama.cpp/models/"+cpp_models[model],invocation_layer_class=LlamaCPPInvocationLayer,model_kwargs={'max_context':4096})
+# Paths of the GGML models that are served through the llama.cpp invocation layer, relative to ../llama.cpp/models/
+cpp_models = {'llama-cpp':'llama2-7b/Llama-2-7B-Chat-GGML/llama-2-7b-chat.ggmlv3.q4_1.bin','nous':'nous/nous-hermes-llama-2-7b.ggmlv3.q3_K_M.bin'}
+
+# Small GGML model with the llama tokenizer, relative to ../llama.cpp/models/, that drafts tokens for the llama.cpp models above.
+# When set, the llama.cpp models decode greedily with speculative decoding, SPECULATIVE_TOKENS drafted tokens at a time.
+LLAMA_DRAFT_MODEL = os.getenv("LLAMA_DRAFT_MODEL")
+SPECULATIVE_TOKENS = int(os.getenv("SPECULATIVE_TOKENS", "4"))
+cpp_draft_models = {name: LLAMA_DRAFT_MODEL for name in cpp_models} if LLAMA_DRAFT_MODEL else {}
+
+# How the llama.cpp weights are held in memory: memory-mapped from the page cache, and locked in RAM so they cannot be swapped out
+LLAMA_USE_MMAP = os.getenv("LLAMA_USE_MMAP", "1") == "1"
+LLAMA_USE_MLOCK = bool(os.getenv("LLAMA_USE_MLOCK"))
+
+# Evaluated prompt states each llama.cpp model keeps, so prompts starting with the same template and paragraphs skip prefilling them.
+# A state holds the KV cache of the prompt, about 0.5 MB per token for a 7B model, so the total size is bounded as well.
+LLAMA_PREFIX_CACHE_SLOTS = int(os.getenv("LLAMA_PREFIX_CACHE_SLOTS", "1"))
+LLAMA_PREFIX_CACHE_MB = int(os.getenv("LLAMA_PREFIX_CACHE_MB", "1024"))
+
+# Total size of the models kept in memory by the model registry. Unset means no limit.
+MODEL_MEMORY_BUDGET_GB = os.getenv("MODEL_MEMORY_BUDGET_GB")
+
+# Number of worker processes running each llama.cpp model. 0 runs the model inside the Streamlit process.
+LLAMA_WORKERS = int(os.getenv("LLAMA_WORKERS", "0"))
+# Maximum number of requests waiting for a llama worker before new ones are rejected
+LLAMA_QUEUE_DEPTH = int(os.getenv("LLAMA_QUEUE_DEPTH", "32"))
+# Seconds the background startup waits for the llama workers to load the model before reporting the model failed
+LLAMA_WORKER_START_TIMEOUT = float(os.getenv("LLAMA_WORKER_START_TIMEOUT", "600"))
+
+
+def _model_size(path):
+    """ Estimates the memory footprint of a model from the size of its weights on disk.
+    """
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+    return os.path.getsize(path)
+
+def _estimate_model_size(model):
+    """ Estimates the memory footprint of a model by name before it is loaded: the size of its weights on disk, plus the prefix caches
+    of a llama.cpp model.
+    """
+    size = sum(_model_size(path) for path in _model_paths(model))
+    if model in cpp_models and LLAMA_PREFIX_CACHE_SLOTS:
+        # Every process running the model can fill its prefix cache
+        size += LLAMA_PREFIX_CACHE_MB*2**20*max(1,LLAMA_WORKERS)
+    return size
+
+def _load_prompt_model(model):
+    """ Loads a single model by name. Used by the model registry, returns the PromptModel and its estimated size in bytes.
+    """
+    print("-----------------------------")
+    print(model)
+    size = _estimate_model_size(model)
+    if model in cpp_models.keys():
+        print("LLAMA")
+        path = "../llama.cpp/models/"+cpp_models[model]
+        layer_kwargs = {'max_context':4096,'use_mmap':LLAMA_USE_MMAP,'use_mlock':LLAMA_USE_MLOCK,
+                        'prefix_cache_slots':LLAMA_PREFIX_CACHE_SLOTS,'prefix_cache_bytes':LLAMA_PREFIX_CACHE_MB*2**20}
+        if model in cpp_draft_models:
+            draft_path = "../llama.cpp/models/"+cpp_draft_models[model]
+            layer_kwargs.update(draft_model_path=draft_path,speculative_tokens=SPECULATIVE_TOKENS)
+        if LLAMA_WORKERS > 0:
+            promptmodel = PromptModel(model_name_or_path=path,invocation_layer_class=LlamaCPPWorkerInvocationLayer,
+                                      model_kwargs={**layer_kwargs,'workers':LLAMA_WORKERS,'max_queue':LLAMA_QUEUE_DEPTH})
         else:
-            print("NON_LLAMA")
-            print(models)
-            new = PromptModel(model_name_or_path=model_path+model,model_kwargs={'task_name':'text2text-generation','trust_remote_code':True})
-            #models[model] = PromptModel(model_name_or_path=model_path+model,model_kwargs={'task_name':'text2text-generation','trust_remote_code':True})
-        print(models[model])
-        print("Successfully loaded " + model)
-    p = Pipeline()
-    print(p)
-    print(models)
+            promptmodel = PromptModel(model_name_or_path=path,invocation_layer_class=LlamaCPPInvocationLayer,model_kwargs=layer_kwargs)
+    else:
+        print("NON_LLAMA")
+        path = model_path+model
+        promptmodel = PromptModel(model_name_or_path=path,model_kwargs={'task_name':'text2text-generation','trust_remote_code':True})
+    print("Successfully loaded " + model)
+    return promptmodel, size
+
+@st.cache_resource
+def get_model_registry():
+    """ The model registry shared by all sessions of this process.
+    """
+    budget = int(float(MODEL_MEMORY_BUDGET_GB) * 2**30) if MODEL_MEMORY_BUDGET_GB else None
+    registry = ModelRegistry(_load_prompt_model, memory_budget=budget, estimate_size=_estimate_model_size)
+    # Cached pipelines hold on to their model, drop them so an evicted model is really freed
+    registry.on_evict(lambda name, model: invalidate_pipelines(model=model))
+    return registry
+
+def load_models(models=['flan-t5-base']):
+    """ Load models through the process-wide model registry. Models that are already loaded - by this or any other session - are reused,
+    and the least recently used models are unloaded when the memory budget is exceeded.
+
+    Takes a list of model names and returns a dictionary of model names and PromptModels. Hold on to a model with `lease_model`
+    while running a request on it, so it cannot be unloaded halfway.
+    """
+    registry = get_model_registry()
+    models = {model: registry.get(model) for model in models}
+    print(registry.stats())
     return models
 
+def lease_model(model):
+    """ Context manager that yields the PromptModel for a model name and keeps it loaded until the block exits.
+    """
+    return get_model_registry().lease(model)
+
+# Standard prompt of the pages
+DEFAULT_PROMPT_AT_STARTUP_P1 = os.getenv("DEFAULT_PROMPT_AT_STARTUP_P1","""Synthesize a comprehensive answer from the following given question and relevant paragraphs.
+Provide a clear and concise response that summarizes the key points and information presented in the paragraphs.
+Your answer should be in your own words and be no longer than necessary.
+\n\n Question: {query}
+\n\n Paragraphs: {join(documents)}  \n\n Answer:""")
+
+# Background startup of the models: the weights are read into the page cache before a memory-mapped model is created (unless it
+# is mlocked, which reads them anyway), and WARMUP_TOKENS tokens are generated from the standard prompt, so the first question finds
+# the template in the prefix cache. WARMUP_TOKENS=0 skips the warm-up generation.
+MODEL_PREFAULT = os.getenv("MODEL_PREFAULT", "1") == "1"
+WARMUP_TOKENS = int(os.getenv("WARMUP_TOKENS", "4"))
+WARMUP_QUERY = os.getenv("WARMUP_QUERY", "What are the restrictive policies on the Oil and Gas sectors?")
+
+def _model_paths(model):
+    """ Paths of the weights of a model: the model file or directory, and the draft model of a llama.cpp model.
+    """
+    if model in cpp_models:
+        paths = ["../llama.cpp/models/"+cpp_models[model]]
+        if model in cpp_draft_models:
+            paths.append("../llama.cpp/models/"+cpp_draft_models[model])
+        return paths
+    return [model_path+model]
+
+def _prefault_model(model):
+    if not MODEL_PREFAULT or (model in cpp_models and (LLAMA_USE_MLOCK or not LLAMA_USE_MMAP)):
+        return
+    for path in _model_paths(model):
+        prefault(path)
+
+def _warm_up_model(model,promptmodel):
+    if WARMUP_TOKENS <= 0:
+        return
+    prompt = render_prompt(DEFAULT_PROMPT_AT_STARTUP_P1,WARMUP_QUERY,[])
+    pool = getattr(promptmodel.model_invocation_layer,"pool",None)
+    if pool is None:
+        promptmodel.invoke(prompt,max_tokens=WARMUP_TOKENS)
+        return
+    # Every llama worker process has its own caches to warm up, so each one gets its own warm-up request
+    workers = pool.wait_ready(timeout=LLAMA_WORKER_START_TIMEOUT)
+    if not workers:
+        raise RuntimeError("None of the llama workers started")
+    with ThreadPoolExecutor(max_workers=len(workers)) as executor:
+        for future in [executor.submit(promptmodel.invoke,prompt,max_tokens=WARMUP_TOKENS,worker=worker) for worker in workers]:
+            future.result()
+
+@st.cache_resource
+def get_model_startup():
+    """ Loads and warms up models in a background thread, shared by all sessions of this process.
+    """
+    return ModelStartup(get_model_registry(),prefault=_prefault_model,warm_up=_warm_up_model,on_trace=get_trace_exporter().export)
+
+def start_models(models):
+    """ Starts loading models in the background and returns right away. Questions asked before a model is loaded wait for it in
+    lease_model.
+    """
+    get_model_startup().start(models)
+
+def model_status(models):
+    """ Returns the startup state of the models - pending, loading, warming up, ready or failed - with the seconds spent per phase.
+    Models that were loaded without start_models are reported ready.
+    """
+    status = get_model_startup().status()
+    loaded = get_model_registry().loaded()
+    return {model: status.get(model, {"state": "ready" if model in loaded else "pending", "error": None, "phases": {}}) for model in models}
+
+# Generation kwargs of the QA node, also part of the answer cache key
+GENERATION_KWARGS = {"max_tokens":512}
+
+# Document store to search: "elasticsearch", or "bm25" for the embedded NumpyBM25DocumentStore saved to BM25_INDEX_PATH.
+# The embedded store indexes uploads itself, so it needs neither Elasticsearch nor the Haystack REST API.
+DOCUMENT_STORE = os.getenv("DOCUMENT_STORE", "elasticsearch")
+BM25_INDEX_PATH = os.getenv("BM25_INDEX_PATH", "bm25_index")
+
+# Retrieval: "bm25", or "hybrid" to merge BM25 with a local int8 vector index of EMBEDDING_MODEL embeddings by reciprocal rank fusion.
+# Hybrid retrieval needs DOCUMENT_STORE=bm25, the vector index is kept next to the BM25 index.
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "bm25")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "384"))
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+# Candidates fetched by each retriever before fusion, and clusters of the vector index scanned per query
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))
+VECTOR_N_PROBE = int(os.getenv("VECTOR_N_PROBE", "8"))
+
+@st.cache_resource
+def get_document_store():
+    """ The document store shared by all pipelines of this process. Its Elasticsearch client keeps a pool of connections,
+    so queries reuse open connections and the index checks only run once.
+    """
+    if RETRIEVAL_MODE == "hybrid" and DOCUMENT_STORE != "bm25":
+        raise ValueError("RETRIEVAL_MODE=hybrid needs the embedded document store, set DOCUMENT_STORE=bm25")
+    if DOCUMENT_STORE == "bm25":
+        embedding_dim = EMBEDDING_DIM if RETRIEVAL_MODE == "hybrid" else None
+        return NumpyBM25DocumentStore(path=BM25_INDEX_PATH,index="document",embedding_dim=embedding_dim,n_probe=VECTOR_N_PROBE)
+
+    return ElasticsearchDocumentStore(index="document",host='localhost') # Comment to change to embedding retrieval
+
+    # return ElasticsearchDocumentStore(index="document",host='localhost',embedding_dim=384) # Uncomment for embedding retrieval
+
+@st.cache_resource
+def get_embedding_retriever():
+    """ The embedding retriever of hybrid retrieval, shared by all pipelines of this process. Documents indexed before hybrid retrieval
+    was switched on are embedded when it is created.
+    """
+    document_store = get_document_store()
+    retriever = EmbeddingRetriever(document_store=document_store, embedding_model=EMBEDDING_MODEL, model_format="sentence_transformers",
+                                   top_k=HYBRID_CANDIDATES, batch_size=EMBEDDING_BATCH_SIZE)
+    document_store.update_embeddings(retriever,update_existing_embeddings=False,batch_size=EMBEDDING_BATCH_SIZE)
+    return retriever
+
+# Retrieval results kept in memory, and the seconds they are served for. Results are dropped as soon as a document is indexed
+# through Promptbox, the TTL covers documents indexed by other processes. 0 entries disables the cache.
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "2048"))
+RETRIEVAL_CACHE_TTL = float(os.getenv("RETRIEVAL_CACHE_TTL", "300"))
+
+@st.cache_resource
+def get_retrieval_cache():
+    """ The retrieval cache shared by all pipelines of this process.
+    """
+    return RetrievalCache(max_entries=RETRIEVAL_CACHE_SIZE,ttl=RETRIEVAL_CACHE_TTL)
+
 def build_ES_pipeline(promptmodel,prompt_text):
     """
     This function takes a promptmodel - preloaded from the load_models function and cached by Streamlit -
     and uses it to build a Pipeline that connects to an ElasticSearch DocumentStore,
     """
 
-    ESdocument_store = ElasticsearchDocumentStore(index="document",host='localhost') # Comment to change to embedding retrieval
-
-    # ESdocument_store = ElasticsearchDocumentStore(index="document",host='localhost',embedding_dim=384) # Uncomment for embedding retrieval
+    ESdocument_store = get_document_store()
 
     Retriever = BM25Retriever(document_store=ESdocument_store) # Comment to change to embedding retrieval
 
+    if RETRIEVAL_MODE == "hybrid":
+        Retriever = HybridRetriever(Retriever, get_embedding_retriever(), top_k=5, candidates=HYBRID_CANDIDATES)
+
+    if RETRIEVAL_CACHE_SIZE > 0:
+        Retriever = CachingRetriever(Retriever, get_retrieval_cache(), top_k=5)
+
     prompt = PromptTemplate(prompt_text=prompt_text,name="default")
 
     #Retriever = EmbeddingRetriever(document_store=ESdocument_store, embedding_model="sentence-transformers/all-MiniLM-L6-v2", model_format="sentence_transformers", top_k=5) # Uncomment for embedding retrieval
 
     print("Loading node")
-    prompt_node = PromptNode(promptmodel, default_prompt_template=prompt,model_kwargs={"max_tokens":512})
+    prompt_node = PromptNode(promptmodel, default_prompt_template=prompt,model_kwargs=GENERATION_KWARGS)
     prompt_node.debug = True
     print(prompt_node)
     print(prompt)
@@ -71,6 +296,44 @@ def build_ES_pipeline(promptmodel,prompt_text):
     ES_p.add_node(component=prompt_node, name="QA", inputs=["Retriever1"])
     return ES_p
 
+# Retriever settings that build_ES_pipeline uses, part of the pipeline cache key
+RETRIEVER_CONFIG = ("BM25Retriever", DOCUMENT_STORE, RETRIEVAL_MODE, "document")
+
+# Maximum number of built pipelines kept by get_ES_pipeline
+PIPELINE_CACHE_SIZE = int(os.getenv("PIPELINE_CACHE_SIZE", "32"))
+
+_pipelines = OrderedDict()
+_pipelines_lock = threading.Lock()
+
+def get_ES_pipeline(promptmodel,prompt_text):
+    """ Returns the pipeline for a model and prompt template, building it only if it is not cached yet.
+
+    Pipelines are cached per (model, prompt text, retriever config), least recently used first out. A changed prompt template
+    gets its own entry, the pipelines of other models and templates are left alone.
+    """
+    key = (promptmodel.model_name_or_path,prompt_text,RETRIEVER_CONFIG)
+    with _pipelines_lock:
+        if key in _pipelines:
+            _pipelines.move_to_end(key)
+            return _pipelines[key][1]
+
+    with tracing.stage("pipeline_build"):
+        p = build_ES_pipeline(promptmodel,prompt_text)
+
+    with _pipelines_lock:
+        _pipelines[key] = (promptmodel,p)
+        while len(_pipelines) > PIPELINE_CACHE_SIZE:
+            _pipelines.popitem(last=False)
+    return p
+
+def invalidate_pipelines(model=None,prompt_text=None):
+    """ Drops the cached pipelines built for the given model and/or prompt text. Without arguments, drops all of them.
+    """
+    with _pipelines_lock:
+        for key,(promptmodel,_) in list(_pipelines.items()):
+            if (model is None or promptmodel is model) and (prompt_text is None or key[1] == prompt_text):
+                del _pipelines[key]
+
 def check_sentiment(query,model,in_docs,prompt_text):
     """
     This function takes a query and assesses whether the output suggests 'yes', 'no', or 'n/a'. The prompt_text should be geared towards giving 'yes.', 'no.', or'na.' as an output.
@@ -94,7 +357,14 @@ def check_sentiment(query,model,in_docs,prompt_text):
     through_docs = []
     answers=[]
     for j in in_docs:
-        answer = p2.run(query=query,params={"QA":{"documents":[Document(j['Answer'])]}})
+        cancellation.raise_if_cancelled()
+        docs = [Document(j['Answer'])]
+        trace = Trace("check_sentiment",model=model.model_name_or_path,query=query,document=j['Document'])
+        with tracing.activate(trace):
+            answer = _generate_cached(model,prompt_text,{},query,docs,[j['Document']],
+                                      lambda: p2.run(query=query,params={"QA":{"documents":docs}}))
+        get_trace_exporter().export(trace)
+        answer = {**answer,"trace":trace.to_dict()}
         answers.append(answer)
         if r"no." in answer['results'][0].lower():
             documents[j['Document']] = 'No'
@@ -106,6 +376,54 @@ def check_sentiment(query,model,in_docs,prompt_text):
     print(documents)
     return documents,answers,through_docs
 
+# Spellings of the labels that classify_sentiment scores
+SENTIMENT_LABELS = {'Yes':['yes','Yes','YES'],'No':['no','No','NO'],'N/a':['na','Na','NA','n/a','N/A']}
+
+def classify_sentiment(query,model,in_docs,prompt_text,calibrate=True):
+    """
+    Classification mode of check_sentiment: instead of generating an answer and looking for 'no.' or 'na.' in it, the labels are scored
+    directly from the next-token probabilities of the llama model, with one forward pass per document and no sampling.
+
+    Outputs the same dictionary of document names and labels, list of answers and list of document names where the answer was 'no' as
+    check_sentiment, plus a list with the label probabilities per document. Each answer holds the chosen label as its result and the probabilities.
+
+    Parameters
+    - query: the query to give a yes/no answer to
+    - model: the model to use, as loaded in load_models above. Has to be a llama.cpp model.
+    - in_docs: a dictionary of document names and corresponding text snippets to check for a yes/no answer
+    - prompt_text: the prompt template text to use
+    - calibrate: if True, the probabilities are calibrated against those for an empty document, which removes the bias of the model and
+    template towards one of the labels
+    """
+    layer = model.model_invocation_layer
+    if not hasattr(layer,'score_labels'):
+        raise ValueError(f"Scoring labels requires a llama.cpp model, {model.model_name_or_path} is not one")
+
+    prompts = [model._ensure_token_limit(render_prompt(prompt_text,query,[Document(j['Answer'])])) for j in in_docs]
+    if calibrate:
+        prompts.append(render_prompt(prompt_text,query,[Document("N/A")]))
+    scores = layer.score_labels(prompts,SENTIMENT_LABELS)
+
+    probabilities = [{label:math.exp(score) for label,score in s.items()} for s in scores]
+    if calibrate:
+        prior = probabilities.pop()
+        for p in probabilities:
+            total = sum(p[label]/prior[label] for label in p)
+            for label in p:
+                p[label] = p[label]/prior[label]/total
+
+    documents = {}
+    through_docs = []
+    answers=[]
+    for j,p in zip(in_docs,probabilities):
+        label = max(p,key=p.get)
+        answers.append({'query':query,'results':[label],'probabilities':p})
+        documents[j['Document']] = label
+        if label == 'No':
+            through_docs.append(j['Document'])
+    print(documents)
+    return documents,answers,through_docs,probabilities
+
 
 
 API_ENDPOINT = os.getenv("API_ENDPOINT", "http://localhost:8000")
@@ -116,18 +434,44 @@ DOC_FEEDBACK = "feedback"
 DOC_UPLOAD = "file-upload"
 
 
+# Timeouts and retries of the REST API client
+API_TIMEOUT = float(os.getenv("API_TIMEOUT", "10"))
+API_UPLOAD_TIMEOUT = float(os.getenv("API_UPLOAD_TIMEOUT", "300"))
+API_RETRIES = int(os.getenv("API_RETRIES", "3"))
+
+@st.cache_resource
+def get_api_client():
+    """ The REST API client shared by all sessions of this process, keeping a pool of connections to API_ENDPOINT.
+    """
+    return HaystackClient(API_ENDPOINT,timeout=API_TIMEOUT,upload_timeout=API_UPLOAD_TIMEOUT,retries=API_RETRIES,
+                          pool_size=max(10,INGESTION_WORKERS))
+
+def get_async_api_client(concurrency=8):
+    """ Asyncio variant of the REST API client, for bulk calls such as uploading a directory of files.
+    """
+    return AsyncHaystackClient(get_api_client(),concurrency=concurrency)
+
+@st.cache_resource
+def get_health_monitor():
+    """ Polls the readiness of the REST API in the background, for all sessions of this process.
+    """
+    return HealthMonitor(get_api_client())
+
 def haystack_is_ready():
     """
     Used to show the "Haystack is loading..." message
+
+    Returns the readiness last seen by the health monitor, without a request. Only the first call waits briefly for the first check.
     """
-    url = f"{API_ENDPOINT}/{STATUS}"
-    try:
-        if requests.get(url).status_code < 400:
-            return True
-    except Exception as e:
-        logging.exception(e)
-        sleep(1)  # To avoid spamming a non-existing endpoint at startup
-    return False
+    if DOCUMENT_STORE == "bm25":
+        # Queries and uploads do not go through the REST API
+        return True
+    monitor = get_health_monitor()
+    ready = monitor.ready(wait=1)
+    if not ready:
+        # Check again soon, the user is waiting for it
+        monitor.check_now()
+    return ready
 
 
 @st.cache_data
@@ -135,77 +479,577 @@ def haystack_version():
     """
     Get the Haystack version from the REST API
     """
-    url = f"{API_ENDPOINT}/{HS_VERSION}"
-    return requests.get(url, timeout=0.1).json()["hs_version"]
+    return get_api_client().version()
 
-def fetch_docs(store="ES"):
-    """
-    Fetches the names of files in the document store.
+# How long the list of documents is cached, and how many names are fetched per Elasticsearch request
+DOCUMENT_CATALOG_TTL = float(os.getenv("DOCUMENT_CATALOG_TTL", "300"))
+DOCUMENT_CATALOG_PAGE_SIZE = int(os.getenv("DOCUMENT_CATALOG_PAGE_SIZE", "1000"))
+ES_HOST = os.getenv("ES_HOST", "http://localhost:9200")
+WEAVIATE_URL = os.getenv("WEAVIATE_URL", "http://localhost:8080")
+
+@st.cache_resource
+def get_es_client():
+    """ The Elasticsearch client shared by all sessions of this process, keeping a pool of open connections.
     """
-    if store == "Weaviate":
-        client = weaviate.Client(
-        url = "http://localhost:8080",  # Replace with your endpoint
-        )
+    return Elasticsearch(hosts=ES_HOST)
+
+def _weaviate_catalog():
+    try:
+        import weaviate
+    except ImportError:
+        raise ImportError("Listing the documents in Weaviate requires the weaviate-client package: pip install weaviate-client")
+
+    client = weaviate.Client(
+    url = WEAVIATE_URL,
+    )
 
-        result = (
-        client.query
-        .aggregate('Document')
-        .with_group_by_filter(['name'])
-        .with_fields('groupedBy { value }')
-        .do()
-            )
+    result = (
+    client.query
+    .aggregate('Document')
+    .with_group_by_filter(['name'])
+    .with_fields('groupedBy { value } meta { count }')
+    .do()
+        )
 
-        docs = [x['groupedBy']['value'] for x in result['data']['Aggregate']['Document']]
+    return {x['groupedBy']['value']:{'chunks':x['meta']['count'],'uploaded_at':None} for x in result['data']['Aggregate']['Document']}
 
-    if store == "ES":
-        es = Elasticsearch(hosts="http://localhost:9200")
+@st.cache_resource
+def get_document_catalog(store):
+    """ The document catalog of a store - "ES", "BM25" or "Weaviate" - shared by all sessions of this process.
+    """
+    if store == "BM25":
+        fetch = lambda: get_document_store().catalog()
+    elif store == "Weaviate":
+        fetch = _weaviate_catalog
+    elif store == "ES":
+        fetch = lambda: elasticsearch_catalog(get_es_client(),index="document",page_size=DOCUMENT_CATALOG_PAGE_SIZE)
+    else:
+        raise ValueError(f"Unknown document store {store}")
+    return DocumentCatalog(fetch,ttl=DOCUMENT_CATALOG_TTL)
 
-        body = {
-            "size": 0,
-            "aggs": {
-                "docs": {
-                    "terms": {
-                        "size": 100,
-                        "field": "name"
-                    }
-                }
-            }
-        }
+def _default_store():
+    return "BM25" if DOCUMENT_STORE == "bm25" else "ES"
 
-        result = es.search(index="document", body=body)
+def fetch_docs(store=None):
+    """
+    Fetches the names of files in the document store. Defaults to the store selected by DOCUMENT_STORE.
 
-        docs = [x['key'] for x in result['aggregations']['docs']['buckets']]
+    The names come from the document catalog, which is cached for DOCUMENT_CATALOG_TTL seconds and refreshed when a document is uploaded.
+    """
+    return get_document_catalog(store or _default_store()).names()
 
-    return docs
+def fetch_doc_metadata(store=None):
+    """
+    Fetches a dictionary of the names of files in the document store, and for each the number of paragraphs ('chunks') and the time
+    it was uploaded ('uploaded_at', in seconds since the epoch, None for files uploaded before upload times were recorded).
+    """
+    return get_document_catalog(store or _default_store()).metadata()
 
-def query_listed_documents(query,documents,model,prompt_text):
+def query_listed_documents(query,documents,model,prompt_text,stream_handler=None):
     """ Takes a query, list of documents, and a pipeline to run retrieval on the specified documents.
 
+    If a stream_handler (a Haystack TokenStreamingHandler) is given, the model streams its tokens to it while generating,
+    for each document in turn.
     """
+    output,det_output = query_listed_documents_batch([query],documents,model,prompt_text,stream_handlers=[stream_handler])[0]
+    print(output)
+    return output,det_output
+
+# Number of generations that run at the same time, and of concurrent retrievals when querying several documents
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", str(max(1, (os.cpu_count() or 1) // 4))))
+RETRIEVAL_WORKERS = int(os.getenv("RETRIEVAL_WORKERS", "8"))
+
+def _thread_pool(max_workers):
+    """ Thread pool whose threads are attached to the current Streamlit script run, so they can update the page.
+    """
+    ctx = get_script_run_ctx()
+    return ThreadPoolExecutor(max_workers=max_workers,initializer=lambda: add_script_run_ctx(threading.current_thread(),ctx))
+
+def query_listed_documents_batch(queries,documents,model,prompt_text,stream_handlers=None):
+    """ Runs a batch of queries against a list of documents, with a single pipeline.
+
+    The retrievals for a document - one per query - are sent to the document store in one `_msearch` request, and the documents are
+    retrieved in parallel. As soon as the paragraphs of a document are in, its answers are queued for generation on a bounded pool
+    of GENERATION_WORKERS, query by query, so consecutive prompts share the template header and the query.
+
+    Returns a list with an (output, det_output) tuple per query, as returned by query_listed_documents, in the order of the queries
+    and documents. A document that fails to retrieve or generate gets an error as its answer, without affecting the others.
+
+    Parameters
+    - queries: the list of queries to answer
+    - documents: the names of the documents to answer the queries for. If empty, the queries are answered from the top 5 paragraphs of all documents.
+    - model: the model to use, as loaded in load_models above
+    - prompt_text: the prompt template text to use
+    - stream_handlers: optional list with a TokenStreamingHandler (or None) per query. Tokens are only streamed when there is a single
+    document (or none), otherwise the answers of several documents would end up in the same cell.
+    """
+    stream_handlers = stream_handlers or [None] * len(queries)
+    # Cancelling the request of the calling thread stops the retrievals and generations running for it in the pools
+    token = cancellation.current()
 
-    output = []
-    det_output = []
+    # Stages shared by all answers of the batch are timed once, and copied into the trace of every answer
+    shared = Trace("batch")
+    with tracing.activate(shared):
+        p = get_ES_pipeline(model,prompt_text)
+    retriever = p.get_node("Retriever1")
 
-    p = build_ES_pipeline(model,prompt_text)
+    # Generate without running the retriever again
+    qa = Pipeline()
+    qa.add_node(component=p.get_node("QA"), name="QA", inputs=["Query"])
 
-    if len(documents)>0:
+    filters = [{'name':[j]} for j in documents] if len(documents)>0 else [None]
+    if len(filters)>1:
+        stream_handlers = [None] * len(queries)
 
-        for j in documents:
-            res = p.run(query=query,params={"Retriever1": {"top_k": 5,"filters":{'name':[j]}},"debug": True})
-            print(res)
-            out = {'Document':j,'Answer':res['results'][0].replace('<pad>',"")}
+    traces = {}
+    for i,query in enumerate(queries):
+        for k,f in enumerate(filters):
+            trace = traces[(i,k)] = Trace("query_listed_documents",model=model.model_name_or_path,query=query,
+                                          document=f['name'][0] if f is not None else None)
+            for record in shared.stages:
+                trace.add_record(dict(record))
+
+    def retrieve(k,f):
+        if token is not None:
+            token.raise_if_cancelled()
+        start = time.perf_counter()
+        retrieved = retriever.retrieve_batch(queries=queries,filters=[f]*len(queries),top_k=5)
+        # One _msearch request answers the retrieval for all queries
+        for i in range(len(queries)):
+            traces[(i,k)].add("retrieval",time.perf_counter()-start,documents=len(retrieved[i]),batched_queries=len(queries))
+        return retrieved
+
+    semantic_cache = get_semantic_cache()
+
+    def generate(query,docs,handler,trace,f):
+        with tracing.activate(trace), cancellation.activate(token):
+            cancellation.raise_if_cancelled()
+            if semantic_cache is not None:
+                scope = semantic_cache.make_scope(model.model_name_or_path,prompt_text,f['name'] if f is not None else None,GENERATION_KWARGS,
+                                                  paragraphs=[d.id for d in docs])
+                with tracing.stage("semantic_cache"):
+                    reused = semantic_cache.get(scope,query)
+                if reused is not None:
+                    if handler is not None and reused['results']:
+                        handler(reused['results'][0])
+                    return {"query":query,"documents":docs,"results":reused['results'],
+                            "semantic_cache":{"query":reused['query'],"similarity":reused['similarity']}}
+            docs,packing = pack_context(model,prompt_text,query,docs)
+            names = [d.meta.get('name','') for d in docs]
+            res = _generate_cached(model,prompt_text,GENERATION_KWARGS,query,docs,names,
+                                   lambda: qa.run(query=query,documents=docs,params={**_stream_params(handler),"debug": True}),
+                                   stream_handler=handler)
+            if semantic_cache is not None and "answer_cache" not in res and "single_flight" not in res:
+                semantic_cache.put(scope,query,res['results'],names)
+        res.setdefault("documents",docs)
+        res["packing"] = packing
+        return res
+
+    answers = {}
+    with _thread_pool(min(RETRIEVAL_WORKERS,len(filters))) as retrieval_pool, _thread_pool(GENERATION_WORKERS) as generation_pool:
+        retrievals = {retrieval_pool.submit(retrieve,k,f): k for k,f in enumerate(filters)}
+        for future in as_completed(retrievals):
+            k = retrievals[future]
+            try:
+                retrieved = future.result()
+            except GenerationCancelled:
+                raise
+            except Exception as e:
+                logging.exception(e)
+                for i,query in enumerate(queries):
+                    answers[(i,k)] = e
+                continue
+            for i,(query,handler) in enumerate(zip(queries,stream_handlers)):
+                answers[(i,k)] = generation_pool.submit(generate,query,retrieved[i],handler,traces[(i,k)],filters[k])
+
+    exporter = get_trace_exporter()
+    results = []
+    for i,query in enumerate(queries):
+        output = []
+        det_output = []
+        for k,f in enumerate(filters):
+            answer = answers[(i,k)]
+            trace = traces[(i,k)]
+            try:
+                if isinstance(answer,Exception):
+                    raise answer
+                res = answer.result()
+                with trace.stage("postprocess"):
+                    text = res['results'][0].replace('<pad>',"")
+                    if "semantic_cache" in res:
+                        text = mark_reused(text,res['semantic_cache'])
+            except GenerationCancelled:
+                raise
+            except Exception as e:
+                logging.exception(e)
+                res = {"query":query,"error":str(e)}
+                text = f"Error: {e}"
+            if f is not None:
+                out = {'Document':f['name'][0],'Answer':text}
+            else:
+                out = {'Documents':'','Answer':text}
             output.append(out)
+            exporter.export(trace)
+            res["trace"] = trace.to_dict()
             det_output.append(res)
-    else:
-        res = p.run(query=query,params={"Retriever1": {"top_k": 5,"debug": True}})
-        out = {'Documents':'','Answer':res['results'][0].replace('<pad>',"")}
-        output.append(out)
-        det_output.append(res)
-    print(output)
-    return output,det_output
+        results.append((output,det_output))
+    return results
+
+# Location and limits of the persistent answer cache
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", "answer_cache.db")
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "10000"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", str(7 * 24 * 3600)))
+
+@st.cache_resource
+def get_answer_cache():
+    """ The answer cache shared by all sessions of this process.
+    """
+    return AnswerCache(ANSWER_CACHE_PATH,max_entries=ANSWER_CACHE_MAX_ENTRIES,ttl=ANSWER_CACHE_TTL)
+
+# Reuse of answers to similar questions, off unless SEMANTIC_CACHE_THRESHOLD is set. The threshold is the minimum cosine similarity
+# between the EMBEDDING_MODEL embeddings of two questions about the same documents, with the same model and template.
+SEMANTIC_CACHE_THRESHOLD = os.getenv("SEMANTIC_CACHE_THRESHOLD")
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", "semantic_cache.db")
+
+@st.cache_resource
+def get_query_embedder():
+    """ Function embedding a list of questions with EMBEDDING_MODEL. Reuses the model of hybrid retrieval if it is loaded anyway.
+    """
+    if RETRIEVAL_MODE == "hybrid":
+        return get_embedding_retriever().embed_queries
+    from sentence_transformers import SentenceTransformer
+    encoder = SentenceTransformer(EMBEDDING_MODEL)
+    return lambda queries: encoder.encode(queries,convert_to_numpy=True)
+
+@st.cache_resource
+def get_semantic_cache():
+    """ The cache of answers to similar questions shared by all sessions of this process, or None if it is off.
+    """
+    if not SEMANTIC_CACHE_THRESHOLD:
+        return None
+    return SemanticAnswerCache(SEMANTIC_CACHE_PATH,get_query_embedder(),threshold=float(SEMANTIC_CACHE_THRESHOLD),
+                               max_entries=ANSWER_CACHE_MAX_ENTRIES,ttl=ANSWER_CACHE_TTL)
+
+def mark_reused(text,reused):
+    """ Marks an answer that was reused from a similar question, so readers know it answers that question.
+    """
+    return f"♻️ {text}\n\n(Reused answer to the similar question \"{reused['query']}\", similarity {reused['similarity']:.2f})"
+
+def render_prompt(prompt_text,query,documents):
+    """ Fills the prompt template the same way the PromptNode does, and returns the prompt the model gets to see.
+    """
+    with tracing.stage("prompt_render",documents=len(documents)):
+        return next(PromptTemplate(prompt_text=prompt_text,name="default").fill(query=query,documents=documents))
+
+def pack_context(model,prompt_text,query,documents):
+    """ Fits the retrieved documents into the context of the model, before the prompt is rendered.
+
+    The tokens left for the documents are the context length, minus the answer length and the tokens of the template and query - counted
+    the way the model counts the prompt for its token limit, with a small margin. The highest scoring documents that fit are kept, so the
+    question and the 'Answer:' cue at the end of the template are never cut off.
+
+    Returns the kept documents and a dictionary for the debug output describing the budget and the dropped documents.
+    """
+    limits = model_token_limits(model,GENERATION_KWARGS)
+    if limits is None:
+        return documents,{}
+    count_tokens,context_length,answer_length = limits
+    template = render_prompt(prompt_text,query,[])
+    with tracing.stage("tokenize",documents=len(documents)):
+        scaffold = count_prompt_tokens(model,template,count_tokens)
+        budget = max(0,context_length-answer_length-scaffold)
+        kept,dropped = pack_documents(documents,budget,count_tokens)
+    if dropped:
+        logging.warning("Dropped %s of %s documents that do not fit in the %s tokens left for documents",len(dropped),len(documents),budget)
+    return kept,{"budget":budget,"template_tokens":scaffold,"answer_tokens":answer_length,"dropped":dropped}
+
+def context_budget(model,prompt_text,query):
+    """ Returns the token counter of a model and the number of tokens left for documents in a prompt, or None if the token
+    limits of the model are not known.
+    """
+    limits = model_token_limits(model,GENERATION_KWARGS)
+    if limits is None:
+        return None
+    count_tokens,context_length,answer_length = limits
+    return count_tokens,max(0,context_length-answer_length-count_prompt_tokens(model,render_prompt(prompt_text,query,[]),count_tokens))
+
+# Map-reduce answering from all documents: the number of paragraphs retrieved, and the prompt merging partial answers
+MAP_REDUCE_TOP_K = int(os.getenv("MAP_REDUCE_TOP_K", "40"))
+REDUCE_PROMPT = os.getenv("REDUCE_PROMPT", """Combine the following partial answers to the question into one comprehensive answer.
+Keep every relevant point, leave out repetitions and partial answers saying the paragraphs do not answer the question.
+\n\n Question: {query}
+\n\n Partial answers: {join(documents)}  \n\n Answer:""")
+
+def query_all_documents(query,model,prompt_text,stream_handler=None,on_partial=None):
+    """ Answers a query from the MAP_REDUCE_TOP_K best paragraphs of all documents, more than fit in a single prompt.
+
+    The paragraphs are grouped by document, and split into chunk groups that fit in the context of the model. The map step answers
+    the query from every chunk group with prompt_text, GENERATION_WORKERS groups at a time, and the reduce step merges the partial
+    answers with REDUCE_PROMPT until one answer is left. Only the final answer is streamed to the stream_handler; on_partial gets a
+    dictionary with the level, documents and answer of every partial answer as soon as it is in.
+
+    Returns (output, det_output) like query_listed_documents, the partial answers are under 'partials' in the detailed output.
+    """
+    trace = Trace("query_all_documents",model=model.model_name_or_path,query=query,document=None)
+    token = cancellation.current()
+    with tracing.activate(trace):
+        p = get_ES_pipeline(model,prompt_text)
+        reduce_p = get_ES_pipeline(model,REDUCE_PROMPT)
+        with tracing.stage("retrieval") as record:
+            docs = p.get_node("Retriever1").retrieve(query=query,top_k=MAP_REDUCE_TOP_K)
+            record["documents"] = len(docs)
+        limits = context_budget(model,prompt_text,query)
+        if limits is not None:
+            count_tokens,budget = limits
+            reduce_budget = context_budget(model,REDUCE_PROMPT,query)[1]
+        else:
+            # Without known token limits, every document is a group of its own and all partial answers are merged at once
+            count_tokens,budget,reduce_budget = (lambda text: 0),float("inf"),float("inf")
+        groups = chunk_groups(docs,budget,count_tokens)
+
+    def answerer(pipeline,template):
+        qa = Pipeline()
+        qa.add_node(component=pipeline.get_node("QA"), name="QA", inputs=["Query"])
+
+        def answer(group,handler):
+            with tracing.activate(trace), cancellation.activate(token):
+                cancellation.raise_if_cancelled()
+                group,_ = pack_context(model,template,query,group)
+                names = [name for d in group for name in d.meta.get('name','').split(', ')]
+                res = _generate_cached(model,template,GENERATION_KWARGS,query,group,names,
+                                       lambda: qa.run(query=query,documents=group,params={**_stream_params(handler),"debug": True}),
+                                       stream_handler=handler)
+            return res['results'][0].replace('<pad>',"")
+        return answer
+
+    try:
+        with _thread_pool(GENERATION_WORKERS) as pool:
+            map_reduce = MapReduce(answerer(p,prompt_text),answerer(reduce_p,REDUCE_PROMPT),reduce_budget,count_tokens,
+                                   pool,on_partial=on_partial)
+            text,partials = map_reduce.run(groups,stream_handler=stream_handler)
+        res = {"query":query,"documents":docs,"results":[text],"partials":partials}
+    except GenerationCancelled:
+        raise
+    except Exception as e:
+        logging.exception(e)
+        text = f"Error: {e}"
+        res = {"query":query,"error":str(e)}
+    get_trace_exporter().export(trace)
+    res["trace"] = trace.to_dict()
+    return [{'Documents':'','Answer':text}],[res]
+
+@st.cache_resource
+def get_run_registry():
+    """ The cancellation tokens of the requests running for every browser session of this process.
+    """
+    return RunRegistry()
+
+def _session_id():
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else None
+
+def cancel_request():
+    """ Cancels the request running for the current browser session, if any. The pages call it when the question or
+    prompt changes, so the answer to the old question stops generating.
+    """
+    return get_run_registry().cancel(_session_id())
+
+async def run_request_async(fn,*args,heartbeat=None,**kwargs):
+    """ Runs one of the query functions as the request of the current browser session, in a thread attached to the
+    script run. A new request of the same session cancels this one, as does cancel_request.
+
+    Streamlit stops a script for a rerun by raising from its next Streamlit call, so the heartbeat, called from the
+    script thread while waiting, should render something now and then - such as TableStreamingHandler.refresh. The rerun then
+    cancels the request, and generation stops within a token instead of running to the end for nobody. Requests waiting
+    for the model or for an identical generation of another session stop waiting as well.
+    """
+    key = _session_id()
+    ctx = get_script_run_ctx()
+    token = get_run_registry().begin(key)
+
+    def run(*args,**kwargs):
+        add_script_run_ctx(threading.current_thread(),ctx)
+        return fn(*args,**kwargs)
+
+    try:
+        return await run_cancellable(run,*args,token=token,heartbeat=heartbeat,**kwargs)
+    finally:
+        get_run_registry().finish(key,token)
+
+def run_request(fn,*args,heartbeat=None,**kwargs):
+    """ Runs run_request_async to completion, for the pages, whose scripts are not async.
+    """
+    return asyncio.run(run_request_async(fn,*args,heartbeat=heartbeat,**kwargs))
+
+async def query_listed_documents_async(query,documents,model,prompt_text,stream_handler=None,heartbeat=None):
+    """ Cancellable version of query_listed_documents, see run_request_async.
+    """
+    return await run_request_async(query_listed_documents,query,documents,model,prompt_text,stream_handler=stream_handler,heartbeat=heartbeat)
+
+async def query_listed_documents_batch_async(queries,documents,model,prompt_text,stream_handlers=None,heartbeat=None):
+    """ Cancellable version of query_listed_documents_batch, see run_request_async.
+    """
+    return await run_request_async(query_listed_documents_batch,queries,documents,model,prompt_text,stream_handlers=stream_handlers,heartbeat=heartbeat)
+
+async def query_all_documents_async(query,model,prompt_text,stream_handler=None,on_partial=None,heartbeat=None):
+    """ Cancellable version of query_all_documents, see run_request_async.
+    """
+    return await run_request_async(query_all_documents,query,model,prompt_text,stream_handler=stream_handler,on_partial=on_partial,heartbeat=heartbeat)
+
+async def check_sentiment_async(query,model,in_docs,prompt_text,heartbeat=None):
+    """ Cancellable version of check_sentiment, see run_request_async.
+    """
+    return await run_request_async(check_sentiment,query,model,in_docs,prompt_text,heartbeat=heartbeat)
+
+@st.cache_resource
+def get_single_flight():
+    """ Coalesces identical generations running at the same time, across all sessions of this process.
+    """
+    return SingleFlight()
+
+# Per-request stage timings: appended as JSON lines to TRACE_LOG_PATH, and served in the Prometheus text format on
+# http://METRICS_HOST:METRICS_PORT/metrics. Both are off when unset. The metrics are only served on the loopback interface unless
+# METRICS_HOST is set, for instance to 0.0.0.0 for a Prometheus server on another machine.
+TRACE_LOG_PATH = os.getenv("TRACE_LOG_PATH")
+METRICS_PORT = os.getenv("METRICS_PORT")
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+@st.cache_resource
+def get_trace_exporter():
+    """ The trace exporter shared by all sessions of this process, serving the metrics endpoint if METRICS_PORT is set.
+    """
+    exporter = TraceExporter(log_path=TRACE_LOG_PATH)
+    exporter.add_metric("promptbox_single_flight_total","counter","Generations that ran, and identical ones that shared their answer.",
+                        "outcome",lambda: {k: v for k,v in get_single_flight().stats().items() if k != "in_flight"})
+    if METRICS_PORT:
+        exporter.serve(int(METRICS_PORT),host=METRICS_HOST)
+    return exporter
+
+def stage_timings(detailed_output):
+    """ Flattens the traces in a detailed output - a dictionary of models, questions and lists of pipeline results - into
+    one row per stage, for the stage timings table of the "Detailed output" tab.
+    """
+    rows = []
+    for model,questions in detailed_output.items():
+        for question,results in questions.items():
+            for res in results:
+                trace = res.get('trace')
+                if not trace:
+                    continue
+                for record in trace['stages']:
+                    rows.append({'Model':model,'Question':question,'Document':trace.get('document') or 'All',
+                                 'Stage':record['stage'],'ms':round(record['seconds']*1000,1),'Tokens':record.get('tokens')})
+    return rows
+
+def _generate_cached(model,prompt_text,generation_kwargs,query,documents,names,run,stream_handler=None):
+    """ Returns the cached answer for a prompt if there is one, otherwise calls `run` to generate it and caches the result.
+
+    If the same prompt is already being generated for the same model and generation kwargs - typically another session running the
+    default questions - this waits for that generation and shares its answer instead of generating it again.
+
+    Parameters
+    - model: the PromptModel that generates the answer
+    - prompt_text: the prompt template text
+    - generation_kwargs: generation kwargs of the PromptNode
+    - query, documents: what the prompt is rendered from
+    - names: names of the documents, so the answer can be invalidated when one of them is uploaded again
+    - run: function running the PromptNode, returning the pipeline result
+    - stream_handler: gets the whole answer at once on a cache hit or when the answer is shared
+    """
+    cache = get_answer_cache()
+    key = cache.make_key(model.model_name_or_path,render_prompt(prompt_text,query,documents),[d.content for d in documents],generation_kwargs)
+    results = cache.get(key)
+    if results is not None:
+        if stream_handler is not None and results:
+            stream_handler(results[0])
+        return {"query":query,"documents":documents,"results":results,"answer_cache":"hit"}
+    try:
+        res,shared = get_single_flight().do(key,run)
+    except GenerationCancelled:
+        # The session that ran the shared generation moved on, generate it here unless this request was cancelled too
+        cancellation.raise_if_cancelled()
+        res,shared = run(),False
+    if shared:
+        if stream_handler is not None and res['results']:
+            stream_handler(res['results'][0])
+        return {**res,"query":query,"documents":documents,"single_flight":"coalesced"}
+    cache.put(key,res['results'],names)
+    return res
+
+def _stream_params(stream_handler):
+    """ Pipeline params that make the QA node stream its tokens to the stream_handler.
+    """
+    if stream_handler is None:
+        return {}
+    return {"QA": {"invocation_context": {"stream": True, "stream_handler": stream_handler}}}
+
+@st.cache_resource
+def get_indexing_pipeline():
+    """ Indexing pipeline for the embedded document store, converting and splitting files like the REST API does.
+    """
+    p = Pipeline()
+    p.add_node(component=FileTypeClassifier(supported_types=["txt","pdf","docx"]), name="FileTypeClassifier", inputs=["File"])
+    p.add_node(component=TextConverter(), name="TextConverter", inputs=["FileTypeClassifier.output_1"])
+    p.add_node(component=PDFToTextConverter(), name="PDFConverter", inputs=["FileTypeClassifier.output_2"])
+    p.add_node(component=DocxToTextConverter(), name="DocxConverter", inputs=["FileTypeClassifier.output_3"])
+    p.add_node(component=PreProcessor(split_by="word",split_length=50), name="PreProcessor", inputs=["TextConverter","PDFConverter","DocxConverter"])
+    p.add_node(component=get_document_store(), name="DocumentStore", inputs=["PreProcessor"])
+    return p
+
+def _index_locally(name,data):
+    """ Indexes an uploaded file into the embedded document store, replacing the paragraphs of an earlier upload with the same name.
+    """
+    store = get_document_store()
+    store.delete_documents(filters={"name":[name]})
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp,os.path.basename(name))
+        with open(path,"wb") as f:
+            f.write(data)
+        get_indexing_pipeline().run(file_paths=[path],meta={"name":name,"uploaded_at":time.time()})
+    if RETRIEVAL_MODE == "hybrid":
+        # Embedded at ingest time, in batches, so queries only embed the query
+        store.update_embeddings(get_embedding_retriever(),update_existing_embeddings=False,batch_size=EMBEDDING_BATCH_SIZE)
+    return {"name":name,"documents":store.name_counts().get(name,0)}
+
+# Number of files indexed at the same time, and where the ingestion jobs and the files waiting to be indexed are kept
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", "4"))
+INGESTION_PATH = os.getenv("INGESTION_PATH", "ingestion")
+
+def _upload_bytes(name,data):
+    """ Indexes a file, through the REST API or into the embedded document store.
+    """
+    if DOCUMENT_STORE == "bm25":
+        return _index_locally(name,data)
+    # The REST API adds the meta to every paragraph, the catalog reads the upload time from it
+    return get_api_client().upload(name,data,{'split_length':'50','meta':json.dumps({'uploaded_at':time.time()})})
+
+def _document_indexed(name,content_hash):
+    # Answers generated from a previous version of the document are stale now
+    get_answer_cache().document_uploaded(name,content_hash)
+    get_document_catalog(_default_store()).invalidate()
+    get_retrieval_cache().invalidate()
+    if get_semantic_cache() is not None:
+        get_semantic_cache().invalidate_document(name)
 
 def upload_doc(file):
-    url = f"{API_ENDPOINT}/{DOC_UPLOAD}"
-    files = [("files", file)]
-    response = requests.post(url, files=files,data={'split_length':'50'}).json()
+    """ Indexes an uploaded file and waits for it. Use ingest_docs to index files in the background.
+    """
+    data = file.getvalue()
+    response = _upload_bytes(file.name,data)
+    _document_indexed(file.name,hashlib.sha256(data).hexdigest())
     return response
+
+@st.cache_resource
+def get_ingestion_queue():
+    """ The ingestion queue shared by all sessions of this process. Unfinished jobs of a previous run are resumed when it is created.
+    """
+    os.makedirs(INGESTION_PATH,exist_ok=True)
+    return IngestionQueue(INGESTION_PATH,_upload_bytes,workers=INGESTION_WORKERS,on_done=_document_indexed)
+
+def ingest_docs(files):
+    """ Queues uploaded files for indexing in the background and returns their jobs, with a 'status' of 'queued', 'running', 'done' or 'failed'.
+
+    A file that was indexed before with the same name and content is not sent again, so calling this on every rerun of the page with
+    the files in the file uploader only indexes the new ones.
+    """
+    return get_ingestion_queue().submit_many((file.name,file.getvalue()) for file in files)
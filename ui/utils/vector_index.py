@@ -0,0 +1,200 @@
+import json
+import logging
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def quantize(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Normalizes vectors to unit length and quantizes them to int8, with one scale per vector.
+
+    :return: The int8 codes and the float32 scales, so that codes * scales approximates the normalized vectors.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def kmeans(vectors: np.ndarray, k: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """
+    Spherical k-means: returns k unit-length centroids of the unit-length vectors.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=k, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        for c in range(k):
+            members = vectors[assignments == c]
+            if len(members):
+                centroids[c] = members.sum(axis=0)
+            else:
+                # Reseed empty clusters, so no list stays empty
+                centroids[c] = vectors[rng.integers(len(vectors))]
+        centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+    return centroids
+
+
+class IVFInt8Index:
+    """
+    Approximate nearest neighbour index of int8-quantized vectors, with an inverted file (IVF) of k-means clusters.
+
+    A search scores the query against the centroids, and only scans the vectors in the `n_probe` closest clusters.
+    Vectors are compared by cosine similarity. The codes, scales and cluster lists are saved to `path` as .npy files,
+    and memory-mapped when the index is loaded again.
+    """
+
+    def __init__(self, dim: int, path: Optional[str] = None, n_probe: int = 8):
+        """
+        :param dim: Dimension of the vectors.
+        :param path: Directory to save the index to. The index is loaded from it if it exists.
+        :param n_probe: Number of clusters scanned per search. More is slower but finds more of the true neighbours.
+        """
+        self.dim = dim
+        self.path = path
+        self.n_probe = n_probe
+        self.ids: List[str] = []
+        self.codes = np.zeros((0, dim), dtype=np.int8)
+        self.scales = np.zeros(0, dtype=np.float32)
+        self.centroids = np.zeros((0, dim), dtype=np.float32)
+        self.list_ptr = np.zeros(1, dtype=np.int64)
+        self.list_rows = np.zeros(0, dtype=np.int64)
+        self._rows: Dict[str, int] = {}
+        if path is not None and os.path.exists(os.path.join(path, "vector_ids.json")):
+            self._load()
+
+    def clone(self) -> "IVFInt8Index":
+        """
+        Returns a copy to update while searches keep using this index. Arrays are shared, updates replace them.
+        """
+        index = IVFInt8Index.__new__(IVFInt8Index)
+        index.__dict__.update(self.__dict__)
+        return index
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self._rows
+
+    def row(self, doc_id: str) -> Optional[int]:
+        return self._rows.get(doc_id)
+
+    def add(self, ids: Sequence[str], vectors: np.ndarray):
+        """
+        Adds or replaces the vectors of the given ids. Call `build` afterwards to update the clusters.
+        """
+        codes, scales = quantize(vectors)
+        new_ids, new_codes, new_scales = [], [], []
+        codes_array, scales_array = np.array(self.codes), np.array(self.scales)
+        for doc_id, code, scale in zip(ids, codes, scales):
+            row = self._rows.get(doc_id)
+            if row is None:
+                new_ids.append(doc_id)
+                new_codes.append(code)
+                new_scales.append(scale)
+            else:
+                codes_array[row] = code
+                scales_array[row] = scale
+        if new_ids:
+            codes_array = np.concatenate([codes_array, np.asarray(new_codes, dtype=np.int8).reshape(-1, self.dim)])
+            scales_array = np.concatenate([scales_array, np.asarray(new_scales, dtype=np.float32)])
+        self._set(list(self.ids) + new_ids, codes_array, scales_array)
+
+    def keep(self, ids: Sequence[str]) -> bool:
+        """
+        Removes the vectors of all ids that are not in `ids`. Call `build` afterwards to update the clusters.
+
+        :return: Whether any vectors were removed.
+        """
+        keep = set(ids)
+        rows = np.asarray([row for row, doc_id in enumerate(self.ids) if doc_id in keep], dtype=np.int64)
+        if len(rows) == len(self.ids):
+            return False
+        self._set([self.ids[row] for row in rows], np.array(self.codes)[rows], np.array(self.scales)[rows])
+        return True
+
+    def build(self, lists: Optional[int] = None):
+        """
+        Clusters the vectors into `lists` inverted lists, by default about the square root of the number of vectors,
+        and saves the index.
+        """
+        n = len(self.ids)
+        if n:
+            vectors = np.asarray(self.codes, dtype=np.float32) * np.asarray(self.scales)[:, None]
+            k = min(n, lists or max(1, int(np.sqrt(n))))
+            self.centroids = kmeans(vectors, k).astype(np.float32)
+            assignments = np.argmax(vectors @ self.centroids.T, axis=1)
+            self.list_rows = np.argsort(assignments, kind="stable").astype(np.int64)
+            self.list_ptr = np.zeros(k + 1, dtype=np.int64)
+            np.cumsum(np.bincount(assignments, minlength=k), out=self.list_ptr[1:])
+        else:
+            self.centroids = np.zeros((0, self.dim), dtype=np.float32)
+            self.list_ptr = np.zeros(1, dtype=np.int64)
+            self.list_rows = np.zeros(0, dtype=np.int64)
+        if self.path is not None:
+            self._save()
+
+    def search(self, query: np.ndarray, top_k: int, rows: Optional[np.ndarray] = None) -> List[Tuple[str, float]]:
+        """
+        Returns the ids and cosine similarities of the top_k vectors closest to the query.
+
+        :param rows: Only consider these rows, for filtered queries. They are scanned exhaustively instead of through
+        the clusters, since a filter typically leaves a few hundred rows at most.
+        """
+        if not len(self.ids):
+            return []
+        q_codes, q_scale = quantize(np.asarray(query, dtype=np.float32).reshape(1, -1))
+        if rows is None:
+            probes = np.argsort(-(self.centroids @ (q_codes[0] * q_scale[0])))[: self.n_probe]
+            rows = np.concatenate([self.list_rows[self.list_ptr[c]:self.list_ptr[c + 1]] for c in probes])
+        if not len(rows):
+            return []
+        scores = (self.codes[rows].astype(np.int32) @ q_codes[0].astype(np.int32)) * self.scales[rows] * q_scale[0]
+        if len(rows) > top_k:
+            best = np.argpartition(-scores, top_k - 1)[:top_k]
+        else:
+            best = np.arange(len(rows))
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return [(self.ids[rows[i]], float(scores[i])) for i in best]
+
+    def _set(self, ids: List[str], codes: np.ndarray, scales: np.ndarray):
+        self.ids = ids
+        self.codes = codes
+        self.scales = scales
+        self._rows = {doc_id: row for row, doc_id in enumerate(ids)}
+
+    def _save(self):
+        os.makedirs(self.path, exist_ok=True)
+        for name in ("codes", "scales", "centroids", "list_ptr", "list_rows"):
+            tmp = os.path.join(self.path, f"vector_{name}.tmp.npy")
+            np.save(tmp, np.asarray(getattr(self, name)))
+            os.replace(tmp, os.path.join(self.path, f"vector_{name}.npy"))
+        tmp = os.path.join(self.path, "vector_ids.tmp.json")
+        with open(tmp, "w") as f:
+            json.dump({"dim": self.dim, "ids": self.ids}, f)
+        os.replace(tmp, os.path.join(self.path, "vector_ids.json"))
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.path, "vector_ids.json")) as f:
+                meta = json.load(f)
+            if meta["dim"] != self.dim:
+                logger.warning("The vector index in %s has dimension %s instead of %s, ignoring it", self.path, meta["dim"], self.dim)
+                return
+            arrays = {
+                name: np.load(os.path.join(self.path, f"vector_{name}.npy"), mmap_mode="r")
+                for name in ("codes", "scales", "centroids", "list_ptr", "list_rows")
+            }
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("Could not load the vector index from %s: %s", self.path, e)
+            return
+        self._set(meta["ids"], arrays["codes"], arrays["scales"])
+        self.centroids = arrays["centroids"]
+        self.list_ptr = arrays["list_ptr"]
+        self.list_rows = arrays["list_rows"]
@@ -0,0 +1,457 @@
+import heapq
+import inspect
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import weakref
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from haystack.nodes.prompt.invocation_layer import DefaultTokenStreamingHandler
+
+from utils import cancellation, tracing
+from utils.llamalayer import LlamaCPPInvocationLayer
+
+logger = logging.getLogger(__name__)
+
+# Generation kwargs that are forwarded to the workers, the rest of what Haystack passes to invoke stays in this process
+FORWARDED_KWARGS = ["suffix", "max_tokens", "temperature", "top_p", "logprobs", "echo", "repeat_penalty", "top_k"]
+
+
+class WorkerPoolFull(Exception):
+    """
+    Raised when a request is submitted while the queue of the worker pool is full.
+    """
+
+
+class _ForwardingHandler:
+    """
+    Stream handler used inside a worker, sending every token back to the parent process.
+    """
+
+    def __init__(self, results: Any, request_id: int):
+        self.results = results
+        self.request_id = request_id
+
+    def __call__(self, token_received: str, **kwargs) -> str:
+        self.results.put((self.request_id, "token", token_received))
+        return token_received
+
+
+class _SharedCancellation(cancellation.CancellationToken):
+    """
+    Cancellation token of a request inside a worker. The parent process cancels it by writing the request id into a
+    shared value, which the worker reads between decode steps.
+    """
+
+    def __init__(self, cancelled_request: Any, request_id: int):
+        super().__init__()
+        self.cancelled_request = cancelled_request
+        self.request_id = request_id
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancelled_request.value == self.request_id
+
+
+def _worker_main(worker_id: int, model_name_or_path: str, layer_kwargs: Dict[str, Any], inbox: Any, results: Any,
+    cancelled_request: Any):
+    """
+    Entry point of a worker process. Loads the model, then runs requests from its inbox until it gets None.
+    """
+    try:
+        layer = LlamaCPPInvocationLayer(model_name_or_path, **layer_kwargs)
+    except Exception as e:
+        results.put((None, "failed", (worker_id, repr(e))))
+        return
+    results.put((None, "ready", (worker_id, None)))
+
+    while True:
+        message = inbox.get()
+        if message is None:
+            break
+        request_id, method, kwargs = message
+        # The stages timed in the worker are sent back, to be added to the trace of the request in the parent
+        trace = tracing.Trace(method)
+        try:
+            with tracing.activate(trace), cancellation.activate(_SharedCancellation(cancelled_request, request_id)):
+                if method == "invoke":
+                    layer._remember_tokens(kwargs["prompt"], kwargs.pop("tokens"))
+                    if kwargs.get("stream"):
+                        kwargs["stream_handler"] = _ForwardingHandler(results, request_id)
+                    output = layer.invoke(**kwargs)
+                elif method == "score_labels":
+                    output = layer.score_labels(**kwargs)
+                else:
+                    raise ValueError(f"Unknown method {method}")
+            results.put((request_id, "stages", trace.stages))
+            results.put((request_id, "done", (worker_id, output)))
+        except cancellation.GenerationCancelled:
+            results.put((request_id, "cancelled", (worker_id, None)))
+        except Exception as e:
+            logger.exception(e)
+            results.put((request_id, "error", (worker_id, repr(e))))
+
+
+class LlamaWorkerPool:
+    """
+    Pool of worker processes that each hold a llama model and run one request at a time.
+
+    The model file is memory-mapped, so the weights are shared through the page cache instead of being copied into
+    every worker, and the cores are split between the workers. Requests wait in a priority queue of bounded depth;
+    when it is full, new requests are rejected with WorkerPoolFull instead of piling up.
+
+    A worker that dies after it started, for instance killed by the out-of-memory killer, fails the request it was
+    running and is started again, after a delay that doubles with every death up to `max_restart_delay` seconds.
+    """
+
+    def __init__(self, model_name_or_path: str, workers: int = 2, max_queue: int = 32, layer_kwargs: Optional[Dict[str, Any]] = None,
+        restart_delay: float = 1.0, max_restart_delay: float = 60.0):
+        """
+        :param model_name_or_path: Path of the GGML model file.
+        :param workers: Number of worker processes.
+        :param max_queue: Maximum number of requests waiting for a worker.
+        :param layer_kwargs: Keyword arguments for the LlamaCPPInvocationLayer of each worker. n_threads defaults to
+        an equal share of the cores.
+        :param restart_delay: Seconds before a dead worker is started again the first time.
+        :param max_restart_delay: Maximum seconds before a dead worker is started again.
+        """
+        layer_kwargs = dict(layer_kwargs or {})
+        layer_kwargs["use_mmap"] = True
+        if not layer_kwargs.get("n_threads"):
+            layer_kwargs["n_threads"] = max(1, (os.cpu_count() or 1) // workers)
+
+        self.max_queue = max_queue
+        self.model_name_or_path = model_name_or_path
+        self.layer_kwargs = layer_kwargs
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self._context = multiprocessing.get_context("spawn")
+        self._results = self._context.Queue()
+        self._inboxes: List[Any] = [None] * workers
+        # Id of the request each worker should stop, -1 for none
+        self._cancelled: List[Any] = [None] * workers
+        self._processes: List[Any] = [None] * workers
+        for i in range(workers):
+            self._start_worker(i)
+
+        self._lock = threading.Condition()
+        self._pending: List[Tuple[int, int, str, Dict[str, Any], Optional[int]]] = []
+        self._idle: List[int] = []
+        self._ready: List[int] = []
+        self._assigned: Dict[int, int] = {}
+        self._replies: Dict[int, "queue.Queue[Tuple[str, Any]]"] = {}
+        self._ids = itertools.count()
+        self._closed = False
+        # Errors of the workers that failed to start, and the workers that are still loading the model
+        self._failed: Dict[int, str] = {}
+        self._loading = set(range(workers))
+        # Per worker: when it was last started, and the delay before it is started again if it dies
+        self._started = [time.monotonic()] * workers
+        self._delays = [restart_delay] * workers
+        self._restarts = 0
+
+        threading.Thread(target=self._read_results, daemon=True).start()
+        threading.Thread(target=self._dispatch, daemon=True).start()
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    def _start_worker(self, worker: int):
+        # A fresh inbox, the old one may still hold the request the dead worker never read
+        self._inboxes[worker] = self._context.Queue()
+        self._cancelled[worker] = self._context.Value("q", -1, lock=False)
+        self._processes[worker] = self._context.Process(
+            target=_worker_main,
+            args=(worker, self.model_name_or_path, self.layer_kwargs, self._inboxes[worker], self._results, self._cancelled[worker]),
+            daemon=True,
+        )
+        self._processes[worker].start()
+
+    def submit(self, method: str, kwargs: Dict[str, Any], priority: int = 0, worker: Optional[int] = None) -> int:
+        """
+        Queues a request and returns its id. Lower priorities are served first.
+
+        :param worker: Id of the worker to run the request on, None for the first idle one.
+        :raises WorkerPoolFull: If max_queue requests are already waiting.
+        """
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The worker pool is closed")
+            if len(self._failed) == len(self._processes):
+                raise RuntimeError(f"All llama workers failed to start: {next(iter(self._failed.values()))}")
+            if len(self._pending) >= self.max_queue:
+                raise WorkerPoolFull(f"The inference queue is full ({self.max_queue} requests waiting), try again shortly")
+            if worker is not None and worker not in self._ready:
+                raise RuntimeError(f"Llama worker {worker} is not running")
+            request_id = next(self._ids)
+            self._replies[request_id] = queue.Queue()
+            heapq.heappush(self._pending, (priority, request_id, method, kwargs, worker))
+            self._lock.notify_all()
+        return request_id
+
+    def replies(self, request_id: int) -> Iterator[Tuple[str, Any]]:
+        """
+        Yields the ("token", text) messages of a request, the ("stages", records) timed by the worker, then its
+        ("done", output), ("error", message) or ("cancelled", None) reply.
+        """
+        replies = self._replies[request_id]
+        try:
+            while True:
+                try:
+                    kind, payload = replies.get(timeout=1)
+                except queue.Empty:
+                    self._check_alive(request_id)
+                    continue
+                yield kind, payload
+                if kind in ("done", "error", "cancelled"):
+                    return
+        finally:
+            with self._lock:
+                self._replies.pop(request_id, None)
+
+    def call(self, method: str, kwargs: Dict[str, Any], priority: int = 0, on_token: Optional[Any] = None,
+        worker: Optional[int] = None) -> Any:
+        """
+        Submits a request and waits for its output. Streamed tokens are passed to `on_token` in the calling thread, and
+        the stages the worker timed are added to the active trace of the calling thread. Cancelling the active
+        cancellation token of the calling thread cancels the request.
+        """
+        token = cancellation.current()
+        if token is not None:
+            token.raise_if_cancelled()
+        request_id = self.submit(method, kwargs, priority, worker)
+        unregister = token.on_cancel(lambda: self.cancel(request_id)) if token is not None else lambda: None
+        try:
+            for kind, payload in self.replies(request_id):
+                if kind == "token" and on_token is not None:
+                    on_token(payload)
+                elif kind == "stages" and tracing.current() is not None:
+                    for record in payload:
+                        tracing.current().add_record(record)
+                elif kind == "done":
+                    return payload
+                elif kind == "error":
+                    raise RuntimeError(f"Llama worker failed: {payload}")
+                elif kind == "cancelled":
+                    raise cancellation.GenerationCancelled("The request was cancelled")
+        finally:
+            unregister()
+
+    def cancel(self, request_id: int):
+        """
+        Cancels a request. A waiting request is dropped from the queue, a running one stops at its next decode step.
+        """
+        with self._lock:
+            waiting = [entry for entry in self._pending if entry[1] == request_id]
+            if waiting:
+                self._pending.remove(waiting[0])
+                heapq.heapify(self._pending)
+            worker = self._assigned.get(request_id)
+            if worker is not None:
+                self._cancelled[worker].value = request_id
+            replies = self._replies.get(request_id)
+        if waiting and replies is not None:
+            replies.put(("cancelled", None))
+
+    def wait_ready(self, timeout: Optional[float] = None) -> List[int]:
+        """
+        Waits until every worker has loaded its model or failed to, and returns the ids of the workers that are running.
+
+        :raises TimeoutError: If workers are still starting after `timeout` seconds.
+        """
+        with self._lock:
+            if not self._lock.wait_for(lambda: len(self._ready) + len(self._failed) >= len(self._processes), timeout):
+                starting = len(self._processes) - len(self._ready) - len(self._failed)
+                raise TimeoutError(f"{starting} of {len(self._processes)} llama workers did not start within {timeout}s")
+            return sorted(self._ready)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "workers": len(self._processes),
+                "alive": sum(p.is_alive() for p in self._processes),
+                "idle": len(self._idle),
+                "queued": len(self._pending),
+                "running": len(self._assigned),
+                "max_queue": self.max_queue,
+                "restarts": self._restarts,
+            }
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._lock.notify_all()
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+    def _check_alive(self, request_id: int):
+        with self._lock:
+            worker = self._assigned.get(request_id)
+            if worker is None:
+                # A request waiting for a given worker
+                worker = next((entry[4] for entry in self._pending if entry[1] == request_id), None)
+        if worker is not None and not self._processes[worker].is_alive():
+            raise RuntimeError(f"Llama worker {worker} died while running the request")
+        if not any(p.is_alive() for p in self._processes) and len(self._failed) == len(self._processes):
+            raise RuntimeError("All llama workers have exited")
+
+    def _watch(self, interval: float = 1.0):
+        """
+        Fails the requests of workers that died after they started, and starts those workers again with backoff.
+        Workers that die while loading the model, for instance killed for running out of memory, are recorded as
+        failed to start, like the ones that report an error.
+        """
+        restart_at: Dict[int, float] = {}
+        while True:
+            time.sleep(interval)
+            now = time.monotonic()
+            with self._lock:
+                if self._closed:
+                    return
+                for worker in list(self._loading):
+                    if self._processes[worker].is_alive():
+                        continue
+                    self._loading.discard(worker)
+                    self._failed[worker] = f"exited with code {self._processes[worker].exitcode} while loading the model"
+                    logger.error("Llama worker %s %s", worker, self._failed[worker])
+                    self._lock.notify_all()
+                for worker in list(self._ready):
+                    if self._processes[worker].is_alive():
+                        continue
+                    self._ready.remove(worker)
+                    if worker in self._idle:
+                        self._idle.remove(worker)
+                    # A worker that ran for a while before it died starts again right away
+                    if now - self._started[worker] > 10 * self.max_restart_delay:
+                        self._delays[worker] = self.restart_delay
+                    restart_at[worker] = now + self._delays[worker]
+                    logger.error("Llama worker %s died (exit code %s), starting it again in %.1fs",
+                                 worker, self._processes[worker].exitcode, self._delays[worker])
+                    self._delays[worker] = min(2 * self._delays[worker], self.max_restart_delay)
+                    for request_id in [r for r, w in self._assigned.items() if w == worker]:
+                        del self._assigned[request_id]
+                        replies = self._replies.get(request_id)
+                        if replies is not None:
+                            replies.put(("error", f"Llama worker {worker} died while running the request"))
+                due = [worker for worker, at in restart_at.items() if at <= now]
+                for worker in due:
+                    del restart_at[worker]
+                    self._started[worker] = now
+                    self._restarts += 1
+                    self._loading.add(worker)
+            # Outside of the lock, spawning takes a while and the worker is neither idle nor assigned until it is ready.
+            # The watcher checks the loading workers again only after this.
+            for worker in due:
+                self._start_worker(worker)
+
+    def _dispatch(self):
+        while True:
+            with self._lock:
+                while not self._closed and self._next_request() is None:
+                    self._lock.wait()
+                if self._closed:
+                    return
+                entry = self._next_request()
+                self._pending.remove(entry)
+                heapq.heapify(self._pending)
+                _, request_id, method, kwargs, worker = entry
+                worker = self._idle[-1] if worker is None else worker
+                self._idle.remove(worker)
+                self._assigned[request_id] = worker
+            self._inboxes[worker].put((request_id, method, kwargs))
+
+    def _next_request(self) -> Optional[Tuple[int, int, str, Dict[str, Any], Optional[int]]]:
+        """
+        The first request, in priority order, that can run on an idle worker.
+        """
+        if not self._idle or not self._pending:
+            return None
+        if self._pending[0][4] is None:
+            return self._pending[0]
+        return next((entry for entry in sorted(self._pending) if entry[4] is None or entry[4] in self._idle), None)
+
+    def _read_results(self):
+        while True:
+            try:
+                request_id, kind, payload = self._results.get()
+            except (EOFError, OSError):
+                return
+            if kind in ("ready", "failed"):
+                worker, error = payload
+                with self._lock:
+                    if worker not in self._loading:
+                        # Already recorded as failed, it died right after reporting
+                        self._failed[worker] = error or self._failed.get(worker, "")
+                    elif kind == "ready":
+                        self._loading.discard(worker)
+                        self._idle.append(worker)
+                        self._ready.append(worker)
+                        logger.info("Llama worker %s is ready", worker)
+                    else:
+                        self._loading.discard(worker)
+                        self._failed[worker] = error
+                        logger.error("Llama worker %s failed to start: %s", worker, error)
+                    self._lock.notify_all()
+                continue
+            if kind in ("done", "error", "cancelled"):
+                worker, payload = payload
+                with self._lock:
+                    self._assigned.pop(request_id, None)
+                    # A worker the watcher retired after this reply is restarting, it becomes idle again once it is ready
+                    if worker in self._ready and worker not in self._idle:
+                        self._idle.append(worker)
+                    self._lock.notify_all()
+            replies = self._replies.get(request_id)
+            if replies is not None:
+                replies.put((kind, payload))
+
+
+class LlamaCPPWorkerInvocationLayer(LlamaCPPInvocationLayer):
+    """
+    Invocation layer that runs the llama model in a LlamaWorkerPool instead of in the Streamlit process.
+
+    This process only loads the vocabulary, to tokenize prompts for the token limit and the context packer. The tokens
+    are sent along with the prompt, so the workers do not tokenize it again.
+    """
+
+    def __init__(self, model_name_or_path: str, workers: int = 2, max_queue: int = 32, priority: int = 0, **kwargs):
+        """
+        :param model_name_or_path: Path of the GGML model file.
+        :param workers: Number of worker processes.
+        :param max_queue: Maximum number of requests waiting for a worker, see LlamaWorkerPool.
+        :param priority: Default priority of the requests of this layer. Lower is served first.
+        :param kwargs: Keyword arguments of LlamaCPPInvocationLayer, used by the workers.
+        """
+        accepted = inspect.signature(LlamaCPPInvocationLayer.__init__).parameters
+        layer_kwargs = {k: v for k, v in kwargs.items() if k in accepted and k != "model_name_or_path"}
+        # Only the workers load the draft model
+        super().__init__(model_name_or_path, **{**layer_kwargs, "vocab_only": True, "prefix_cache_slots": 0, "draft_model_path": None})
+        self.priority = priority
+        self.pool = LlamaWorkerPool(model_name_or_path, workers=workers, max_queue=max_queue, layer_kwargs=layer_kwargs)
+        weakref.finalize(self, self.pool.close)
+
+    def invoke(self, *args, **kwargs):
+        """
+        Sends the prompt to a worker and returns its list of generated texts. With `stream=True`, tokens are passed to
+        the `stream_handler` as the worker decodes them.
+        """
+        stream = kwargs.pop("stream", False)
+        stream_handler = kwargs.pop("stream_handler", None)
+        priority = kwargs.pop("priority", self.priority)
+        worker = kwargs.pop("worker", None)
+        prompt = kwargs.pop("prompt")
+        request = {key: kwargs[key] for key in FORWARDED_KWARGS if key in kwargs}
+        request.update(prompt=prompt, tokens=self._tokens_for(prompt), stream=stream)
+        on_token = (stream_handler or DefaultTokenStreamingHandler()) if stream else None
+        return self.pool.call("invoke", request, priority=priority, on_token=on_token, worker=worker)
+
+    def score_labels(self, prompts: List[str], labels: Dict[str, List[str]]) -> List[Dict[str, float]]:
+        return self.pool.call("score_labels", {"prompts": prompts, "labels": labels}, priority=self.priority)